@@ -1,94 +1,136 @@
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, Response, request, jsonify, render_template
 import logging
 import json
 import os
-import time
 import pandas as pd
 import atexit
-from apscheduler.schedulers.background import BackgroundScheduler
+import time
+from concurrent.futures import TimeoutError as FuturesTimeoutError
 
 # Importe do ultrabot
-from ultrabot import load_states, save_states, send_message_ultramsg, ultraChatBot
+from ultrabot import (
+    load_state_with_seq, save_state_if_unchanged, TURN_ATTEMPTS, TurnConflictError,
+    format_number, send_message_ultramsg, ultraChatBot,
+    state_store, conversation_archive, outbound_dispatcher, outbound_stats, receipt_service, STATE_DB,
+    FREE_TEXT_STATES, product_list_cache
+)
+from catalog import product_catalog, repair_table
+from executor import ChatExecutor
+from inactivity import InactivityScheduler, POLL_INTERVAL
+from dedup import DedupCache, message_key
+from debounce import InboundDebouncer
+from ingest import CatalogIngest, CatalogValidationError
+from events import EventBroker, ChangeFeed
+from cluster import CachedSetting, LeaderLease
+from metrics import REGISTRY, CONTENT_TYPE, Gauge, WEBHOOK_TURN_SECONDS, WEBHOOK_REQUEST_SECONDS
 
 app = Flask(__name__)
 
 # Configuração de logging
 logging.basicConfig(level=logging.INFO)
 
-# Caminho para o arquivo de status do bot
+# Arquivo antigo com o status do bot (importado para o banco uma única vez)
 STATUS_FILE = 'bot_status.json'
 
-# Função para carregar o status do bot
-def load_bot_status():
-    """Carrega o status do bot de um arquivo JSON. Se não existir, retorna False (desativado)."""
-    if os.path.exists(STATUS_FILE):
-        try:
-            with open(STATUS_FILE, 'r') as f:
-                data = json.load(f)
-                return data.get("active", False)
-        except Exception as e:
-            logging.error(f"Erro ao carregar status do bot: {e}")
-    return False  # Default: desativado
-
-# Função para salvar o status do bot
-def save_bot_status(is_active: bool):
-    """Salva o status do bot em um arquivo JSON."""
-    try:
-        with open(STATUS_FILE, 'w') as f:
-            json.dump({"active": is_active}, f)
-    except Exception as e:
-        logging.error(f"Erro ao salvar status do bot: {e}")
-
-# Inicializa o status do bot ao iniciar
-bot_active = load_bot_status()
-
-# Função para verificar conversas inativas
-def check_inactive_conversations():
+def migrate_bot_status(json_path: str):
+    """Leva o status do antigo bot_status.json para o banco e renomeia o arquivo para .migrated."""
+    if not os.path.exists(json_path):
+        return
     try:
-        states = load_states()
-        current_time = time.time()
-
-        for chatID, state_info in list(states.items()):
-            last_interaction = state_info.get('last_interaction', current_time)
-            state = state_info.get('state', '')
-            pause_start_time = state_info.get('pause_start_time', None)
-
-            # Se inativo por mais de 20 min, mas menos de 30 min, enviar aviso
-            if 20 * 60 <= current_time - last_interaction < 30 * 60 and state != 'WARNING_SENT':
-                send_message_ultramsg(
-                    chatID,
-                    "Estamos verificando se você ainda está aí! Sua sessão será pausada em 30 minutos por inatividade. "
-                    "Se precisar continuar, por favor, envie uma mensagem."
-                )
-                states[chatID]['state'] = 'WARNING_SENT'
-                save_states(states)
-
-            # Se inativo por mais de 30 min e não está em SESSION_ENDED
-            elif current_time - last_interaction >= 30 * 60 and state != 'SESSION_ENDED':
-                send_message_ultramsg(
-                    chatID,
-                    "Sua sessão foi pausada por inatividade. "
-                    "Se precisar de algo, por favor, envie uma nova mensagem para iniciaremos um novo atendimento."
-                )
-                states[chatID]['state'] = 'SESSION_ENDED'
-                states[chatID]['pause_start_time'] = time.time()
-                save_states(states)
-
-            # Remove estados SESSION_ENDED há mais de 24 horas
-            if state == 'SESSION_ENDED' and pause_start_time and current_time - pause_start_time > 24 * 60 * 60:
-                del states[chatID]
-
-        save_states(states)
-
+        with open(json_path, 'r') as f:
+            active = bool(json.load(f).get("active", False))
     except Exception as e:
-        logging.error(f"Erro ao verificar conversas inativas: {e}")
-
-# Configuração do agendador para conversas inativas
-scheduler = BackgroundScheduler()
-scheduler.add_job(func=check_inactive_conversations, trigger="interval", seconds=60)
-scheduler.start()
-
-atexit.register(lambda: scheduler.shutdown())
+        logging.error(f"Erro ao ler {json_path} para migração: {e}")
+        return
+    # Não sobrescreve um valor que outro processo já tenha gravado
+    state_store.set_setting('bot_active', active, overwrite=False)
+    os.replace(json_path, json_path + '.migrated')
+    logging.info(f"Status do bot migrado de {json_path} para {STATE_DB}.")
+
+# Status do bot (ativado/desativado) compartilhado por todos os workers pelo banco
+migrate_bot_status(STATUS_FILE)
+bot_active = CachedSetting(state_store, 'bot_active', default=False)
+
+# Mensagens de um mesmo chat são processadas em ordem e uma de cada vez;
+# chats diferentes rodam em paralelo
+chat_executor = ChatExecutor(max_workers=8)
+
+# Tempo máximo que o webhook espera o processamento antes de responder
+WEBHOOK_TIMEOUT = 25
+
+# Resposta de process_message quando a mensagem ficou esperando as próximas
+DEBOUNCED = object()
+
+# Eventos já recebidos: reentregas da UltraMsg não são processadas de novo
+webhook_dedup = DedupCache(STATE_DB)
+
+# Atualizações da planilha de produtos: validadas fora da requisição, uma por vez
+catalog_ingest = CatalogIngest(product_catalog)
+# Tempo máximo que o /upload espera a validação antes de responder
+UPLOAD_TIMEOUT = 60
+
+# Mensagens seguidas em estados de texto livre são juntadas e processadas uma vez
+inbound_debouncer = InboundDebouncer(
+    lambda chat_id, message_data: chat_executor.submit(chat_id, run_bot_turn, message_data)
+)
+
+# Avisos, pausas e arquivamentos por inatividade, disparados pelo prazo de cada conversa
+inactivity_scheduler = InactivityScheduler(
+    state_store, chat_executor, send_message_ultramsg, archive=conversation_archive,
+    poll_interval=POLL_INTERVAL
+)
+state_store.add_listener(inactivity_scheduler.update)
+
+# Com vários workers, só o processo líder roda o agendador de inatividade
+inactivity_leader = LeaderLease(
+    STATE_DB, 'inactivity', on_acquire=inactivity_scheduler.start, on_release=inactivity_scheduler.stop
+)
+
+# Mudanças de conversa e do status do bot empurradas para os painéis abertos (/events);
+# vêm do banco, então incluem as feitas por outros workers
+event_broker = EventBroker()
+event_feed = ChangeFeed(event_broker, state_store, bot_active)
+state_store.add_listener(event_feed.wake)
+
+# Valores lidos na hora da coleta do /metrics
+Gauge('ultrabot_conversations', 'Conversas no banco de estados, por estado.',
+      state_store.count_by_state, ['state'])
+Gauge('ultrabot_state_db_bytes', 'Tamanho do banco de estados em disco (com o WAL).', state_store.size_bytes)
+Gauge('ultrabot_bot_active', '1 se o bot está ativado.', lambda: int(bool(bot_active.get())))
+Gauge('ultrabot_inactivity_leader', '1 se este processo roda o agendador de inatividade.',
+      lambda: int(inactivity_leader.is_leader))
+Gauge('ultrabot_pending_chat_tasks', 'Tarefas na fila dos chats.', chat_executor.pending)
+
+def warm_catalogs():
+    """Carrega (e compila, se o .xlsx mudou) as planilhas antes da primeira mensagem."""
+    for cache in (product_catalog, repair_table):
+        try:
+            cache.snapshot()
+        except Exception as e:
+            logging.error(f"Erro ao carregar {cache.path} na inicialização: {e}")
+
+def start_background_services():
+    warm_catalogs()
+    # Os processos de recibo levam alguns segundos para subir; sobem antes do primeiro pedido
+    receipt_service.warm()
+    inactivity_leader.start()
+    event_feed.start()
+
+    atexit.register(lambda: inactivity_leader.stop())
+    atexit.register(lambda: event_broker.close())
+    atexit.register(lambda: event_feed.stop())
+    atexit.register(lambda: catalog_ingest.shutdown(wait=True))
+    # Ordem inversa no encerramento: termina os turnos em andamento e depois esvazia as filas
+    atexit.register(lambda: outbound_dispatcher.shutdown(wait=True))
+    atexit.register(lambda: receipt_service.shutdown(wait=True))
+    atexit.register(lambda: chat_executor.shutdown(wait=True))
+    # Roda antes de fechar a fila dos chats: entrega as mensagens que estavam agrupando
+    atexit.register(lambda: inbound_debouncer.stop())
+
+# Os processos que renderizam recibos reimportam este arquivo como '__mp_main__';
+# neles o agendador não pode subir
+if __name__ != '__mp_main__':
+    start_background_services()
 
 ##############################################################################
 # Rotas para Página de Controle
@@ -102,17 +144,20 @@ def index():
 @app.route('/status', methods=['GET', 'POST'])
 def bot_status():
     """Retorna ou altera o estado do bot."""
-    global bot_active
     if request.method == 'POST':
-        bot_active = not bot_active
-        save_bot_status(bot_active)  # Salva o estado no arquivo
-        return jsonify({'active': bot_active})
+        active = bot_active.toggle()  # Grava no banco, vale para todos os workers
+        # Os painéis recebem a mudança pelo ChangeFeed, como as feitas em outros workers
+        event_feed.wake()
+        return jsonify({'active': active})
     elif request.method == 'GET':
-        return jsonify({'active': bot_active})
+        return jsonify({'active': bot_active.get()})
 
 @app.route('/upload', methods=['POST'])
 def upload_excel():
-    """Recebe upload de arquivo Excel e sobrescreve excel/Produtos_Lacrados.xlsx."""
+    """
+    Recebe upload de arquivo Excel e, se ele for válido, substitui excel/Produtos_Lacrados.xlsx.
+    Responde com o resumo das mudanças (produtos adicionados, removidos e com preço alterado).
+    """
     if 'arquivo' not in request.files:
         return jsonify({'message': 'Nenhum arquivo enviado.'}), 400
     
@@ -120,28 +165,146 @@ def upload_excel():
     if file.filename == '':
         return jsonify({'message': 'Nome de arquivo vazio.'}), 400
 
-    # Caminho para salvar na pasta excel/
-    save_path = os.path.join('excel', 'Produtos_Lacrados.xlsx')
-    
-    # Salva (sobrescreve) o arquivo
-    file.save(save_path)
+    # Salva num temporário; a planilha atual só é trocada depois de validada
+    tmp_path = catalog_ingest.save_upload(file)
+    return ingest_response(catalog_ingest.submit(tmp_path))
+
+@app.route('/upload/rollback', methods=['POST'])
+def rollback_excel():
+    """Volta a planilha de produtos para a versão anterior (ou para `version`, se informada)."""
+    version = (request.get_json(silent=True) or {}).get('version')
+    try:
+        future = catalog_ingest.rollback(version)
+    except FileNotFoundError as e:
+        return jsonify({'message': str(e), 'versions': catalog_ingest.versions()}), 404
+    return ingest_response(future)
+
+@app.route('/upload/versions', methods=['GET'])
+def list_excel_versions():
+    return jsonify({'versions': catalog_ingest.versions()}), 200
 
-    logging.info(f"Planilha atualizada: {save_path}")
-    return jsonify({'message': 'Planilha atualizada com sucesso!'}), 200
+def ingest_response(future):
+    try:
+        diff = future.result(timeout=UPLOAD_TIMEOUT)
+    except FuturesTimeoutError:
+        return jsonify({'message': 'Planilha recebida; a validação continua em segundo plano.'}), 202
+    except CatalogValidationError as e:
+        logging.warning(f"Planilha recusada: {e}")
+        return jsonify({'message': 'Planilha recusada; a versão atual foi mantida.', 'errors': e.errors}), 400
+    except Exception as e:
+        logging.error(f"Erro ao atualizar a planilha: {e}")
+        return jsonify({'message': 'Não foi possível atualizar a planilha; a versão atual foi mantida.'}), 500
+
+    return jsonify({
+        'message': 'Planilha atualizada com sucesso!',
+        'version': product_catalog.version,
+        'diff': diff,
+    }), 200
+
+# Tamanho padrão e máximo de uma página de /conversations
+CONVERSATIONS_PAGE_SIZE = 200
+CONVERSATIONS_MAX_PAGE_SIZE = 1000
+
+def parse_bool(value):
+    if value is None:
+        return None
+    return value.lower() in ('1', 'true', 'sim', 'yes')
+
+def with_etag(response, etag: str):
+    response.set_etag(etag, weak=True)
+    return response
+
+def conversation_json(chat_id: str, state: str, agent_mode: bool) -> dict:
+    return {'chatID': chat_id, 'agentMode': agent_mode, 'state': state}
 
 # Rota que retorna a lista de conversas atuais
 @app.route('/conversations', methods=['GET'])
 def get_conversations():
-    states = load_states()
-    conversation_list = []
-
-    for chat_id, st in states.items():
-        conversation_list.append({
-            'chatID': chat_id,
-            'agentMode': st.get('agent_mode', False),  # se não existir, default False
-            'state': st.get('state', '')  # Adiciona o estado
-        })
-    return jsonify(conversation_list), 200
+    """
+    Lista paginada das conversas (só colunas indexadas, sem desserializar os estados).
+
+    Parâmetros: `state`, `agent_mode` (filtros), `limit`, `after` (chatID da última linha
+    da página anterior) ou `since` (cursor: devolve só o que mudou depois dele, incluindo
+    as conversas que saíram da lista em `removed`). Toda resposta traz `cursor`, e o ETag
+    é o seq atual do banco: sem nenhuma escrita desde a última consulta, a resposta é 304.
+    """
+    # Lido antes das linhas: uma escrita durante a consulta aparece na próxima chamada com `since`
+    current_seq = state_store.current_seq()
+    etag = str(current_seq)
+    if request.if_none_match.contains_weak(etag):
+        return with_etag(app.response_class(status=304), etag)
+
+    state = request.args.get('state')
+    agent_mode = parse_bool(request.args.get('agent_mode'))
+    try:
+        limit = min(int(request.args.get('limit', CONVERSATIONS_PAGE_SIZE)), CONVERSATIONS_MAX_PAGE_SIZE)
+        since = request.args.get('since', type=int)
+    except ValueError:
+        return jsonify({'error': 'Parâmetros inválidos'}), 400
+    limit = max(limit, 1)
+
+    if since is not None:
+        changes = state_store.changes_since(since, limit)
+        if changes is None:
+            # Cursor antigo demais: o cliente precisa recarregar a lista inteira
+            return with_etag(jsonify({'reset': True, 'cursor': current_seq}), etag)
+        conversations, removed = [], []
+        for chat_id, row_state, row_agent_mode, _, deleted in changes:
+            matches = (state is None or row_state == state) and (agent_mode is None or row_agent_mode == agent_mode)
+            if deleted or not matches:
+                removed.append(chat_id)
+            else:
+                conversations.append(conversation_json(chat_id, row_state, row_agent_mode))
+        more = len(changes) == limit
+        cursor = changes[-1][3] if more else max(since, current_seq)
+        body = {'conversations': conversations, 'removed': removed, 'cursor': cursor, 'more': more}
+        return with_etag(jsonify(body), etag)
+
+    rows = state_store.summaries_page(state, agent_mode, request.args.get('after'), limit)
+    body = {
+        'conversations': [conversation_json(*row) for row in rows],
+        'next': rows[-1][0] if len(rows) == limit else None,
+        'cursor': current_seq,
+    }
+    return with_etag(jsonify(body), etag)
+
+# Fluxo de eventos do painel (Server-Sent Events)
+@app.route('/events', methods=['GET'])
+def stream_events():
+    """
+    Eventos 'conversation' (created, state, agent_mode, session_ended, removed) e
+    'bot_status'. Um painel que não acompanha recebe 'resync' e deve buscar o que
+    perdeu em /conversations?since=<cursor>.
+    """
+    subscriber = event_broker.subscribe()
+    if subscriber is None:
+        return jsonify({'error': 'Painéis demais conectados'}), 503
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    return Response(event_broker.stream(subscriber), mimetype='text/event-stream', headers=headers)
+
+# Métricas para o Prometheus
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(REGISTRY.render(), content_type=CONTENT_TYPE)
+
+# Rota com contadores para monitoramento
+@app.route('/stats', methods=['GET'])
+def get_stats():
+    return jsonify({
+        'outbound': dict(outbound_stats),
+        'webhook_dedup': webhook_dedup.stats(),
+        'product_list_cache': product_list_cache.stats(),
+        'pending_tasks': chat_executor.pending(),
+        'events': event_broker.stats(),
+    }), 200
+
+# Rota que busca uma conversa encerrada no arquivo frio
+@app.route('/archive/<chat_id>', methods=['GET'])
+def get_archived_conversation(chat_id):
+    record = conversation_archive.lookup(chat_id)
+    if record is None:
+        return jsonify({'error': 'Conversa não encontrada no arquivo'}), 404
+    return jsonify(record), 200
 
 # Rota para alterar se a conversa está ou não em modo atendente
 @app.route('/toggle_conversation', methods=['POST'])
@@ -153,23 +316,43 @@ def toggle_conversation():
     if not chat_id:
         return jsonify({'error': 'chatID não fornecido'}), 400
 
-    states = load_states()
-    if chat_id not in states:
+    # Passa pela fila do chat para não sobrescrever uma mensagem em processamento
+    future = chat_executor.submit(chat_id, set_agent_mode, chat_id, agent_mode)
+    try:
+        found = future.result(timeout=WEBHOOK_TIMEOUT)
+    except FuturesTimeoutError:
+        logging.warning(f"Alteração do modo atendente de {chat_id} passou de {WEBHOOK_TIMEOUT}s; continua em segundo plano.")
+        return jsonify({'status': 'em processamento'}), 202
+    if not found:
         return jsonify({'error': 'Conversa não encontrada'}), 404
-
-    # Atualiza o estado
-    states[chat_id]['agent_mode'] = agent_mode
-    save_states(states)
     return jsonify({'success': True}), 200
 
+def set_agent_mode(chat_id: str, agent_mode) -> bool:
+    # Gravação condicional: não desfaz um turno gravado por outro worker entre a leitura e a escrita
+    for _ in range(TURN_ATTEMPTS):
+        info, seq = load_state_with_seq(chat_id)
+        if info is None:
+            return False
+
+        # Atualiza o estado
+        info['agent_mode'] = agent_mode
+        if save_state_if_unchanged(chat_id, info, seq):
+            return True
+    raise TurnConflictError(f"Conversa {chat_id} mudou durante todas as {TURN_ATTEMPTS} tentativas")
+
 ##############################################################################
 # Webhook principal do UltraMsg
 ##############################################################################
 
 @app.route('/', methods=['POST'])
 def webhook():
-    global bot_active
-    if not bot_active:
+    started = time.perf_counter()
+    body, code = handle_webhook()
+    WEBHOOK_REQUEST_SECONDS.labels(code).observe(time.perf_counter() - started)
+    return body, code
+
+def handle_webhook():
+    if not bot_active.get():
         # Se o bot está desativado, devolve 403
         return jsonify({'error': 'Bot está desativado'}), 403
 
@@ -204,20 +387,61 @@ def webhook():
             logging.error("Faltando 'sender' ou 'body' nos dados recebidos.")
             return jsonify({'error': 'Faltando sender ou body nos dados'}), 400
 
+        # Reentrega de um evento já recebido: responde sem carregar estado nem processar
+        dedup_key = message_key(result)
+        if webhook_dedup.check_and_add(dedup_key):
+            logging.info(f"Evento repetido de {sender} ({dedup_key}). Ignorando.")
+            return jsonify({'status': 'ignorado', 'reason': 'evento repetido'}), 200
+
         # Monta o objeto de mensagem
         message_data = {
             'body': user_message,
             'from': sender
         }
 
-        # Processa a mensagem no bot
-        bot = ultraChatBot(message_data)
-        response = bot.Processing_incoming_messages()
+        # Processa a mensagem no bot, na fila do chat
+        future = chat_executor.submit(format_number(sender), process_message, message_data)
+        try:
+            response = future.result(timeout=WEBHOOK_TIMEOUT)
+        except FuturesTimeoutError:
+            logging.warning(f"Processamento de {sender} passou de {WEBHOOK_TIMEOUT}s; continua em segundo plano.")
+            return jsonify({'status': 'em processamento'}), 202
+        except Exception:
+            # Falhou: a reentrega da UltraMsg deve ser processada
+            webhook_dedup.forget(dedup_key)
+            raise
+        if response is DEBOUNCED:
+            return jsonify({'status': 'agrupando'}), 202
         return jsonify({'status': 'sucesso', 'response': response}), 200
 
     except Exception as e:
         logging.error(f"Ocorreu um erro no webhook: {e}")
         return jsonify({'error': 'Erro interno do servidor'}), 500
 
+def process_message(message_data: dict):
+    """Roda na fila do chat: em estado de texto livre, segura a mensagem para juntar com as próximas."""
+    chat_id = format_number(message_data['from'])
+    if inbound_debouncer.enabled and (
+        inbound_debouncer.is_pending(chat_id) or state_store.get_state(chat_id) in FREE_TEXT_STATES
+    ):
+        inbound_debouncer.add(chat_id, message_data)
+        return DEBOUNCED
+    return run_bot_turn(message_data)
+
+def run_bot_turn(message_data: dict):
+    started = time.perf_counter()
+    bot = ultraChatBot(message_data)
+    info = bot.states.get(bot.chatID)
+    if info is None:
+        state = 'NEW'
+    elif info.get('agent_mode', False):
+        state = 'AGENT_MODE'
+    else:
+        state = info.get('state') or 'UNKNOWN'
+    try:
+        return bot.Processing_incoming_messages()
+    finally:
+        WEBHOOK_TURN_SECONDS.labels(state).observe(time.perf_counter() - started)
+
 if __name__ == '__main__':
-    app.run(debug=False, host='0.0.0.0', port=5000)
+    app.run(debug=False, host='0.0.0.0', port=5000, threaded=True)
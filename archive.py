@@ -0,0 +1,216 @@
+import os
+import json
+import gzip
+import time
+import logging
+import threading
+
+##############################################################################
+# ARQUIVO FRIO DAS CONVERSAS ENCERRADAS (JSON-lines + gzip, um segmento por dia)
+##############################################################################
+
+ARCHIVE_DIR = "archive"
+INDEX_FILE = "index.jsonl"
+SEGMENT_PREFIX = "conversations-"
+SEGMENT_SUFFIX = ".jsonl.gz"
+
+# Os registros têm CPF, endereço e telefone: segmentos com mais de ARCHIVE_RETENTION
+# segundos são apagados, numa verificação feita no máximo a cada PRUNE_INTERVAL
+ARCHIVE_RETENTION = 180 * 24 * 60 * 60
+PRUNE_INTERVAL = 24 * 60 * 60
+
+
+def segment_name(timestamp: float) -> str:
+    return f"{SEGMENT_PREFIX}{time.strftime('%Y-%m-%d', time.localtime(timestamp))}{SEGMENT_SUFFIX}"
+
+
+class ConversationArchive():
+    """
+    Conversas encerradas saem do banco de estados e vêm para cá, só com acréscimos.
+
+    Cada dia tem um segmento gzip; cada gravação acrescenta um membro gzip novo ao
+    segmento (gzip lê membros concatenados como um único arquivo). Um índice em
+    texto (chatID -> segmento da versão mais recente) fica em memória, então saber
+    se um chat já foi arquivado não toca o disco, e buscar o registro lê só um segmento.
+    Se o índice se perder, ele é refeito a partir dos segmentos.
+
+    Outros processos também gravam aqui: quando um chat não está no índice em
+    memória, as linhas acrescentadas ao index.jsonl desde a última leitura são lidas
+    antes de responder. Segmentos mais velhos que `retention` são apagados por `prune`.
+    """
+
+    def __init__(self, directory: str = ARCHIVE_DIR, retention: float = ARCHIVE_RETENTION):
+        self.directory = directory
+        self.retention = retention
+        self._lock = threading.Lock()
+        self._index = {}  # chatID -> segmento
+        self._index_file = None  # (inode, bytes já lidos) do index.jsonl
+        self._pruned_at = None
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    @property
+    def index_path(self) -> str:
+        return os.path.join(self.directory, INDEX_FILE)
+
+    def segments(self) -> list:
+        """Segmentos existentes, do mais antigo para o mais novo."""
+        return sorted(
+            name for name in os.listdir(self.directory)
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX)
+        )
+
+    def _load_index(self):
+        if not os.path.exists(self.index_path):
+            if self.segments():
+                self.rebuild_index()
+            return
+        with self._lock:
+            self._read_index()
+
+    def _read_index(self):
+        """Lê as linhas novas do index.jsonl (com o lock); relê tudo se o arquivo foi trocado."""
+        try:
+            f = open(self.index_path, 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            stat = os.fstat(f.fileno())
+            if self._index_file is None or self._index_file[0] != stat.st_ino or stat.st_size < self._index_file[1]:
+                # Índice refeito ou podado por outro processo
+                self._index, offset = {}, 0
+            else:
+                offset = self._index_file[1]
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # Linha ainda sendo gravada: fica para a próxima leitura
+                    break
+                offset += len(line)
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # Linha cortada por uma queda no meio da gravação
+                    continue
+                self._index[entry['chat_id']] = entry['segment']
+            self._index_file = (stat.st_ino, offset)
+
+    def _write_index(self, index: dict):
+        """Troca o index.jsonl por um com as entradas de `index` (com o lock)."""
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for chat_id, segment in index.items():
+                f.write(json.dumps({'chat_id': chat_id, 'segment': segment}) + "\n")
+        os.replace(tmp_path, self.index_path)
+        self._index = index
+        self._index_file = None
+        self._read_index()
+
+    def rebuild_index(self):
+        """Refaz o índice lendo todos os segmentos."""
+        index = {}
+        for segment in self.segments():
+            for record in self._read_segment(segment):
+                index[record['chat_id']] = segment
+        with self._lock:
+            self._write_index(index)
+        logging.info(f"Índice do arquivo refeito com {len(index)} conversas.")
+
+    def _read_segment(self, segment: str):
+        try:
+            with gzip.open(os.path.join(self.directory, segment), 'rt', encoding='utf-8') as f:
+                for line in f:
+                    yield json.loads(line)
+        except (OSError, EOFError, json.JSONDecodeError) as e:
+            # Segmento com o último membro incompleto: o que veio antes continua válido
+            logging.error(f"Erro ao ler o segmento {segment} do arquivo: {e}")
+
+    # ---------------------------- escrita ----------------------------
+
+    def append_many(self, states: dict, reason: str = ''):
+        """Arquiva várias conversas ({chatID: estado}) numa única gravação."""
+        if not states:
+            return
+        now = time.time()
+        segment = segment_name(now)
+        lines = "".join(
+            json.dumps({'chat_id': chat_id, 'archived_at': now, 'reason': reason, 'state': info},
+                       ensure_ascii=False) + "\n"
+            for chat_id, info in states.items()
+        )
+        index_lines = "".join(
+            json.dumps({'chat_id': chat_id, 'segment': segment}) + "\n" for chat_id in states
+        )
+        with self._lock:
+            with gzip.open(os.path.join(self.directory, segment), 'at', encoding='utf-8') as f:
+                f.write(lines)
+            # O índice só é gravado depois do segmento: no pior caso ele fica para trás
+            with open(self.index_path, 'a', encoding='utf-8') as f:
+                f.write(index_lines)
+            # Lê o que foi acrescentado (inclusive por outros processos) até aqui
+            self._read_index()
+
+    def prune(self, now: float = None) -> list:
+        """Apaga os segmentos mais velhos que `retention` e devolve os nomes apagados."""
+        now = now if now is not None else time.time()
+        # Os nomes têm a data do segmento, então comparar os textos compara as datas
+        oldest_kept = segment_name(now - self.retention)
+        with self._lock:
+            self._pruned_at = now
+            expired = [segment for segment in self.segments() if segment < oldest_kept]
+            if not expired:
+                return []
+            # O índice deixa de apontar para os segmentos antes de eles sumirem
+            self._read_index()
+            self._write_index({
+                chat_id: segment for chat_id, segment in self._index.items() if segment >= oldest_kept
+            })
+            for segment in expired:
+                try:
+                    os.remove(os.path.join(self.directory, segment))
+                except FileNotFoundError:
+                    pass
+        logging.info(f"Arquivo: {len(expired)} segmentos com mais de {self.retention / 86400:.0f} dias apagados.")
+        return expired
+
+    def prune_if_due(self, now: float = None) -> list:
+        """`prune` no máximo a cada PRUNE_INTERVAL segundos."""
+        now = now if now is not None else time.time()
+        if self._pruned_at is not None and now - self._pruned_at < PRUNE_INTERVAL:
+            return []
+        return self.prune(now)
+
+    def append(self, chat_id: str, info: dict, reason: str = ''):
+        self.append_many({chat_id: info}, reason)
+
+    # ---------------------------- leitura ----------------------------
+
+    def _segment_of(self, chat_id: str):
+        oldest_kept = segment_name(time.time() - self.retention)
+        segment = self._index.get(chat_id)
+        if segment is None or segment < oldest_kept:
+            # Pode ter sido arquivado de novo por outro processo depois da última leitura
+            with self._lock:
+                self._read_index()
+                segment = self._index.get(chat_id)
+        # Segmento vencido conta como apagado, mesmo que a poda ainda não tenha rodado
+        return segment if segment is not None and segment >= oldest_kept else None
+
+    def contains(self, chat_id: str) -> bool:
+        return self._segment_of(chat_id) is not None
+
+    def lookup(self, chat_id: str):
+        """Registro mais recente de um chat arquivado ({'chat_id', 'archived_at', 'reason', 'state'}), ou None."""
+        segment = self._segment_of(chat_id)
+        if segment is None or not os.path.exists(os.path.join(self.directory, segment)):
+            return None
+        latest = None
+        for record in self._read_segment(segment):
+            if record['chat_id'] == chat_id:
+                latest = record
+        return latest
+
+    def count(self) -> int:
+        with self._lock:
+            self._read_index()
+            return len(self._index)
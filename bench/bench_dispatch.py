@@ -0,0 +1,128 @@
+"""
+Benchmark do roteamento de mensagens por estado.
+
+Compara, por mensagem, só o custo de escolher o tratador:
+- antes: a cadeia if/elif do Processing_incoming_messages antigo, avaliada de cima
+  para baixo (estados do fim da cadeia pagam todas as comparações anteriores);
+- depois: STATE_DISPATCH, um dicionário estado -> função.
+
+Uso (na raiz do projeto):
+    python bench/bench_dispatch.py --n 200000
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# O ultrabot cria o banco de estados e o arquivo no diretório atual
+os.chdir(tempfile.mkdtemp(prefix='bench_dispatch_'))
+os.environ.setdefault('ULTRAMSG_BASE_URL', 'http://127.0.0.1:9')
+
+from ultrabot import STATE_DISPATCH, ultraChatBot
+
+
+def legacy_route(state: str) -> str:
+    # Mesma ordem de comparações da cadeia antiga (inclusive o startswith('ASKED_')
+    # acima dos estados de assistência técnica)
+    if state == 'SESSION_ENDED':
+        return 'handle_session_ended'
+    elif state == 'ASKED_OPTION':
+        return 'handle_option_choice'
+    elif state == 'ASKED_NO_RESULTS_ACTION':
+        return 'handle_no_results_action'
+    elif state == 'ASKED_MODEL_NAME':
+        return 'handle_model_search'
+    elif state == 'ASKED_MODEL_NUMBER':
+        return 'handle_model_number_choice'
+    elif state == 'CONFIRM_PURCHASE':
+        return 'handle_confirm_purchase'
+    elif state == 'ASKED_PAYMENT_METHOD':
+        return 'handle_payment_method'
+    elif state == 'ASKED_CREDIT_INSTALLMENTS':
+        return 'handle_credit_installments'
+    elif state == 'ASKED_USED_PHONE_MODEL':
+        return 'handle_used_phone_model'
+    elif state == 'ASKED_USED_PHONE_STORAGE':
+        return 'handle_used_phone_storage'
+    elif state == 'ASKED_USED_PHONE_BATTERY':
+        return 'handle_used_phone_battery'
+    elif state == 'ASKED_USED_PHONE_FACEID':
+        return 'handle_used_phone_faceid'
+    elif state == 'ASKED_USED_PHONE_DEFECTS':
+        return 'handle_used_phone_defects'
+    elif state == 'ASKED_COMPLEMENT_PAYMENT_METHOD':
+        return 'handle_complement_payment_method'
+    elif state == 'ASKED_USED_PHONE_MODEL_SELL':
+        return 'handle_used_phone_model_sell'
+    elif state == 'ASKED_USED_PHONE_STORAGE_SELL':
+        return 'handle_used_phone_storage_sell'
+    elif state == 'ASKED_USED_PHONE_BATTERY_SELL':
+        return 'handle_used_phone_battery_sell'
+    elif state == 'ASKED_USED_PHONE_FACEID_SELL':
+        return 'handle_used_phone_faceid_sell'
+    elif state == 'ASKED_USED_PHONE_DEFECTS_SELL':
+        return 'handle_used_phone_defects_sell'
+    elif state == 'ASKED_USED_PHONE_PHOTOS_SELL':
+        return 'handle_used_phone_photos_sell'
+    elif state.startswith('ASKED_'):
+        return 'collect_client_data'
+    elif state == 'ASKED_TECH_OPTION':
+        return 'handle_tech_option_choice'
+    elif state == 'ASKED_PHONE_MODEL':
+        return 'handle_phone_model'
+    elif state == 'ASKED_SERVICE_CONFIRMATION':
+        return 'handle_service_confirmation'
+    elif state == 'ASKED_PROBLEM_DESCRIPTION':
+        return 'handle_problem_description'
+    elif state == 'FINISHED':
+        return 'handle_finished'
+    elif state == 'WAITING_FOR_AGENT':
+        return 'handle_waiting'
+    elif state == 'VENDER_CEL':
+        return 'handle_waiting'
+    else:
+        return 'handle_restart'
+
+
+def table_route(state: str):
+    return STATE_DISPATCH.get(state, ultraChatBot.handle_restart)
+
+
+def measure(label: str, fn, states: list, n: int) -> float:
+    rounds = max(1, n // len(states))
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for state in states:
+            fn(state)
+    elapsed = time.perf_counter() - start
+    per_call = elapsed / (rounds * len(states)) * 1e9
+    print(f"{label:<8} {per_call:7.1f} ns por mensagem")
+    return per_call
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--n', type=int, default=200000, help='mensagens roteadas por cenário')
+    args = parser.parse_args()
+
+    states = sorted(STATE_DISPATCH)
+    misrouted = [s for s in states if legacy_route(s) != STATE_DISPATCH[s].__name__]
+    print(f"{len(states)} estados registrados; roteados errado pela cadeia antiga: {', '.join(misrouted) or 'nenhum'}")
+
+    before = measure('antes', legacy_route, states, args.n)
+    after = measure('depois', table_route, states, args.n)
+
+    tail = ['VENDER_CEL', 'WAITING_FOR_AGENT', 'FINISHED']
+    before_tail = measure('antes*', legacy_route, tail, args.n)
+    after_tail = measure('depois*', table_route, tail, args.n)
+    print("(* só estados do fim da cadeia antiga)")
+
+    print(f"ganho médio: {before / after:.2f}x | fim da cadeia: {before_tail / after_tail:.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""
+Benchmark da renderização de recibos.
+
+Compara, por recibo:
+- antes: HTML com o <style> embutido, interpretado pelo WeasyPrint do zero a cada
+  PDF (CSS e fontes resolvidos de novo toda vez), como fazia o generate_receipt antigo;
+- depois: ReceiptRenderer, com o template compilado e CSS/fontes reaproveitados.
+
+Uso (na raiz do projeto):
+    python bench/bench_receipt.py --n 50
+
+Resultado de referência (--n 200; WeasyPrint 70.0, Pango 1.44.7, Python 3.11.7, 1 vCPU):
+    antes    média   217.1 ms | mediana   217.2 ms
+    depois   média   198.2 ms | mediana   198.5 ms   (1.09x na mediana)
+A maior parte do tempo é o layout e a escrita do PDF, que são iguais nos dois
+cenários; o ganho vem só do CSS e das fontes reaproveitados. Em rodadas com
+--n 50 a mediana variou entre 1.06x e 1.23x.
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from weasyprint import HTML
+
+from receipt import ReceiptRenderer, TEMPLATE_DIR, RECEIPT_STYLESHEET
+
+CLIENT_DATA = {
+    'name': 'Maria da Silva',
+    'cpf': '000.000.000-00',
+    'phone': '11999999999',
+    'address': 'Rua Exemplo, 123',
+    'neighborhood': 'Centro',
+    'zip': '01000-000',
+    'email': 'maria@example.com',
+    'produto_escolhido': {'Produto': 'iPhone 13 128GB', 'Preço (R$)': 3550, 'Cor': 'Branco', 'Estado': 'Lacrado'},
+    'payment_method': 'CARTAO',
+    'installments': 10,
+    'valor_final': 3985.94,
+}
+
+
+def legacy_render(renderer: ReceiptRenderer, css_text: str, pdf_path: str):
+    # Mesmo HTML, mas com o CSS embutido, sem reaproveitar nada entre recibos
+    # e passando pelo disco, como o generate_receipt antigo
+    html = renderer.html(CLIENT_DATA).replace('</head>', f'<style>{css_text}</style></head>')
+    HTML(string=html).write_pdf(pdf_path)
+
+
+def measure(label: str, fn, n: int) -> list:
+    fn()  # aquecimento (imports, primeira resolução de fontes)
+    samples = []
+    for _ in range(n):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    print(f"{label:<8} média {statistics.mean(samples):7.1f} ms | "
+          f"mediana {statistics.median(samples):7.1f} ms | mín {min(samples):7.1f} ms")
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--n', type=int, default=30, help='recibos por cenário')
+    args = parser.parse_args()
+
+    renderer = ReceiptRenderer()
+    with open(os.path.join(TEMPLATE_DIR, RECEIPT_STYLESHEET), 'r', encoding='utf-8') as f:
+        css_text = f.read()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        pdf_path = os.path.join(tmp, 'recibo.pdf')
+        before = measure('antes', lambda: legacy_render(renderer, css_text, pdf_path), args.n)
+        after = measure('depois', lambda: renderer.render(CLIENT_DATA), args.n)
+
+    print(f"ganho na mediana: {statistics.median(before) / statistics.median(after):.2f}x")
+
+
+if __name__ == '__main__':
+    main()
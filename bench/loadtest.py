@@ -0,0 +1,305 @@
+"""
+Teste de carga de ponta a ponta do bot.
+
+Sobe um servidor local que simula a UltraMsg (messages/chat e messages/document,
+com latência e taxa de erro configuráveis), aponta o bot para ele via
+ULTRAMSG_BASE_URL e dispara milhares de clientes simulados contra o webhook,
+cada um seguindo um roteiro real:
+
+- compra: produto -> PIX -> dados do cliente -> recibo em PDF;
+- assistência técnica: troca de tela com orçamento;
+- venda de aparelho usado: perguntas do aparelho até esperar o atendente.
+
+Relata vazão, latência do webhook (p50/p95/p99, no geral e por roteiro),
+mensagens enviadas por turno e o crescimento do banco de estados. Tudo roda num
+diretório temporário (banco, arquivo e recibos), sem tocar nos dados do projeto.
+
+Uso (na raiz do projeto):
+    python bench/loadtest.py --customers 2000 --concurrency 64 --latency 80 --error-rate 0.01
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import atexit
+import logging
+import argparse
+import tempfile
+import threading
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+##############################################################################
+# ROTEIROS DOS CLIENTES
+##############################################################################
+
+BUY_SCRIPT = [
+    'oi', '1', 'iphone 13', '1', 'sim', '2',
+    'Maria da Silva', '000.000.000-00', '11999999999', 'Rua Exemplo, 123', 'Centro', '01000-000',
+    'maria@example.com',
+]
+TECH_SCRIPT = ['oi', '2', '1', 'iphone 11', 'sim']
+SELL_SCRIPT = ['oi', '5', 'iPhone 12', '128GB', '85%', 'sim', 'nenhum', 'fotos enviadas']
+
+SCRIPTS = {'compra': BUY_SCRIPT, 'assistencia': TECH_SCRIPT, 'venda': SELL_SCRIPT}
+
+# Proporção padrão de cada roteiro entre os clientes
+DEFAULT_MIX = 'compra=0.5,assistencia=0.3,venda=0.2'
+
+##############################################################################
+# SIMULADOR DA ULTRAMSG
+##############################################################################
+
+
+class UltraMsgStub():
+    """Servidor HTTP local que responde como a UltraMsg e conta o que recebeu."""
+
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, error_rate: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.lock = threading.Lock()
+        self.received = Counter()   # endpoint -> mensagens aceitas
+        self.errors = Counter()     # endpoint -> respostas de erro simuladas
+        self.bytes_in = 0
+        self.last_request = time.monotonic()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name='ultramsg-stub', daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive, como a API real
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                self.rfile.read(length)
+                endpoint = self.path.split('/', 2)[-1]
+                if endpoint not in ('messages/chat', 'messages/document'):
+                    self._reply(404, {'error': 'endpoint desconhecido'})
+                    return
+                delay = stub.latency + random.uniform(0, stub.jitter)
+                if delay:
+                    time.sleep(delay)
+                failed = random.random() < stub.error_rate
+                with stub.lock:
+                    stub.bytes_in += length
+                    stub.last_request = time.monotonic()
+                    (stub.errors if failed else stub.received)[endpoint] += 1
+                if failed:
+                    self._reply(503, {'error': 'erro simulado'})
+                else:
+                    self._reply(200, {'sent': 'true', 'message': 'ok'})
+
+            def _reply(self, status: int, body: dict):
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {'received': dict(self.received), 'errors': dict(self.errors), 'bytes_in': self.bytes_in}
+
+##############################################################################
+# CARGA
+##############################################################################
+
+
+def parse_mix(text: str) -> list:
+    mix = []
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name.strip() not in SCRIPTS:
+            raise SystemExit(f"Roteiro desconhecido: {name!r} (use {', '.join(SCRIPTS)})")
+        mix.append((name.strip(), float(weight)))
+    return mix
+
+
+def percentile(sorted_samples: list, fraction: float) -> float:
+    if not sorted_samples:
+        return 0.0
+    index = min(len(sorted_samples) - 1, max(0, round(fraction * len(sorted_samples)) - 1))
+    return sorted_samples[index]
+
+
+def latency_line(label: str, samples: list) -> str:
+    ordered = sorted(samples)
+    return (f"{label:<12} {len(ordered):7d} turnos | p50 {percentile(ordered, 0.50) * 1000:7.1f} ms | "
+            f"p95 {percentile(ordered, 0.95) * 1000:7.1f} ms | p99 {percentile(ordered, 0.99) * 1000:7.1f} ms | "
+            f"máx {(ordered[-1] if ordered else 0) * 1000:7.1f} ms")
+
+
+def directory_size(path: str) -> int:
+    total = 0
+    for base, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(os.path.join(base, name))
+    return total
+
+
+class LoadTest():
+    def __init__(self, app_module, args):
+        self.app = app_module
+        self.args = args
+        self.latencies = defaultdict(list)   # roteiro -> [segundos por turno]
+        self.status = Counter()
+        self.turns = 0
+        self.lock = threading.Lock()
+
+    def post(self, client, chat_number: str, body: str):
+        payload = {
+            'event_type': 'message_received',
+            'data': {'id': f"{chat_number}-{time.time_ns()}", 'from': f"{chat_number}@c.us", 'body': body},
+        }
+        started = time.perf_counter()
+        response = client.post('/', json=payload)
+        return time.perf_counter() - started, response
+
+    def run_customer(self, index: int, script_name: str):
+        client = self.app.app.test_client()
+        chat_number = f"5511{900000000 + index}"
+        window = self.app.inbound_debouncer.window
+        for body in SCRIPTS[script_name]:
+            elapsed, response = self.post(client, chat_number, body)
+            with self.lock:
+                self.latencies[script_name].append(elapsed)
+                self.status[response.status_code] += 1
+                self.turns += 1
+            if response.status_code == 202 and window:
+                # Mensagem segurada pelo agrupamento: espera a janela fechar antes da próxima
+                time.sleep(window * 1.2)
+            if self.args.think_time:
+                time.sleep(random.uniform(0, self.args.think_time))
+
+    def run(self, assignments: list) -> float:
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.args.concurrency) as pool:
+            futures = [pool.submit(self.run_customer, index, name) for index, name in enumerate(assignments)]
+            for future in futures:
+                future.result()
+        return time.perf_counter() - started
+
+
+def wait_for_drain(app_module, stub: UltraMsgStub, timeout: float) -> float:
+    """Espera as filas de saída e de recibos esvaziarem; devolve quanto esperou."""
+    started = time.perf_counter()
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        busy = (app_module.chat_executor.pending() or app_module.outbound_dispatcher.pending()
+                or app_module.receipt_service.pending())
+        if not busy and time.monotonic() - stub.last_request > 0.5:
+            break
+        time.sleep(0.1)
+    else:
+        print(f"aviso: filas ainda ocupadas depois de {timeout:.0f} s")
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--customers', type=int, default=1000, help='clientes simulados')
+    parser.add_argument('--concurrency', type=int, default=32, help='clientes conversando ao mesmo tempo')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help=f'proporção dos roteiros (padrão: {DEFAULT_MIX})')
+    parser.add_argument('--latency', type=float, default=50, help='latência da UltraMsg simulada (ms)')
+    parser.add_argument('--jitter', type=float, default=20, help='variação aleatória somada à latência (ms)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fração de envios respondidos com 503')
+    parser.add_argument('--think-time', type=float, default=0.0, help='pausa máxima do cliente entre mensagens (s)')
+    parser.add_argument('--debounce', type=float, default=0.0,
+                        help='janela de agrupamento de mensagens (s); 0 desliga, como no padrão deste teste')
+    parser.add_argument('--drain-timeout', type=float, default=300, help='espera máxima pelas filas no final (s)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--verbose', action='store_true', help='mostra os logs INFO do bot')
+    parser.add_argument('--keep', action='store_true', help='não apaga o diretório temporário')
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    stub = UltraMsgStub(args.latency / 1000, args.jitter / 1000, args.error_rate)
+    stub.start()
+
+    # O bot grava banco, arquivo e recibos no diretório atual
+    workdir = tempfile.mkdtemp(prefix='loadtest_')
+    shutil.copytree(os.path.join(ROOT, 'excel'), os.path.join(workdir, 'excel'),
+                    ignore=shutil.ignore_patterns('.cache', '.history'))
+    os.chdir(workdir)
+    os.environ['ULTRAMSG_BASE_URL'] = stub.base_url
+    if not args.keep:
+        # Registrado antes dos encerramentos do app, então roda depois deles
+        atexit.register(shutil.rmtree, workdir, True)
+
+    import app as app_module
+    from state_store import StateStore
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+    app_module.bot_active.set(True)
+    app_module.inbound_debouncer.window = args.debounce
+    store: StateStore = app_module.state_store
+    db_before = store.size_bytes()
+
+    names, weights = zip(*parse_mix(args.mix))
+    assignments = random.choices(names, weights=weights, k=args.customers)
+    print(f"{args.customers} clientes ({', '.join(f'{n}={assignments.count(n)}' for n in names)}), "
+          f"{args.concurrency} simultâneos, UltraMsg simulada com {args.latency:.0f}±{args.jitter:.0f} ms "
+          f"e {args.error_rate:.1%} de erro | diretório {workdir}")
+
+    test = LoadTest(app_module, args)
+    elapsed = test.run(assignments)
+    drained = wait_for_drain(app_module, stub, args.drain_timeout)
+
+    sent = stub.snapshot()
+    all_latencies = [value for samples in test.latencies.values() for value in samples]
+    texts = sent['received'].get('messages/chat', 0)
+    documents = sent['received'].get('messages/document', 0)
+    db_after = store.size_bytes()
+
+    print()
+    print(f"vazão          {test.turns / elapsed:8.1f} turnos/s ({test.turns} turnos em {elapsed:.1f} s; "
+          f"filas esvaziadas {drained:.1f} s depois)")
+    print(latency_line('todos', all_latencies))
+    for name in names:
+        print(latency_line(name, test.latencies[name]))
+    print(f"status HTTP    {dict(sorted(test.status.items()))}")
+    print(f"enviadas       {texts} textos + {documents} documentos = "
+          f"{(texts + documents) / max(test.turns, 1):.2f} mensagens por turno "
+          f"({sent['bytes_in'] / 1024 / 1024:.1f} MiB)")
+    print(f"entrega        {(texts + documents) / (elapsed + drained):8.1f} mensagens/s até a UltraMsg "
+          f"(webhook + esvaziamento das filas)")
+    print(f"erros UltraMsg {sent['errors'] or 'nenhum'} | contadores do bot {dict(app_module.outbound_stats)}")
+    print(f"banco          {db_before / 1024:.0f} KiB -> {db_after / 1024:.0f} KiB "
+          f"({(db_after - db_before) / max(args.customers, 1):.0f} bytes por cliente, "
+          f"{store.count()} conversas)")
+    print(f"recibos        {directory_size('PDF') / 1024:.0f} KiB em disco | arquivo frio "
+          f"{directory_size('archive') / 1024:.0f} KiB")
+
+    stub.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,560 @@
+import os
+import re
+import pickle
+import hashlib
+import logging
+import threading
+import time
+import unicodedata
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+import pandas as pd
+
+from metrics import CATALOG_LOAD_SECONDS
+
+##############################################################################
+# CATÁLOGO DE PRODUTOS (cache em memória da planilha)
+##############################################################################
+
+PRODUCTS_FILE = os.path.join('excel', 'Produtos_Lacrados.xlsx')
+
+# Colunas usadas pelo bot (o restante da planilha é ignorado)
+PRODUCT_COLUMNS = ['Produto', 'Preço (R$)', 'Cor', 'Detalhe']
+
+# Intervalo mínimo (segundos) entre duas verificações do mtime do arquivo
+MTIME_CHECK_INTERVAL = 2.0
+
+# Pasta (ao lado das planilhas) com as versões já interpretadas de cada .xlsx
+COMPILED_CACHE_DIR = '.cache'
+# Mudar quando o formato dos dados compilados (colunas, tipos) mudar
+COMPILED_FORMAT = 1
+
+
+def load_products_frame(path: str) -> pd.DataFrame:
+    """
+    Lê a planilha de produtos e devolve o DataFrame já normalizado:
+    cabeçalhos sem espaços, apenas as colunas usadas e a coluna 'Estado' calculada.
+    """
+    df = pd.read_excel(path)
+    df.columns = df.columns.str.strip()
+    df = df[PRODUCT_COLUMNS].copy()
+
+    # 'Lacrado' quando não há detalhe, senão 'Seminovo (<detalhe>)'
+    detalhe = df['Detalhe']
+    df['Estado'] = ('Seminovo (' + detalhe.astype(str) + ')').where(detalhe.notna(), 'Lacrado')
+    return df.reset_index(drop=True)
+
+
+##############################################################################
+# ÍNDICE DE BUSCA (tokens normalizados + trigramas)
+##############################################################################
+
+# Palavras da mensagem do cliente que não ajudam a identificar o produto
+SEARCH_STOPWORDS = {
+    'quero', 'queria', 'procuro', 'procurando', 'um', 'uma', 'o', 'a', 'de', 'do', 'da',
+    'celular', 'aparelho', 'novo', 'por', 'favor', 'tem', 'voces', 'vcs',
+}
+
+# Similaridade mínima (Jaccard de trigramas) para aceitar um token com erro de digitação
+FUZZY_MIN_SIMILARITY = 0.45
+
+
+def normalize_text(text) -> str:
+    """
+    Deixa o texto em minúsculas, sem acentos e com letras e números separados
+    ("iPhone13ProMax" -> "iphone 13promax", "128GB" -> "128 gb").
+    """
+    text = unicodedata.normalize('NFKD', str(text))
+    text = ''.join(ch for ch in text if not unicodedata.combining(ch)).lower()
+    text = re.sub(r'(?<=[a-z])(?=\d)|(?<=\d)(?=[a-z])', ' ', text)
+    return ' '.join(re.findall(r'[a-z0-9]+', text))
+
+
+def tokenize(text) -> list:
+    return normalize_text(text).split()
+
+
+def trigrams(token: str) -> set:
+    padded = f"  {token} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def edit_distance(a: str, b: str, max_distance: int) -> int:
+    """Distância de Levenshtein, abandonando o cálculo ao passar de `max_distance`."""
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, start=1):
+        current = [i]
+        for j, cb in enumerate(b, start=1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        if min(current) > max_distance:
+            return max_distance + 1
+        previous = current
+    return previous[-1]
+
+
+class SearchIndex():
+    """
+    Índice invertido sobre a coluna 'Produto', montado uma vez por versão do catálogo.
+
+    A busca trabalha sobre o vocabulário (poucas centenas de tokens), não sobre as
+    linhas, então o custo de uma consulta praticamente não depende do tamanho da planilha.
+    Cada token da consulta precisa casar com algum token do produto, exatamente,
+    por prefixo ou (para palavras com 4+ letras) por trigramas/distância de edição.
+    Números só casam exatamente, para "iPhone 13" nunca trazer o "iPhone 14".
+    """
+
+    def __init__(self, names):
+        self.postings = {}          # token -> set(posições das linhas)
+        self.trigram_tokens = {}    # trigrama -> set(tokens do vocabulário)
+        self.row_lengths = []       # quantidade de tokens por linha (desempate)
+
+        for position, name in enumerate(names):
+            tokens = tokenize(name) if isinstance(name, str) else []
+            self.row_lengths.append(len(tokens))
+            for token in tokens:
+                self.postings.setdefault(token, set()).add(position)
+
+        for token in self.postings:
+            for gram in trigrams(token):
+                self.trigram_tokens.setdefault(gram, set()).add(token)
+
+    def _match_token(self, query_token: str) -> dict:
+        """Retorna {token do vocabulário: pontuação} para um token da consulta."""
+        if query_token in self.postings:
+            return {query_token: 1.0}
+        if query_token.isdigit():
+            return {}
+
+        matches = {}
+        query_grams = trigrams(query_token)
+        candidates = set()
+        for gram in query_grams:
+            candidates |= self.trigram_tokens.get(gram, set())
+
+        for token in candidates:
+            if token.isdigit():
+                continue
+            if token.startswith(query_token):
+                matches[token] = 0.8
+            elif len(query_token) >= 4:
+                token_grams = trigrams(token)
+                similarity = len(query_grams & token_grams) / len(query_grams | token_grams)
+                # Erros curtos ("ifone", "xiomi") mudam muitos trigramas: usa a distância de edição
+                longest = max(len(token), len(query_token))
+                max_distance = 2 if longest >= 6 else 1
+                distance = edit_distance(query_token, token, max_distance)
+                if distance <= max_distance:
+                    similarity = max(similarity, 1 - distance / longest)
+                if similarity >= FUZZY_MIN_SIMILARITY:
+                    matches[token] = 0.7 * similarity
+        return matches
+
+    def search(self, query: str, limit: int = None) -> list:
+        """Retorna as posições das linhas que casam com a consulta, da melhor para a pior."""
+        query_tokens = [t for t in tokenize(query) if t not in SEARCH_STOPWORDS]
+        if not query_tokens:
+            return []
+
+        scores = None
+        for query_token in query_tokens:
+            token_scores = {}
+            for token, score in self._match_token(query_token).items():
+                for position in self.postings[token]:
+                    if score > token_scores.get(position, 0.0):
+                        token_scores[position] = score
+
+            if scores is None:
+                scores = token_scores
+            else:
+                scores = {p: scores[p] + s for p, s in token_scores.items() if p in scores}
+            if not scores:
+                return []
+
+        # Maior pontuação primeiro; em empate, o nome mais curto (mais específico)
+        ranked = sorted(scores, key=lambda p: (-scores[p], self.row_lengths[p], p))
+        return ranked[:limit] if limit else ranked
+
+
+class CatalogSnapshot():
+    """Versão imutável do catálogo. Quem pegou um snapshot continua lendo a mesma versão."""
+
+    def __init__(self, frame: pd.DataFrame, version: int, index: SearchIndex = None):
+        self.frame = frame
+        self.version = version
+        self.index = index if index is not None else SearchIndex(frame['Produto'].tolist())
+
+    def search(self, query: str, limit: int = None) -> pd.DataFrame:
+        """Linhas do catálogo que casam com `query`, ordenadas por relevância."""
+        return self.frame.iloc[self.index.search(query, limit)]
+
+
+##############################################################################
+# CACHE DE RESULTADOS DE BUSCA (por consulta normalizada e versão do catálogo)
+##############################################################################
+
+# Quantas consultas distintas guardar
+SEARCH_CACHE_SIZE = 256
+
+
+def search_key(query: str) -> str:
+    """Forma canônica da consulta: "Quero um iPhone13 PRO!" e "iphone 13 pro" viram a mesma chave."""
+    return ' '.join(t for t in tokenize(query) if t not in SEARCH_STOPWORDS)
+
+
+class SearchResultCache():
+    """
+    LRU de resultados prontos de busca, com chave (consulta normalizada, versão do catálogo).
+
+    Quando a versão muda (upload ou arquivo alterado), as entradas da versão anterior
+    são descartadas de uma vez, então nunca se devolve um resultado de outro catálogo.
+    `build()` roda fora do lock; duas threads com a mesma consulta nova podem montá-la
+    em paralelo, e a última a terminar fica no cache.
+    """
+
+    def __init__(self, maxsize: int = SEARCH_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._version = None
+
+    def get_or_build(self, query: str, version: int, build):
+        key = search_key(query)
+        with self._lock:
+            if version != self._version:
+                self._entries.clear()
+                self._version = version
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+
+        value = build()
+        with self._lock:
+            if version == self._version:
+                self._entries[key] = value
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+        return value
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries)}
+
+
+##############################################################################
+# PLANILHAS COMPILADAS (xlsx interpretado uma vez por conteúdo)
+##############################################################################
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def compiled_path(path: str, digest: str) -> str:
+    name = f"{os.path.basename(path)}.{digest[:20]}.v{COMPILED_FORMAT}.pkl"
+    return os.path.join(os.path.dirname(path), COMPILED_CACHE_DIR, name)
+
+
+def load_compiled(path: str, loader):
+    """
+    Devolve `loader(path)`, mas só interpreta o .xlsx quando o conteúdo muda.
+
+    O resultado (já com cabeçalhos limpos e colunas derivadas) é gravado em
+    excel/.cache/<arquivo>.<sha256>.v<formato>.pkl; enquanto o hash do .xlsx
+    for o mesmo, as próximas cargas leem só esse arquivo. Versões compiladas
+    de conteúdos anteriores do mesmo .xlsx são apagadas.
+    """
+    started = time.perf_counter()
+    digest = file_digest(path)
+    target = compiled_path(path, digest)
+    try:
+        with open(target, 'rb') as f:
+            data = pickle.load(f)
+        CATALOG_LOAD_SECONDS.labels('compiled').observe(time.perf_counter() - started)
+        return data
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        logging.warning(f"Versão compilada de {path} ilegível ({e}); interpretando a planilha de novo.")
+
+    started = time.perf_counter()
+    data = loader(path)
+    elapsed = time.perf_counter() - started
+    CATALOG_LOAD_SECONDS.labels('excel').observe(elapsed)
+    logging.info(f"Planilha {path} interpretada em {elapsed * 1000:.0f} ms.")
+    store_compiled(path, digest, data)
+    return data
+
+
+def store_compiled(path: str, digest: str, data):
+    """Grava `data` como a versão compilada de `path` com conteúdo `digest` (ver load_compiled)."""
+    target = compiled_path(path, digest)
+    cache_dir = os.path.dirname(target)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{target}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, target)
+        prefix = os.path.basename(path) + '.'
+        for name in os.listdir(cache_dir):
+            if name.startswith(prefix) and name.endswith('.pkl') and name != os.path.basename(target):
+                os.remove(os.path.join(cache_dir, name))
+    except OSError as e:
+        # Sem a versão compilada a planilha é interpretada de novo na próxima carga
+        logging.error(f"Erro ao gravar a versão compilada de {path}: {e}")
+
+
+class SpreadsheetCache(ABC):
+    """
+    Base para planilhas carregadas uma única vez por processo e mantidas em memória.
+
+    Cada recarga gera um novo snapshot com `version` maior que o anterior; a troca
+    é uma simples atribuição, então leitores nunca veem uma planilha pela metade.
+    Arquivos copiados manualmente para `excel/` são detectados pelo mtime.
+    Subclasses implementam `build(path, version)`, que monta o snapshot.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._mtime = None
+        self._last_check = 0.0
+
+    @property
+    def version(self) -> int:
+        return self.snapshot().version
+
+    @abstractmethod
+    def build(self, path: str, version: int):
+        """Lê a planilha em `path` e devolve o snapshot (com o atributo `version`)."""
+
+    def snapshot(self):
+        """Retorna o snapshot atual, recarregando se o arquivo mudou no disco."""
+        snapshot = self._snapshot
+        if snapshot is None or self._file_changed():
+            snapshot = self.reload()
+        return snapshot
+
+    def reload(self):
+        """Relê a planilha e publica um novo snapshot."""
+        with self._lock:
+            mtime = self._current_mtime()
+            # Outra thread pode ter recarregado enquanto esperávamos o lock
+            if self._snapshot is not None and mtime == self._mtime:
+                return self._snapshot
+
+            version = self._snapshot.version + 1 if self._snapshot else 1
+            self._snapshot = self.build(self.path, version)
+            self._mtime = mtime
+            logging.info(f"Planilha carregada: {self.path} (versão {version}).")
+            return self._snapshot
+
+    def _current_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _file_changed(self) -> bool:
+        now = time.monotonic()
+        if now - self._last_check < MTIME_CHECK_INTERVAL:
+            return False
+        self._last_check = now
+        return self._current_mtime() != self._mtime
+
+
+def compile_products(path: str) -> tuple:
+    """(frame normalizado, índice de busca) da planilha de produtos, prontos para serem compilados."""
+    frame = load_products_frame(path)
+    return frame, SearchIndex(frame['Produto'].tolist())
+
+
+class ProductCatalog(SpreadsheetCache):
+    """Catálogo de produtos (Produtos_Lacrados.xlsx) com índice de busca."""
+
+    def __init__(self, path: str = PRODUCTS_FILE):
+        super().__init__(path)
+
+    def build(self, path: str, version: int) -> CatalogSnapshot:
+        frame, index = load_compiled(path, compile_products)
+        return CatalogSnapshot(frame, version, index)
+
+    def frame(self) -> pd.DataFrame:
+        return self.snapshot().frame
+
+    def search(self, query: str, limit: int = None) -> pd.DataFrame:
+        return self.snapshot().search(query, limit)
+
+
+##############################################################################
+# TABELA DE PREÇOS DE REPARO (reparo_iphones.xlsx)
+##############################################################################
+
+REPAIR_FILE = os.path.join('excel', 'reparo_iphones.xlsx')
+
+# Serviços oferecidos pelo bot e os cabeçalhos aceitos na planilha para cada um
+REPAIR_SERVICES = {
+    'Tela': ('tela', 'modulo'),
+    'Bateria': ('bateria',),
+    'Tampa': ('tampa',),
+}
+
+# Quantos modelos no máximo listamos quando a consulta é ambígua
+MAX_REPAIR_CANDIDATES = 6
+
+# Variações comuns digitadas pelos clientes
+REPAIR_SYNONYMS = {
+    'promax': 'pro max',
+    'pm': 'pro max',
+    'ifone': 'iphone',
+    'iphon': 'iphone',
+    'ip': 'iphone',
+}
+
+
+def parse_price(value):
+    """Converte 350, 350.0, 'R$350,00' ou 'R$ 1.200,00' em float. Vazio vira None."""
+    if value is None or (isinstance(value, float) and pd.isna(value)):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    text = str(value).replace('R$', '').strip()
+    if not text:
+        return None
+    if ',' in text:
+        text = text.replace('.', '').replace(',', '.')
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+
+def repair_key(model) -> str:
+    """Chave canônica de um modelo: normalizada, com sinônimos e sem a palavra 'iphone'."""
+    text = ' '.join(REPAIR_SYNONYMS.get(t, t) for t in tokenize(model))
+    return ' '.join(t for t in text.split() if t != 'iphone')
+
+
+def load_repair_rows(path: str) -> list:
+    """
+    Lê a planilha de reparos e devolve [{'Modelo', 'Tela', 'Bateria', 'Tampa'}].
+    Aceita tanto o cabeçalho na primeira linha quanto uma linha de título acima dele
+    ("MODELO | TAMPA TRASEIRA | MODULO | BATERIA").
+    """
+    raw = pd.read_excel(path, header=None)
+
+    header_row = None
+    for i, row in raw.iterrows():
+        if any(normalize_text(cell) == 'modelo' for cell in row if isinstance(cell, str)):
+            header_row = i
+            break
+    if header_row is None:
+        raise ValueError("Cabeçalho 'Modelo' não encontrado na planilha de reparos.")
+
+    headers = [normalize_text(cell) if isinstance(cell, str) else '' for cell in raw.iloc[header_row]]
+    columns = {}
+    for position, header in enumerate(headers):
+        if header == 'modelo':
+            columns['Modelo'] = position
+        for service, names in REPAIR_SERVICES.items():
+            if service not in columns and any(name in header.split() for name in names):
+                columns[service] = position
+
+    rows = []
+    for _, row in raw.iloc[header_row + 1:].iterrows():
+        modelo = row[columns['Modelo']]
+        if not isinstance(modelo, str) or not modelo.strip():
+            continue
+        entry = {'Modelo': modelo.strip()}
+        for service in REPAIR_SERVICES:
+            entry[service] = parse_price(row[columns[service]]) if service in columns else None
+        rows.append(entry)
+    return rows
+
+
+def model_aliases(modelo: str) -> list:
+    """
+    Chaves pelas quais um modelo pode ser encontrado.
+    "iPhone 8/8PLus" -> ["8", "8 plus"]; "iPhone XS Max" -> ["xs max", "xsmax"].
+    """
+    parts = [p for p in modelo.split('/') if p.strip()]
+    first = repair_key(parts[0])
+    aliases = [first]
+    for part in parts[1:]:
+        key = repair_key(part)
+        # "8PLus" depois da barra herda o número do primeiro modelo quando ele já não o tem
+        if key and not key.split()[0] == first.split()[0]:
+            key = f"{first.split()[0]} {key}"
+        aliases.append(key)
+    aliases += [alias.replace(' ', '') for alias in aliases if ' ' in alias]
+    return [alias for alias in aliases if alias]
+
+
+class RepairPrices():
+    """Snapshot da tabela de reparos: chave canônica -> {'Modelo', 'Tela', 'Bateria', 'Tampa'}."""
+
+    def __init__(self, rows: list, version: int):
+        self.version = version
+        self.entries = rows
+        self.aliases = {}
+        for entry in rows:
+            for alias in model_aliases(entry['Modelo']):
+                self.aliases.setdefault(alias, entry)
+
+    def lookup(self, model_name: str):
+        """
+        Retorna (entrada, candidatos).
+        - Modelo identificado: (entrada, []).
+        - Consulta ambígua ("iPhone 1", "13 pro"...): (None, [modelos possíveis]).
+        - Nada parecido: (None, []).
+        """
+        key = repair_key(model_name)
+        if not key:
+            return None, []
+        entry = self.aliases.get(key) or self.aliases.get(key.replace(' ', ''))
+        if entry:
+            return entry, []
+
+        # Casa token a token; o último token digitado pode estar incompleto
+        query = key.split()
+        candidates = []
+        for alias, entry in self.aliases.items():
+            tokens = alias.split()
+            if len(tokens) < len(query):
+                continue
+            if tokens[:len(query) - 1] == query[:-1] and tokens[len(query) - 1].startswith(query[-1]):
+                if entry not in candidates:
+                    candidates.append(entry)
+
+        if len(candidates) == 1:
+            return candidates[0], []
+        return None, candidates[:MAX_REPAIR_CANDIDATES]
+
+
+class RepairTable(SpreadsheetCache):
+    """Tabela de preços de reparo carregada uma vez e recarregada quando o arquivo muda."""
+
+    def __init__(self, path: str = REPAIR_FILE):
+        super().__init__(path)
+
+    def build(self, path: str, version: int) -> RepairPrices:
+        return RepairPrices(load_compiled(path, load_repair_rows), version)
+
+    def lookup(self, model_name: str):
+        return self.snapshot().lookup(model_name)
+
+
+# Instâncias únicas usadas pelo bot e pela rota de upload
+product_catalog = ProductCatalog()
+repair_table = RepairTable()
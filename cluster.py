@@ -0,0 +1,162 @@
+import os
+import time
+import uuid
+import socket
+import logging
+import sqlite3
+import threading
+
+##############################################################################
+# COORDENAÇÃO ENTRE PROCESSOS (vários workers do gunicorn no mesmo banco)
+##############################################################################
+
+# Por quanto tempo (segundos) um processo reaproveita a configuração lida do banco
+SETTING_CACHE_TTL = 1.0
+
+# Validade da liderança; o líder renova a cada LEASE_RENEW segundos. Se ele morrer,
+# outro processo assume em até LEASE_TTL + LEASE_RENEW
+LEASE_TTL = 15
+LEASE_RENEW = 5
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS leases (
+    name TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+"""
+
+
+class CachedSetting():
+    """
+    Configuração guardada na tabela `settings` do StateStore, compartilhada por
+    todos os processos. Leituras usam um cache de `ttl` segundos, então uma mudança
+    feita em outro worker vale aqui em no máximo `ttl`.
+    """
+
+    def __init__(self, store, key: str, default=None, ttl: float = SETTING_CACHE_TTL):
+        self.store = store
+        self.key = key
+        self.default = default
+        self.ttl = ttl
+        self._value = default
+        self._read_at = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        now = time.monotonic()
+        with self._lock:
+            if self._read_at is not None and now - self._read_at < self.ttl:
+                return self._value
+        try:
+            value = self.store.get_setting(self.key, self.default)
+        except sqlite3.Error as e:
+            # Banco ocupado: segue com o último valor conhecido
+            logging.error(f"Erro ao ler a configuração {self.key}: {e}")
+            return self._value
+        self._remember(value)
+        return value
+
+    def set(self, value):
+        self.store.set_setting(self.key, value)
+        self._remember(value)
+
+    def toggle(self) -> bool:
+        value = self.store.toggle_setting(self.key, bool(self.default))
+        self._remember(value)
+        return value
+
+    def _remember(self, value):
+        with self._lock:
+            self._value = value
+            self._read_at = time.monotonic()
+
+
+class LeaderLease():
+    """
+    Eleição de líder por aluguel numa tabela SQLite: só o dono de um aluguel válido
+    é líder, e ele o renova periodicamente. Quando este processo vira líder chama
+    `on_acquire()`; quando perde a liderança (ou para), `on_release()`.
+    """
+
+    def __init__(self, path: str, name: str, on_acquire=None, on_release=None,
+                 ttl: float = LEASE_TTL, renew_every: float = LEASE_RENEW):
+        self.path = path
+        self.name = name
+        self.on_acquire = on_acquire
+        self.on_release = on_release
+        self.ttl = ttl
+        self.renew_every = renew_every
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.is_leader = False
+        self._valid_until = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        with self._conn:
+            self._conn.executescript(SCHEMA)
+
+    def try_acquire(self) -> bool:
+        """
+        Pega ou renova o aluguel se estiver livre, vencido ou já for nosso.
+        Devolve None se o banco não respondeu.
+        """
+        now = time.time()
+        try:
+            with self._conn:
+                # Uma única escrita condicional: dois processos não ganham o mesmo aluguel
+                cursor = self._conn.execute(
+                    "INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+                    "WHERE leases.owner = excluded.owner OR leases.expires_at < ?",
+                    (self.name, self.owner, now + self.ttl, now)
+                )
+            if cursor.rowcount > 0:
+                self._valid_until = now + self.ttl
+                return True
+            return False
+        except sqlite3.Error as e:
+            logging.error(f"Erro ao renovar a liderança de {self.name}: {e}")
+            return None
+
+    def release(self):
+        try:
+            with self._conn:
+                self._conn.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (self.name, self.owner))
+        except sqlite3.Error as e:
+            logging.error(f"Erro ao liberar a liderança de {self.name}: {e}")
+
+    def _set_leader(self, leader: bool):
+        if leader == self.is_leader:
+            return
+        self.is_leader = leader
+        callback = self.on_acquire if leader else self.on_release
+        logging.info(f"Processo {self.owner} {'assumiu' if leader else 'deixou'} a liderança de {self.name}.")
+        if callback is not None:
+            try:
+                callback()
+            except Exception as e:
+                logging.error(f"Erro ao {'assumir' if leader else 'deixar'} a liderança de {self.name}: {e}")
+
+    def _loop(self):
+        while not self._stop.is_set():
+            leader = self.try_acquire()
+            if leader is None:
+                # Falha passageira: continua líder enquanto o último aluguel valer
+                leader = self.is_leader and time.time() < self._valid_until
+            self._set_leader(leader)
+            self._stop.wait(self.renew_every)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop, name=f'lease-{self.name}', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Para de renovar e libera o aluguel na hora, para outro processo assumir logo."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        if self.is_leader:
+            self._set_leader(False)
+            self.release()
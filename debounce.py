@@ -0,0 +1,103 @@
+import time
+import logging
+import threading
+
+##############################################################################
+# AGRUPAMENTO DE MENSAGENS SEGUIDAS (debounce por conversa)
+##############################################################################
+
+# Janela (segundos) em que mensagens seguidas do mesmo chat são juntadas; 0 desliga
+DEBOUNCE_WINDOW = 1.5
+# Espera máxima desde a primeira mensagem do grupo, mesmo que o cliente continue digitando
+DEBOUNCE_MAX_DELAY = 5.0
+
+# Separador entre as mensagens juntadas ("iphone", "13", "pro max" -> "iphone 13 pro max")
+DEBOUNCE_SEPARATOR = " "
+
+
+def merge_messages(messages: list) -> dict:
+    """Junta várias mensagens do mesmo chat numa só, mantendo os demais campos da última."""
+    merged = dict(messages[-1])
+    merged['body'] = DEBOUNCE_SEPARATOR.join(m.get('body', '').strip() for m in messages)
+    return merged
+
+
+class InboundDebouncer():
+    """
+    Segura as mensagens de um chat por `window` segundos depois da última recebida
+    e entrega todas juntas para `on_flush(chat_id, mensagem)` numa única chamada.
+
+    Cada mensagem nova reinicia a janela, até `max_delay` desde a primeira.
+    Uma única thread cuida de todos os chats.
+    """
+
+    def __init__(self, on_flush, window: float = DEBOUNCE_WINDOW, max_delay: float = DEBOUNCE_MAX_DELAY):
+        self.on_flush = on_flush
+        self.window = window
+        self.max_delay = max_delay
+        self._cond = threading.Condition()
+        self._pending = {}  # chatID -> {'messages': [...], 'first': t, 'due': t}
+        self._thread = None
+        self._stopped = False
+
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0
+
+    def is_pending(self, chat_id: str) -> bool:
+        with self._cond:
+            return chat_id in self._pending
+
+    def add(self, chat_id: str, message_data: dict):
+        now = time.monotonic()
+        with self._cond:
+            entry = self._pending.get(chat_id)
+            if entry is None:
+                entry = self._pending[chat_id] = {'messages': [], 'first': now}
+            entry['messages'].append(message_data)
+            entry['due'] = min(now + self.window, entry['first'] + self.max_delay)
+            self._cond.notify()
+        self._ensure_started()
+
+    def _pop_due(self, now: float) -> list:
+        due = [chat_id for chat_id, entry in self._pending.items() if entry['due'] <= now]
+        return [(chat_id, self._pending.pop(chat_id)['messages']) for chat_id in due]
+
+    def _flush(self, batches: list):
+        for chat_id, messages in batches:
+            if len(messages) > 1:
+                logging.info(f"{len(messages)} mensagens seguidas de {chat_id} agrupadas.")
+            try:
+                self.on_flush(chat_id, merge_messages(messages))
+            except Exception as e:
+                logging.error(f"Erro ao entregar mensagens agrupadas de {chat_id}: {e}")
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                if self._stopped:
+                    return
+                now = time.monotonic()
+                batches = self._pop_due(now)
+                if not batches:
+                    next_due = min((entry['due'] for entry in self._pending.values()), default=None)
+                    self._cond.wait(None if next_due is None else next_due - now)
+                    continue
+            self._flush(batches)
+
+    def _ensure_started(self):
+        with self._cond:
+            if self._thread is None and not self._stopped:
+                self._thread = threading.Thread(target=self._loop, name='debounce', daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        """Para a thread e entrega na hora o que ainda estava na janela."""
+        with self._cond:
+            self._stopped = True
+            batches = list(self._pending.items())
+            self._pending.clear()
+            self._cond.notify()
+        self._flush(batches)
+        if self._thread is not None:
+            self._thread.join(timeout=5)
@@ -0,0 +1,158 @@
+import time
+import hashlib
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+
+##############################################################################
+# DEDUPLICAÇÃO DOS EVENTOS DO WEBHOOK (reentregas da UltraMsg)
+##############################################################################
+
+# Quantos eventos recentes lembrar, e por quanto tempo (segundos)
+DEDUP_MAX_ENTRIES = 20000
+DEDUP_TTL = 24 * 60 * 60
+
+# A cada quantas inserções as linhas vencidas são apagadas do banco
+PRUNE_EVERY = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS webhook_seen (
+    key TEXT PRIMARY KEY,
+    seen_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_webhook_seen_at ON webhook_seen(seen_at);
+"""
+
+
+def message_key(data: dict) -> str:
+    """Id da mensagem na UltraMsg, ou um hash de remetente + texto + horário quando não houver id."""
+    message_id = data.get('id')
+    if message_id:
+        return f"id:{message_id}"
+    raw = "\x1f".join(str(data.get(field, '')) for field in ('from', 'body', 'time'))
+    return "sha1:" + hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+class DedupCache():
+    """
+    Conjunto LRU com validade dos eventos já recebidos pelo webhook.
+
+    `check_and_add` é atômico: das entregas simultâneas de um mesmo evento, só a
+    primeira é processada. Com `path`, quem decide é a tabela SQLite (no mesmo banco
+    dos estados), compartilhada por todos os workers e por reinícios: uma reentrega
+    que cai em outro processo também é reconhecida. A memória (limitada a
+    `max_entries`) só guarda eventos já vistos, para responder as reentregas sem
+    tocar o banco.
+    """
+
+    def __init__(self, path: str = None, max_entries: int = DEDUP_MAX_ENTRIES, ttl: float = DEDUP_TTL):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._seen = OrderedDict()  # chave -> instante em que foi vista
+        self._local = threading.local()
+        self._inserts = 0
+        if path:
+            with self.conn:
+                self.conn.executescript(SCHEMA)
+            self._load()
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _load(self):
+        rows = self.conn.execute(
+            "SELECT key, seen_at FROM webhook_seen WHERE seen_at >= ? ORDER BY seen_at DESC LIMIT ?",
+            (time.time() - self.ttl, self.max_entries)
+        ).fetchall()
+        for key, seen_at in reversed(rows):
+            self._seen[key] = seen_at
+        logging.info(f"{len(rows)} eventos recentes do webhook carregados para deduplicação.")
+
+    def check_and_add(self, key: str) -> bool:
+        """True se o evento já foi visto (reentrega); senão registra e devolve False."""
+        now = time.time()
+        with self._lock:
+            seen_at = self._seen.get(key)
+            if seen_at is not None and now - seen_at < self.ttl:
+                self._seen.move_to_end(key)
+                self.hits += 1
+                return True
+            if not self.path:
+                self._remember(key, now)
+                self.misses += 1
+                return False
+
+        seen_at = self._claim(key, now)
+        with self._lock:
+            self._remember(key, seen_at if seen_at is not None else now)
+            if seen_at is not None:
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def _remember(self, key: str, seen_at: float):
+        """Guarda um evento visto na memória (com o lock)."""
+        self._seen[key] = seen_at
+        self._seen.move_to_end(key)
+        while len(self._seen) > self.max_entries:
+            self._seen.popitem(last=False)
+
+    def _claim(self, key: str, now: float):
+        """
+        Registra o evento na tabela se ninguém (deste ou de outro processo) o registrou
+        dentro da validade. Devolve None se o registro é nosso, ou o instante em que o
+        evento foi visto antes.
+        """
+        try:
+            with self.conn:
+                cursor = self.conn.execute(
+                    "INSERT OR IGNORE INTO webhook_seen (key, seen_at) VALUES (?, ?)", (key, now)
+                )
+                if cursor.rowcount:
+                    with self._lock:
+                        self._inserts += 1
+                        prune = self._inserts % PRUNE_EVERY == 0
+                    if prune:
+                        self.conn.execute("DELETE FROM webhook_seen WHERE seen_at < ?", (now - self.ttl,))
+                    return None
+                # Já existe (a transação de escrita já começou no INSERT, então nenhum
+                # outro processo mexe na linha até o fim desta)
+                seen_at = self.conn.execute(
+                    "SELECT seen_at FROM webhook_seen WHERE key = ?", (key,)
+                ).fetchone()[0]
+                if now - seen_at < self.ttl:
+                    return seen_at
+                # Linha vencida que a limpeza ainda não apagou: o evento conta como novo
+                self.conn.execute("UPDATE webhook_seen SET seen_at = ? WHERE key = ?", (now, key))
+                return None
+        except sqlite3.Error as e:
+            # Sem o banco o evento é deduplicado só pela memória deste processo
+            logging.error(f"Erro ao gravar evento do webhook para deduplicação: {e}")
+            return None
+
+    def forget(self, key: str):
+        """Esquece um evento cujo processamento falhou, para que a reentrega seja processada."""
+        with self._lock:
+            self._seen.pop(key, None)
+        if self.path:
+            try:
+                with self.conn:
+                    self.conn.execute("DELETE FROM webhook_seen WHERE key = ?", (key,))
+            except sqlite3.Error as e:
+                logging.error(f"Erro ao remover evento do webhook da deduplicação: {e}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._seen)}
@@ -0,0 +1,277 @@
+import json
+import logging
+import sqlite3
+import threading
+from collections import deque
+
+##############################################################################
+# EVENTOS EM TEMPO REAL PARA O PAINEL (Server-Sent Events)
+##############################################################################
+
+# Eventos guardados por painel conectado; quem fica para trás recebe 'resync'
+SUBSCRIBER_BUFFER = 256
+# Painéis conectados ao mesmo tempo (cada um ocupa uma thread do servidor)
+MAX_SUBSCRIBERS = 32
+
+# Intervalo (segundos) do comentário enviado em conexões ociosas; também é o
+# tempo máximo para perceber que um painel fechou
+HEARTBEAT_INTERVAL = 15
+# Espera (ms) do navegador antes de reconectar
+RETRY_MS = 3000
+
+# De quanto em quanto tempo (segundos) o banco é consultado atrás de mudanças feitas
+# por outros workers; escritas deste processo acordam a consulta na hora
+FEED_INTERVAL = 0.5
+# Linhas lidas por consulta ao acompanhar o banco
+FEED_BATCH = 500
+
+SESSION_ENDED_STATE = 'SESSION_ENDED'
+
+
+def format_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+RESYNC_MESSAGE = format_event('resync', {})
+
+
+class Subscriber():
+    """Fila limitada de um painel. Se encher, é descartada e o painel recebe 'resync'."""
+
+    def __init__(self, maxlen: int = SUBSCRIBER_BUFFER):
+        self.maxlen = maxlen
+        self._cond = threading.Condition()
+        self._buffer = deque()
+        self._overflowed = False
+        self.closed = False
+
+    def put(self, message: str) -> bool:
+        """Enfileira; devolve False se a fila transbordou."""
+        with self._cond:
+            if self.closed or self._overflowed:
+                return True
+            if len(self._buffer) >= self.maxlen:
+                # Os eventos perdidos não importam: o painel vai recarregar pelo cursor
+                self._buffer.clear()
+                self._overflowed = True
+                self._cond.notify()
+                return False
+            self._buffer.append(message)
+            self._cond.notify()
+            return True
+
+    def get(self, timeout: float):
+        """Próxima mensagem, ou None se nada chegou em `timeout` segundos (ou se foi fechado)."""
+        with self._cond:
+            self._cond.wait_for(lambda: self._buffer or self._overflowed or self.closed, timeout)
+            if self._overflowed:
+                self._overflowed = False
+                return RESYNC_MESSAGE
+            if self._buffer:
+                return self._buffer.popleft()
+            return None
+
+    def resync(self):
+        """Descarta o que está na fila e faz o painel recarregar pelo cursor."""
+        with self._cond:
+            if self.closed:
+                return
+            self._buffer.clear()
+            self._overflowed = True
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify()
+
+
+class EventBroker():
+    """
+    Distribui eventos para os painéis conectados em /events.
+
+    Cada evento é serializado uma vez e entregue a todos; quem publica nunca
+    espera por um painel lento. `conversation_changed` (chamado pelo ChangeFeed)
+    só publica quando algo visível no painel mudou (estado ou modo atendente),
+    não a cada mensagem trocada.
+    """
+
+    def __init__(self, buffer_size: int = SUBSCRIBER_BUFFER, max_subscribers: int = MAX_SUBSCRIBERS):
+        self.buffer_size = buffer_size
+        self.max_subscribers = max_subscribers
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._known = {}  # chatID -> (state, agent_mode) já publicados
+        self.published = 0
+        self.resyncs = 0
+
+    def seed(self, summaries: list):
+        """Estado inicial (chatID, state, agent_mode) para distinguir conversa nova de transição."""
+        with self._lock:
+            self._known = {chat_id: (state, agent_mode) for chat_id, state, agent_mode in summaries}
+
+    # --------------------------- assinaturas ----------------------------
+
+    def subscribe(self):
+        """Novo painel; None se o limite de conexões foi atingido."""
+        with self._lock:
+            if len(self._subscribers) >= self.max_subscribers:
+                return None
+            subscriber = Subscriber(self.buffer_size)
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+        subscriber.close()
+
+    def stream(self, subscriber: Subscriber):
+        """Gerador do corpo da resposta text/event-stream de um painel."""
+        try:
+            yield f"retry: {RETRY_MS}\n\n"
+            while not subscriber.closed:
+                message = subscriber.get(HEARTBEAT_INTERVAL)
+                yield message if message is not None else ": ping\n\n"
+        finally:
+            self.unsubscribe(subscriber)
+
+    def close(self):
+        """Encerra todas as conexões (no desligamento do servidor)."""
+        with self._lock:
+            subscribers = list(self._subscribers)
+            self._subscribers.clear()
+        for subscriber in subscribers:
+            subscriber.close()
+
+    # --------------------------- publicação -----------------------------
+
+    def publish(self, event: str, data: dict):
+        message = format_event(event, data)
+        with self._lock:
+            self._deliver(message)
+
+    def _deliver(self, message: str):
+        self.published += 1
+        for subscriber in self._subscribers:
+            if not subscriber.put(message):
+                self.resyncs += 1
+                logging.warning("Painel ficou para trás nos eventos; pedindo resync.")
+
+    def conversation_changed(self, chat_id: str, info):
+        """Mudança lida do banco (info None = conversa removida)."""
+        with self._lock:
+            previous = self._known.get(chat_id)
+            if info is None:
+                if previous is None:
+                    return
+                del self._known[chat_id]
+                data = {'chatID': chat_id, 'kind': 'removed'}
+            else:
+                current = (info.get('state', ''), bool(info.get('agent_mode', False)))
+                if current == previous:
+                    return
+                self._known[chat_id] = current
+                if previous is None:
+                    kind = 'created'
+                elif current[1] != previous[1]:
+                    kind = 'agent_mode'
+                elif current[0] == SESSION_ENDED_STATE:
+                    kind = 'session_ended'
+                else:
+                    kind = 'state'
+                data = {
+                    'chatID': chat_id, 'kind': kind, 'state': current[0], 'agentMode': current[1],
+                    'previousState': previous[0] if previous else None,
+                }
+            # Dentro do lock: os painéis recebem os eventos na mesma ordem das escritas
+            self._deliver(format_event('conversation', data))
+
+    def resync(self, summaries: list):
+        """Troca o estado conhecido e manda todos os painéis recarregarem (mudanças perdidas)."""
+        with self._lock:
+            self._known = {chat_id: (state, agent_mode) for chat_id, state, agent_mode in summaries}
+            self.resyncs += len(self._subscribers)
+            for subscriber in self._subscribers:
+                subscriber.resync()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'subscribers': len(self._subscribers), 'published': self.published, 'resyncs': self.resyncs}
+
+
+class ChangeFeed():
+    """
+    Alimenta o EventBroker a partir do banco, para que um painel ligado a qualquer
+    worker veja as mudanças feitas por todos.
+
+    Segue `store.changes_since(seq)` na ordem das escritas e compara o status do bot
+    (um CachedSetting compartilhado) com o último publicado. As escritas deste
+    processo só acordam a consulta (`wake` é ouvinte do StateStore), então também
+    chegam aos painéis na ordem do seq.
+    """
+
+    def __init__(self, broker: EventBroker, store, bot_active, interval: float = FEED_INTERVAL):
+        self.broker = broker
+        self.store = store
+        self.bot_active = bot_active
+        self.interval = interval
+        self._last_seq = 0
+        self._active = None
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def seed(self):
+        """Estado inicial, sem publicar nada."""
+        # Lido antes das linhas: o que for gravado durante a leitura vem no próximo poll
+        self._last_seq = self.store.current_seq()
+        self.broker.seed(self.store.summaries())
+        self._active = bool(self.bot_active.get())
+
+    def wake(self, *args):
+        """Pede uma consulta imediata (ouvinte do StateStore e do /status)."""
+        self._wake.set()
+
+    def poll(self):
+        """Publica as mudanças gravadas (por qualquer processo) desde a última consulta."""
+        while True:
+            rows = self.store.changes_since(self._last_seq, FEED_BATCH)
+            if rows is None:
+                # Remoções antigas demais para acompanhar: os painéis recarregam tudo
+                self._last_seq = self.store.current_seq()
+                self.broker.resync(self.store.summaries())
+                break
+            for chat_id, state, agent_mode, seq, removed in rows:
+                info = None if removed else {'state': state, 'agent_mode': agent_mode}
+                self.broker.conversation_changed(chat_id, info)
+                self._last_seq = seq
+            if len(rows) < FEED_BATCH:
+                break
+
+        active = bool(self.bot_active.get())
+        if active != self._active:
+            self._active = active
+            self.broker.publish('bot_status', {'active': active})
+
+    def _loop(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            if self._stop.is_set():
+                return
+            try:
+                self.poll()
+            except sqlite3.Error as e:
+                logging.error(f"Erro ao acompanhar o banco para os painéis: {e}")
+
+    def start(self):
+        self.seed()
+        self._thread = threading.Thread(target=self._loop, name='eventos', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
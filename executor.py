@@ -0,0 +1,74 @@
+import logging
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+
+##############################################################################
+# EXECUÇÃO SERIALIZADA POR CONVERSA
+##############################################################################
+
+
+class ChatExecutor():
+    """
+    Pool de threads que executa as tarefas de um mesmo chatID uma de cada vez,
+    na ordem de chegada, enquanto tarefas de chats diferentes rodam em paralelo.
+
+    Cada chat com trabalho pendente tem uma fila; só existe um "drenador" por fila
+    no pool, então duas tarefas do mesmo chat nunca rodam ao mesmo tempo.
+    """
+
+    def __init__(self, max_workers: int = 8, name: str = 'chat'):
+        self.name = name
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self._queues = {}  # chatID -> deque de (future, fn, args, kwargs)
+
+    def submit(self, chat_id: str, fn, *args, **kwargs) -> Future:
+        """Agenda `fn(*args, **kwargs)` na fila do chat e devolve um Future com o resultado."""
+        future = Future()
+        with self._lock:
+            queue = self._queues.get(chat_id)
+            start_drain = queue is None
+            if start_drain:
+                queue = self._queues[chat_id] = deque()
+            queue.append((future, fn, args, kwargs))
+        if start_drain:
+            try:
+                self._pool.submit(self._drain, chat_id)
+            except BaseException as e:
+                # Sem drenador (ex.: pool já desligado): a fila não pode ficar
+                # presa no dicionário, senão o chat nunca mais seria atendido
+                with self._lock:
+                    queue = self._queues.pop(chat_id)
+                for queued, _, _, _ in queue:
+                    queued.set_exception(e)
+        return future
+
+    def pending(self) -> int:
+        """Quantidade de tarefas aguardando (inclui as que estão rodando)."""
+        with self._lock:
+            return sum(len(queue) for queue in self._queues.values())
+
+    def _drain(self, chat_id: str):
+        while True:
+            with self._lock:
+                queue = self._queues[chat_id]
+                future, fn, args, kwargs = queue[0]
+
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args, **kwargs))
+                except BaseException as e:
+                    logging.error(f"Erro em tarefa do chat {chat_id} ({self.name}): {e}")
+                    future.set_exception(e)
+
+            # Só tira a tarefa da fila depois de terminar, para que um submit
+            # concorrente não inicie um segundo drenador para o mesmo chat
+            with self._lock:
+                queue.popleft()
+                if not queue:
+                    del self._queues[chat_id]
+                    return
+
+    def shutdown(self, wait: bool = True):
+        self._pool.shutdown(wait=wait)
@@ -0,0 +1,291 @@
+import time
+import heapq
+import logging
+import threading
+
+from metrics import INACTIVITY_ACTIONS, INACTIVITY_SWEEP_SECONDS
+
+##############################################################################
+# PRAZOS DE INATIVIDADE (aviso, pausa e arquivamento de conversas)
+##############################################################################
+
+# Limites de inatividade (segundos)
+WARNING_AFTER = 20 * 60
+PAUSE_AFTER = 30 * 60
+# Tempo em SESSION_ENDED até a conversa sair do banco para o arquivo frio (archive.py)
+ARCHIVE_AFTER = 2 * 60 * 60
+
+# Tempo máximo que uma rodada espera as filas dos chats envolvidos
+BATCH_TIMEOUT = 30
+# Atraso (segundos) para reavaliar um chat cuja verificação falhou
+RETRY_AFTER = 60
+# Com vários processos, de quanto em quanto tempo (segundos) o líder busca no banco
+# as conversas gravadas pelos outros
+POLL_INTERVAL = 2
+# Linhas lidas por consulta ao acompanhar o banco
+POLL_BATCH = 1000
+
+WARNING_MESSAGE = (
+    "Estamos verificando se você ainda está aí! Sua sessão será pausada em 30 minutos por inatividade. "
+    "Se precisar continuar, por favor, envie uma mensagem."
+)
+PAUSE_MESSAGE = (
+    "Sua sessão foi pausada por inatividade. "
+    "Se precisar de algo, por favor, envie uma nova mensagem para iniciaremos um novo atendimento."
+)
+
+
+def inactivity_action(state_info: dict, current_time: float):
+    """Decide o que fazer com uma conversa inativa: 'warn', 'pause', 'archive' ou None."""
+    last_interaction = state_info.get('last_interaction', current_time)
+    state = state_info.get('state', '')
+    pause_start_time = state_info.get('pause_start_time', None)
+
+    # Arquiva estados SESSION_ENDED há mais de ARCHIVE_AFTER
+    if state == 'SESSION_ENDED' and pause_start_time and current_time - pause_start_time > ARCHIVE_AFTER:
+        return 'archive'
+    # Se inativo por mais de 20 min, mas menos de 30 min, enviar aviso
+    if WARNING_AFTER <= current_time - last_interaction < PAUSE_AFTER and state != 'WARNING_SENT':
+        return 'warn'
+    # Se inativo por mais de 30 min e não está em SESSION_ENDED
+    if current_time - last_interaction >= PAUSE_AFTER and state != 'SESSION_ENDED':
+        return 'pause'
+    return None
+
+
+def inactivity_deadline(state: str, last_interaction, pause_start_time):
+    """Próximo instante em que `inactivity_action` pode mudar de None para uma ação, ou None."""
+    if state == 'SESSION_ENDED':
+        return pause_start_time + ARCHIVE_AFTER if pause_start_time else None
+    if last_interaction is None:
+        return None
+    if state == 'WARNING_SENT':
+        return last_interaction + PAUSE_AFTER
+    return last_interaction + WARNING_AFTER
+
+
+class InactivityScheduler():
+    """
+    Agenda de prazos por conversa num min-heap, em vez de varrer todas as conversas
+    a cada minuto.
+
+    O prazo de cada chat é recalculado sempre que o estado dele é gravado (ouvinte
+    do StateStore). Uma thread dorme até o próximo prazo, junta todos os que venceram
+    e decide cada um na fila do próprio chat (o cliente pode ter acabado de responder).
+    As alterações da rodada são gravadas numa única transação condicional, e só as
+    conversas efetivamente alteradas recebem mensagem.
+
+    Com `poll_interval`, também acompanha pelo `seq` do banco as escritas feitas por
+    outros processos (o ouvinte só enxerga as do próprio processo).
+    """
+
+    def __init__(self, store, executor, send_message, archive=None, poll_interval: float = None):
+        self.store = store
+        self.executor = executor
+        self.send_message = send_message
+        self.archive = archive
+        self.poll_interval = poll_interval
+        self._last_seq = 0
+        self._heap = []        # (prazo, chatID)
+        self._deadlines = {}   # chatID -> prazo vigente (entradas do heap com outro prazo são velhas)
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    # ---------------------------- prazos ----------------------------
+
+    def update(self, chat_id: str, info):
+        """Ouvinte do StateStore: recalcula o prazo de um chat (info None = chat removido)."""
+        if info is None:
+            deadline = None
+        else:
+            deadline = inactivity_deadline(
+                info.get('state', ''), info.get('last_interaction'), info.get('pause_start_time')
+            )
+        self._set_deadline(chat_id, deadline)
+
+    def _set_deadline(self, chat_id: str, deadline):
+        with self._cond:
+            if deadline is None:
+                self._deadlines.pop(chat_id, None)
+                return
+            if self._deadlines.get(chat_id) == deadline:
+                return
+            self._deadlines[chat_id] = deadline
+            heapq.heappush(self._heap, (deadline, chat_id))
+            self._compact()
+            if self._heap[0] == (deadline, chat_id):
+                self._cond.notify()
+
+    def _compact(self):
+        # Entradas velhas se acumulam a cada mensagem; refaz o heap quando passam do dobro
+        if len(self._heap) > 2 * len(self._deadlines) + 1024:
+            self._heap = [(d, c) for c, d in self._deadlines.items()]
+            heapq.heapify(self._heap)
+
+    def rebuild(self):
+        """Remonta todos os prazos a partir do banco (na inicialização)."""
+        # Lido antes das linhas: o que for gravado durante a leitura vem no próximo poll_changes
+        self._last_seq = self.store.current_seq()
+        deadlines = {}
+        for chat_id, state, last_interaction, pause_start_time in self.store.deadline_rows():
+            deadline = inactivity_deadline(state, last_interaction, pause_start_time)
+            if deadline is not None:
+                deadlines[chat_id] = deadline
+        with self._cond:
+            self._deadlines = deadlines
+            self._heap = [(d, c) for c, d in deadlines.items()]
+            heapq.heapify(self._heap)
+            self._cond.notify()
+        logging.info(f"Agenda de inatividade montada com {len(deadlines)} prazos.")
+
+    def poll_changes(self):
+        """Atualiza os prazos das conversas gravadas (por qualquer processo) desde a última leitura."""
+        while True:
+            rows = self.store.deadline_changes_since(self._last_seq, POLL_BATCH)
+            if rows is None:
+                # Remoções antigas demais para acompanhar: remonta tudo
+                self.rebuild()
+                return
+            for chat_id, state, last_interaction, pause_start_time, seq in rows:
+                deadline = None if state is None else inactivity_deadline(state, last_interaction, pause_start_time)
+                self._set_deadline(chat_id, deadline)
+                self._last_seq = seq
+            if len(rows) < POLL_BATCH:
+                return
+
+    def pop_due(self, now: float) -> list:
+        """Retira do heap os chats cujo prazo venceu."""
+        due = []
+        with self._cond:
+            while self._heap and self._heap[0][0] <= now:
+                deadline, chat_id = heapq.heappop(self._heap)
+                if self._deadlines.get(chat_id) == deadline:
+                    del self._deadlines[chat_id]
+                    due.append(chat_id)
+        return due
+
+    # ---------------------------- execução ----------------------------
+
+    def decide(self, chat_id: str, now: float):
+        """Roda na fila do chat: relê o estado e devolve (ação, novo estado, seq lido)."""
+        info, seq = self.store.get_with_seq(chat_id)
+        if info is None:
+            return None, None, None
+        action = inactivity_action(info, now)
+        if action == 'warn':
+            info['state'] = 'WARNING_SENT'
+        elif action == 'pause':
+            info['state'] = 'SESSION_ENDED'
+            info['pause_start_time'] = now
+        elif action is None:
+            # Prazo vencido mas nada a fazer (ex.: aviso atrasado já virou pausa em outra rodada)
+            self.update(chat_id, info)
+        return action, info, seq
+
+    def run_due(self, now: float = None):
+        """Executa as ações de todos os prazos vencidos e grava tudo numa transação."""
+        now = now if now is not None else time.time()
+        due = self.pop_due(now)
+        if not due:
+            return
+
+        started = time.perf_counter()
+        futures = {chat_id: self.executor.submit(chat_id, self.decide, chat_id, now) for chat_id in due}
+
+        updates, deletes, archived, actions = {}, {}, {}, {}
+        for chat_id, future in futures.items():
+            try:
+                action, info, seq = future.result(timeout=BATCH_TIMEOUT)
+            except Exception as e:
+                logging.error(f"Erro ao verificar inatividade de {chat_id}: {e}")
+                # Tenta de novo na próxima rodada, sem perder o prazo
+                self._set_deadline(chat_id, now + RETRY_AFTER)
+                continue
+            if action == 'archive':
+                deletes[chat_id] = seq
+                archived[chat_id] = info
+            elif action in ('warn', 'pause'):
+                updates[chat_id] = (info, seq)
+            if action:
+                actions[chat_id] = action
+
+        # O registro vai para o arquivo antes de sair do banco; se a remoção não for
+        # aplicada (o cliente voltou), sobra só uma cópia antiga no arquivo
+        if archived and self.archive is not None:
+            try:
+                self.archive.append_many(archived, reason='inactivity')
+            except Exception as e:
+                logging.error(f"Erro ao arquivar conversas encerradas: {e}")
+                for chat_id in archived:
+                    del deletes[chat_id]
+                    self._set_deadline(chat_id, now + RETRY_AFTER)
+            self._prune_archive(now)
+
+        # Grava só se ninguém alterou a conversa entre a decisão e a gravação
+        applied = self.store.apply_batch(updates, deletes)
+        for chat_id in applied:
+            if actions[chat_id] == 'warn':
+                self.send_message(chat_id, WARNING_MESSAGE)
+            elif actions[chat_id] == 'pause':
+                self.send_message(chat_id, PAUSE_MESSAGE)
+
+        elapsed = time.perf_counter() - started
+        INACTIVITY_SWEEP_SECONDS.observe(elapsed)
+        INACTIVITY_ACTIONS.labels('due').inc(len(due))
+        for chat_id in applied:
+            INACTIVITY_ACTIONS.labels(actions[chat_id]).inc()
+        logging.info(
+            f"Inatividade: {len(due)} prazos vencidos, {len(applied)} conversas alteradas "
+            f"em {elapsed * 1000:.1f} ms."
+        )
+
+    def _prune_archive(self, now: float = None):
+        """Apaga do arquivo os segmentos vencidos (no máximo uma vez por dia)."""
+        try:
+            self.archive.prune_if_due(now)
+        except Exception as e:
+            logging.error(f"Erro ao apagar segmentos antigos do arquivo: {e}")
+
+    def _loop(self):
+        next_poll = time.monotonic()
+        while True:
+            if self.poll_interval and time.monotonic() >= next_poll:
+                try:
+                    self.poll_changes()
+                except Exception as e:
+                    logging.error(f"Erro ao acompanhar o banco de estados: {e}")
+                next_poll = time.monotonic() + self.poll_interval
+            with self._cond:
+                if self._stopped:
+                    return
+                timeout = self._heap[0][0] - time.time() if self._heap else None
+                if timeout is None or timeout > 0:
+                    if self.poll_interval:
+                        until_poll = max(next_poll - time.monotonic(), 0)
+                        timeout = until_poll if timeout is None else min(timeout, until_poll)
+                    self._cond.wait(timeout)
+                    continue
+            try:
+                self.run_due()
+            except Exception as e:
+                logging.error(f"Erro ao verificar conversas inativas: {e}")
+                time.sleep(1)
+
+    def start(self):
+        """Monta a agenda e começa a disparar (pode ser chamado de novo depois de stop)."""
+        with self._cond:
+            self._stopped = False
+        self.rebuild()
+        if self.archive is not None:
+            self._prune_archive()
+        self._thread = threading.Thread(target=self._loop, name='inatividade', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
@@ -0,0 +1,203 @@
+import os
+import time
+import shutil
+import logging
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from catalog import PRODUCT_COLUMNS, compile_products, file_digest, store_compiled
+
+##############################################################################
+# ATUALIZAÇÃO DA PLANILHA DE PRODUTOS (validada, atômica e com histórico)
+##############################################################################
+
+# Versões anteriores da planilha guardadas para rollback
+INGEST_KEEP_VERSIONS = 5
+HISTORY_DIR = '.history'
+
+# Quantos produtos de cada tipo de mudança são listados no resumo
+DIFF_SAMPLE_SIZE = 20
+
+# Linhas com preço inválido listadas na mensagem de erro
+MAX_REPORTED_ERRORS = 10
+
+# Colunas que identificam um produto ao comparar duas versões
+PRODUCT_KEY = ['Produto', 'Cor', 'Estado']
+
+
+class CatalogValidationError(ValueError):
+    """Planilha enviada recusada; `errors` lista os problemas encontrados."""
+
+    def __init__(self, errors: list):
+        super().__init__("; ".join(errors))
+        self.errors = errors
+
+
+def validate_products(path: str) -> tuple:
+    """
+    Interpreta a planilha enviada e confere colunas obrigatórias e preços.
+    Devolve o mesmo (frame, índice) que compile_products, ou levanta CatalogValidationError.
+    """
+    try:
+        header = pd.read_excel(path, nrows=0).columns.str.strip()
+    except Exception as e:
+        raise CatalogValidationError([f"Arquivo não é uma planilha .xlsx válida ({e})."])
+
+    missing = [column for column in PRODUCT_COLUMNS if column not in header]
+    if missing:
+        raise CatalogValidationError([f"Coluna obrigatória ausente: {column}" for column in missing])
+
+    frame, index = compile_products(path)
+
+    errors = []
+    if frame.empty:
+        errors.append("A planilha não tem nenhum produto.")
+    prices = pd.to_numeric(frame['Preço (R$)'], errors='coerce')
+    # Linha 1 é o cabeçalho no Excel
+    for position in frame.index[prices.isna() | (prices < 0)][:MAX_REPORTED_ERRORS]:
+        errors.append(
+            f"Linha {position + 2}: preço inválido {frame.at[position, 'Preço (R$)']!r} "
+            f"({frame.at[position, 'Produto']})"
+        )
+    for position in frame.index[frame['Produto'].isna()][:MAX_REPORTED_ERRORS]:
+        errors.append(f"Linha {position + 2}: produto sem nome")
+    if errors:
+        raise CatalogValidationError(errors)
+    return frame, index
+
+
+def catalog_diff(old: pd.DataFrame, new: pd.DataFrame) -> dict:
+    """Produtos adicionados, removidos e com preço alterado (por Produto + Cor + Estado)."""
+    def prices_by_key(frame):
+        if frame is None or frame.empty:
+            return {}
+        keys = zip(*(frame[column].fillna('').astype(str) for column in PRODUCT_KEY))
+        prices = {}
+        for key, price in zip(keys, frame['Preço (R$)']):
+            prices.setdefault(key, price)
+        return prices
+
+    before, after = prices_by_key(old), prices_by_key(new)
+    added = [key for key in after if key not in before]
+    removed = [key for key in before if key not in after]
+    changed = [key for key in after if key in before and before[key] != after[key]]
+
+    def describe(key):
+        return dict(zip(PRODUCT_KEY, key))
+
+    return {
+        'added': len(added),
+        'removed': len(removed),
+        'price_changed': len(changed),
+        'added_sample': [describe(key) for key in added[:DIFF_SAMPLE_SIZE]],
+        'removed_sample': [describe(key) for key in removed[:DIFF_SAMPLE_SIZE]],
+        'price_changed_sample': [
+            dict(describe(key), old_price=float(before[key]), new_price=float(after[key]))
+            for key in changed[:DIFF_SAMPLE_SIZE]
+        ],
+    }
+
+
+class CatalogIngest():
+    """
+    Troca a planilha de produtos com segurança:
+
+    1. o arquivo enviado é salvo num temporário na mesma pasta;
+    2. numa thread própria (uma atualização por vez), é interpretado e validado;
+    3. a versão atual vai para excel/.history e o temporário a substitui com
+       os.replace, então nenhum leitor vê um arquivo pela metade;
+    4. a versão compilada já fica pronta, e o catálogo em memória é recarregado.
+
+    Uma planilha recusada nunca chega a substituir a atual.
+    """
+
+    def __init__(self, catalog, keep: int = INGEST_KEEP_VERSIONS):
+        self.catalog = catalog
+        self.keep = keep
+        self.directory = os.path.dirname(catalog.path) or '.'
+        self.history_dir = os.path.join(self.directory, HISTORY_DIR)
+        self._worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ingest')
+
+    def save_upload(self, file_storage) -> str:
+        """Grava o upload num temporário ao lado da planilha (mesmo disco, para o os.replace)."""
+        fd, tmp_path = tempfile.mkstemp(prefix='.upload-', suffix='.xlsx', dir=self.directory)
+        with os.fdopen(fd, 'wb') as f:
+            shutil.copyfileobj(file_storage.stream, f)
+        return tmp_path
+
+    def submit(self, tmp_path: str, consumed: str = None):
+        """Agenda a validação e a troca; devolve um Future com o resumo das mudanças."""
+        return self._worker.submit(self._ingest, tmp_path, consumed)
+
+    def _ingest(self, tmp_path: str, consumed: str = None) -> dict:
+        try:
+            started = time.perf_counter()
+            frame, index = validate_products(tmp_path)
+            try:
+                old = self.catalog.frame()
+            except Exception:
+                old = None
+            diff = catalog_diff(old, frame)
+
+            store_compiled(self.catalog.path, file_digest(tmp_path), (frame, index))
+            self._archive_current()
+            os.replace(tmp_path, self.catalog.path)
+            tmp_path = None
+            if consumed and os.path.exists(consumed):
+                os.remove(consumed)
+
+            self.catalog.reload()
+            logging.info(
+                f"Planilha atualizada em {(time.perf_counter() - started) * 1000:.0f} ms: "
+                f"+{diff['added']} -{diff['removed']} ~{diff['price_changed']} "
+                f"(catálogo versão {self.catalog.version})"
+            )
+            return diff
+        finally:
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    # ---------------------------- histórico ----------------------------
+
+    def versions(self) -> list:
+        """Versões guardadas, da mais nova para a mais antiga."""
+        if not os.path.isdir(self.history_dir):
+            return []
+        prefix = os.path.splitext(os.path.basename(self.catalog.path))[0] + '.'
+        return sorted((name for name in os.listdir(self.history_dir) if name.startswith(prefix)), reverse=True)
+
+    def _archive_current(self):
+        if not os.path.exists(self.catalog.path):
+            return
+        os.makedirs(self.history_dir, exist_ok=True)
+        base, ext = os.path.splitext(os.path.basename(self.catalog.path))
+        name = f"{base}.{time.strftime('%Y%m%d-%H%M%S')}-{time.time_ns() % 1_000_000_000:09d}{ext}"
+        shutil.copy2(self.catalog.path, os.path.join(self.history_dir, name))
+        for old in self.versions()[self.keep:]:
+            os.remove(os.path.join(self.history_dir, old))
+
+    def rollback(self, version: str = None):
+        """
+        Volta para uma versão guardada (a mais recente, se `version` não for dada).
+        Passa pela mesma validação e troca atômica. Devolve o Future de submit().
+        """
+        versions = self.versions()
+        if not versions:
+            raise FileNotFoundError("Nenhuma versão anterior da planilha guardada.")
+        if version is None:
+            version = versions[0]
+        elif version not in versions:
+            raise FileNotFoundError(f"Versão {version} não encontrada.")
+
+        fd, tmp_path = tempfile.mkstemp(prefix='.upload-', suffix='.xlsx', dir=self.directory)
+        os.close(fd)
+        source = os.path.join(self.history_dir, version)
+        shutil.copy(source, tmp_path)
+        # Se a troca der certo a versão restaurada sai do histórico e a substituída entra;
+        # sem `version`, um segundo rollback desfaz o primeiro
+        return self.submit(tmp_path, consumed=source)
+
+    def shutdown(self, wait: bool = True):
+        self._worker.shutdown(wait=wait)
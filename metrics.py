@@ -0,0 +1,311 @@
+import time
+import logging
+import threading
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from contextlib import contextmanager
+
+##############################################################################
+# MÉTRICAS NO FORMATO DO PROMETHEUS (/metrics)
+##############################################################################
+
+# Limites (segundos) dos buckets de latência
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# A cada quantas cópias novas as de threads já encerradas são descartadas
+PRUNE_EVERY = 64
+
+
+class PerThreadValues():
+    """
+    Lista de valores somados em que cada thread escreve só na própria cópia.
+
+    Quem observa não pega lock nem disputa com outras threads (só a primeira
+    observação de cada thread registra a cópia). A leitura soma as cópias. As de
+    threads que já terminaram são incorporadas a um total fixo e descartadas na
+    leitura e a cada PRUNE_EVERY cópias novas, para que threads de vida curta (uma
+    por requisição) não acumulem memória mesmo sem ninguém coletando as métricas.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards = []  # (thread, valores)
+        self._retired = [0] * size
+        self._registered = 0
+
+    def mine(self) -> list:
+        values = getattr(self._local, 'values', None)
+        if values is None:
+            values = self._local.values = [0] * self.size
+            with self._lock:
+                self._shards.append((threading.current_thread(), values))
+                self._registered += 1
+                if self._registered % PRUNE_EVERY == 0:
+                    self._prune()
+        return values
+
+    def _prune(self):
+        """Incorpora ao total fixo as cópias de threads encerradas (com o lock)."""
+        alive = []
+        for thread, values in self._shards:
+            if thread.is_alive():
+                alive.append((thread, values))
+            else:
+                self._retired = [a + b for a, b in zip(self._retired, values)]
+        self._shards = alive
+
+    def total(self) -> list:
+        with self._lock:
+            self._prune()
+            totals = list(self._retired)
+            for _, values in self._shards:
+                totals = [a + b for a, b in zip(totals, values)]
+        return totals
+
+
+class CounterChild():
+    def __init__(self):
+        self._values = PerThreadValues(1)
+
+    def inc(self, amount: float = 1):
+        self._values.mine()[0] += amount
+
+    def samples(self, name: str, labels: dict) -> list:
+        return [(name, labels, self._values.total()[0])]
+
+
+class HistogramChild():
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        # Um contador por bucket, mais o +Inf e a soma no final
+        self._values = PerThreadValues(len(buckets) + 2)
+
+    def observe(self, value: float):
+        values = self._values.mine()
+        values[bisect_left(self.buckets, value)] += 1
+        values[-1] += value
+
+    @contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    def samples(self, name: str, labels: dict) -> list:
+        totals = self._values.total()
+        samples, cumulative = [], 0
+        for bound, count in zip(self.buckets + (float('inf'),), totals):
+            cumulative += count
+            samples.append((name + '_bucket', dict(labels, le=format_value(bound)), cumulative))
+        samples.append((name + '_sum', labels, totals[-1]))
+        samples.append((name + '_count', labels, cumulative))
+        return samples
+
+
+class Metric(ABC):
+    """Família de séries com os mesmos nomes de rótulos, registrada para o /metrics."""
+
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        (registry if registry is not None else REGISTRY).register(self)
+
+    @abstractmethod
+    def samples(self) -> list:
+        """[(nome, rótulos, valor)] no momento da coleta."""
+
+
+class LabeledMetric(Metric):
+    """Métrica alimentada pelo código; `labels(...)` devolve a série daqueles rótulos."""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), registry=None):
+        self._children = {}
+        self._lock = threading.Lock()
+        super().__init__(name, documentation, labelnames, registry)
+        if not self.labelnames:
+            # Sem rótulos a série existe (zerada) desde o início
+            self.labels()
+
+    @abstractmethod
+    def _new_child(self):
+        """Série nova (CounterChild, HistogramChild...)."""
+
+    def labels(self, *values):
+        values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} espera os rótulos {self.labelnames}")
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def samples(self) -> list:
+        samples = []
+        for values, child in list(self._children.items()):
+            samples.extend(child.samples(self.name, dict(zip(self.labelnames, values))))
+        return samples
+
+
+class Counter(LabeledMetric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return CounterChild()
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+
+class Histogram(LabeledMetric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (),
+                 buckets: tuple = LATENCY_BUCKETS, registry=None):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+
+class Gauge(Metric):
+    """
+    Valor calculado na hora da coleta: `function()` devolve um número ou, com
+    rótulos, um dicionário {(valores dos rótulos): número}.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, function, labelnames: tuple = (), registry=None):
+        self.function = function
+        super().__init__(name, documentation, labelnames, registry)
+
+    def samples(self) -> list:
+        try:
+            value = self.function()
+        except Exception as e:
+            logging.error(f"Erro ao calcular a métrica {self.name}: {e}")
+            return []
+        if not isinstance(value, dict):
+            return [(self.name, {}, value)]
+        return [
+            (self.name, dict(zip(self.labelnames, key if isinstance(key, tuple) else (key,))), number)
+            for key, number in value.items()
+        ]
+
+
+class Registry():
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Métrica {metric.name} registrada duas vezes")
+            self._metrics[metric.name] = metric
+
+    def unregister(self, name: str):
+        with self._lock:
+            self._metrics.pop(name, None)
+
+    def render(self) -> str:
+        """Texto no formato de exposição do Prometheus (versão 0.0.4)."""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {escape_help(metric.documentation)}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def escape_help(text: str) -> str:
+    return text.replace('\\', '\\\\').replace('\n', '\\n')
+
+
+def escape_label(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels: dict) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{escape_label(value)}"' for key, value in labels.items()) + '}'
+
+
+def format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value)) if abs(value) < 1e15 else repr(value)
+    return repr(value)
+
+
+REGISTRY = Registry()
+
+##############################################################################
+# MÉTRICAS DO BOT
+##############################################################################
+
+WEBHOOK_TURN_SECONDS = Histogram(
+    'ultrabot_webhook_turn_seconds',
+    'Duração de um turno do bot (roteamento, gravação do estado e enfileiramento das respostas), '
+    'pelo estado da conversa ao receber a mensagem.',
+    ['state'],
+)
+WEBHOOK_REQUEST_SECONDS = Histogram(
+    'ultrabot_webhook_request_seconds',
+    'Duração da requisição do webhook, pelo status HTTP da resposta.',
+    ['code'],
+)
+ULTRAMSG_SEND_SECONDS = Histogram(
+    'ultrabot_ultramsg_send_seconds',
+    'Duração de um envio para a UltraMsg (com novas tentativas), por tipo (text, document) e status HTTP final.',
+    ['kind', 'status'],
+)
+CATALOG_LOAD_SECONDS = Histogram(
+    'ultrabot_catalog_load_seconds',
+    'Duração da carga de uma planilha, pela origem (compiled = cache em pickle, excel = interpretada).',
+    ['source'],
+)
+CATALOG_SEARCH_SECONDS = Histogram(
+    'ultrabot_catalog_search_seconds',
+    'Duração da busca de modelos para a lista de produtos, por acerto no cache de respostas.',
+    ['cache'],
+)
+STATE_SAVE_SECONDS = Histogram(
+    'ultrabot_state_save_seconds',
+    'Duração da gravação condicional do estado de uma conversa (uma transação no banco de estados).',
+)
+RECEIPT_RENDER_SECONDS = Histogram(
+    'ultrabot_receipt_render_seconds',
+    'Duração da renderização de um recibo em PDF no processo auxiliar.',
+)
+INACTIVITY_SWEEP_SECONDS = Histogram(
+    'ultrabot_inactivity_sweep_seconds',
+    'Duração de uma rodada do agendador de inatividade.',
+)
+INACTIVITY_ACTIONS = Counter(
+    'ultrabot_inactivity_actions_total',
+    'Conversas tratadas pelo agendador de inatividade, por ação (due, warn, pause, archive).',
+    ['action'],
+)
@@ -0,0 +1,268 @@
+import os
+import re
+import time
+import logging
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import CancelledError, TimeoutError as FuturesTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+from weasyprint import CSS, HTML
+from weasyprint.text.fonts import FontConfiguration
+
+from metrics import RECEIPT_RENDER_SECONDS
+
+##############################################################################
+# RECIBO EM PDF (renderizado fora do processo do webhook)
+##############################################################################
+
+# Cópia opcional dos recibos em disco; None desliga (o PDF vai direto da memória para a UltraMsg)
+RECEIPT_DIR = "PDF"
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+RECEIPT_TEMPLATE = 'recibo.html'
+RECEIPT_STYLESHEET = 'recibo.css'
+
+# Processos que renderizam recibos em paralelo
+RECEIPT_WORKERS = 2
+# Recibos aguardando/renderizando ao mesmo tempo; acima disso o pedido é recusado
+RECEIPT_MAX_PENDING = 1000
+# Tempo máximo (segundos) de renderização de um recibo (a espera na fila não conta)
+RECEIPT_TIMEOUT = 60
+# Tentativas de um recibo cujo processo morreu (ou foi encerrado por causa de outro recibo)
+RECEIPT_MAX_ATTEMPTS = 2
+
+
+def receipt_filename(client_data: dict, number_str: str) -> str:
+    """Nome do PDF: "NomeDoCliente_whatsnumero.pdf", sem caracteres que mudem de pasta."""
+    nome_cliente = client_data.get('name', 'Cliente')
+    nome_cliente = re.sub(r'[\\/:*?"<>|\x00-\x1f]', '', str(nome_cliente)).strip(' .') or 'Cliente'
+    return f"{nome_cliente}_{number_str}.pdf"
+
+
+def receipt_context(client_data: dict) -> dict:
+    """Variáveis do template recibo.html."""
+    return {
+        'data': time.strftime("%d/%m/%Y"),
+        'client': client_data,
+        'nome_cliente': client_data.get('name', 'Cliente'),
+        'product': client_data.get('produto_escolhido', {}),
+        'valor_final': client_data.get('valor_final', 0),
+        'payment_method': client_data.get('payment_method', ''),
+        'payment_complement': client_data.get('payment_complement', ''),
+        'valor_troca_usado': client_data.get('valor_troca_usado', 0),
+        'installments': client_data.get('installments', 1),
+    }
+
+
+class ReceiptRenderer():
+    """
+    Renderizador de recibos que vive o processo inteiro.
+
+    O template Jinja2 (com autoescape: nome, endereço etc. vêm do cliente) é compilado
+    uma vez, e o CSS e a configuração de fontes do WeasyPrint são reaproveitados
+    entre recibos, em vez de serem interpretados a cada PDF.
+    """
+
+    def __init__(self, template_dir: str = TEMPLATE_DIR):
+        self.env = Environment(
+            loader=FileSystemLoader(template_dir),
+            autoescape=select_autoescape(['html']),
+            trim_blocks=True,
+            lstrip_blocks=True,
+        )
+        self.template = self.env.get_template(RECEIPT_TEMPLATE)
+        self.font_config = FontConfiguration()
+        with open(os.path.join(template_dir, RECEIPT_STYLESHEET), 'r', encoding='utf-8') as f:
+            self.stylesheet = CSS(string=f.read(), font_config=self.font_config)
+
+    def html(self, client_data: dict) -> str:
+        return self.template.render(**receipt_context(client_data))
+
+    def render(self, client_data: dict) -> bytes:
+        """Renderiza o recibo e devolve o PDF em bytes, sem passar pelo disco."""
+        return HTML(string=self.html(client_data)).write_pdf(
+            stylesheets=[self.stylesheet], font_config=self.font_config
+        )
+
+
+# Um renderizador por processo, criado quando o worker sobe
+_renderer = None
+
+def get_renderer() -> ReceiptRenderer:
+    global _renderer
+    if _renderer is None:
+        _renderer = ReceiptRenderer()
+    return _renderer
+
+
+def render_receipt(client_data: dict, filename: str, save_dir: str = None) -> bytes:
+    """
+    Gera o PDF do recibo em memória. Roda num processo do pool (fora do GIL do servidor).
+    Com `save_dir`, grava também uma cópia em disco; uma falha nessa cópia não impede o envio.
+    """
+    pdf_bytes = get_renderer().render(client_data)
+    if save_dir:
+        try:
+            os.makedirs(save_dir, exist_ok=True)
+            with open(os.path.join(save_dir, filename), 'wb') as f:
+                f.write(pdf_bytes)
+        except OSError as e:
+            logging.error(f"Erro ao salvar cópia do recibo {filename}: {e}")
+    return pdf_bytes
+
+
+def timed_render_receipt(client_data: dict, filename: str, save_dir: str = None) -> tuple:
+    """render_receipt medido no próprio processo do pool: (pdf, segundos)."""
+    started = time.perf_counter()
+    pdf_bytes = render_receipt(client_data, filename, save_dir)
+    return pdf_bytes, time.perf_counter() - started
+
+
+class ReceiptService():
+    """
+    Fila de renderização de recibos num pool de processos.
+
+    `submit` retorna na hora; quando o PDF fica pronto, `on_done(pdf_bytes)` é chamado
+    numa thread auxiliar. Se a renderização falhar ou passar de `timeout`, quem é
+    chamado é `on_error(erro)`.
+
+    Só `workers` recibos vão para o pool de cada vez; os demais esperam numa fila
+    própria (até `max_pending`), então o prazo mede só a renderização. Um recibo
+    que passa do prazo trava o seu processo (cancel() não interrompe uma
+    renderização em andamento): o pool é encerrado e recriado, e o lugar só é
+    liberado depois disso. Recibos que estavam no pool encerrado voltam para a fila.
+    """
+
+    def __init__(self, workers: int = RECEIPT_WORKERS, max_pending: int = RECEIPT_MAX_PENDING,
+                 timeout: float = RECEIPT_TIMEOUT, save_dir: str = RECEIPT_DIR):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.save_dir = save_dir
+        self._cond = threading.Condition()
+        self._queue = deque()  # recibos esperando um processo livre
+        self._running = 0
+        self._closed = False
+        self._pool = None
+        # Uma thread por recibo em renderização: espera o resultado e dispara os callbacks
+        self._waiters = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='recibo')
+
+    def pool(self) -> ProcessPoolExecutor:
+        with self._cond:
+            if self._pool is None:
+                # 'spawn': o servidor tem várias threads, e fork copiaria locks em uso
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+                    initializer=get_renderer,
+                )
+            return self._pool
+
+    def warm(self):
+        """Sobe os processos do pool já na inicialização, sem esperar por eles."""
+        pool = self.pool()
+        for _ in range(self.workers):
+            pool.submit(os.getpid)
+
+    def pending(self) -> int:
+        with self._cond:
+            return len(self._queue) + self._running
+
+    def submit(self, client_data: dict, filename: str, on_done, on_error) -> bool:
+        job = {
+            'client_data': client_data, 'filename': filename,
+            'on_done': on_done, 'on_error': on_error, 'attempts': 0,
+        }
+        with self._cond:
+            if len(self._queue) + self._running >= self.max_pending:
+                logging.warning(f"Fila de recibos cheia ({self.max_pending}); recibo {filename} recusado.")
+                return False
+            self._queue.append(job)
+        self._dispatch()
+        return True
+
+    def _dispatch(self):
+        """Manda recibos da fila para o pool enquanto houver processo livre."""
+        while True:
+            with self._cond:
+                if self._closed or self._running >= self.workers or not self._queue:
+                    return
+                job = self._queue.popleft()
+                self._running += 1
+            try:
+                pool = self.pool()
+                future = pool.submit(timed_render_receipt, job['client_data'], job['filename'], self.save_dir)
+            except Exception as e:
+                logging.error(f"Erro ao enfileirar recibo {job['filename']}: {e}")
+                self._release()
+                job['on_error'](e)
+                continue
+            job['attempts'] += 1
+            self._waiters.submit(self._wait, job, pool, future)
+
+    def _wait(self, job: dict, pool: ProcessPoolExecutor, future):
+        filename = job['filename']
+        try:
+            pdf_bytes, elapsed = future.result(timeout=self.timeout)
+        except FuturesTimeoutError as e:
+            logging.error(f"Recibo {filename} passou de {self.timeout}s; reiniciando os processos de recibo.")
+            self._recycle_pool(pool)
+            self._fail(job, e)
+            return
+        except (BrokenProcessPool, CancelledError) as e:
+            # Um processo morreu (ou o pool foi encerrado por outro recibo): tenta de novo num pool novo
+            self._recycle_pool(pool)
+            if job['attempts'] < RECEIPT_MAX_ATTEMPTS:
+                logging.warning(f"Processo do recibo {filename} encerrado; tentando de novo.")
+                with self._cond:
+                    self._queue.appendleft(job)
+                self._release()
+                return
+            self._fail(job, e)
+            return
+        except Exception as e:
+            self._fail(job, e)
+            return
+
+        # As métricas do processo do pool não chegam ao /metrics; a medida volta com o resultado
+        RECEIPT_RENDER_SECONDS.observe(elapsed)
+        self._release()
+        job['on_done'](pdf_bytes)
+
+    def _fail(self, job: dict, error: Exception):
+        logging.error(f"Erro ao gerar o recibo {job['filename']}: {error!r}")
+        self._release()
+        job['on_error'](error)
+
+    def _release(self):
+        """Libera o lugar de um recibo que saiu do pool e manda o próximo."""
+        with self._cond:
+            self._running -= 1
+            self._cond.notify_all()
+        self._dispatch()
+
+    def _recycle_pool(self, pool: ProcessPoolExecutor):
+        """Encerra os processos de `pool` (inclusive um travado); o próximo recibo cria outro pool."""
+        with self._cond:
+            if self._pool is pool:
+                self._pool = None
+        terminate = getattr(pool, 'terminate_workers', None)
+        if terminate is not None:
+            terminate()
+        else:
+            for process in list((getattr(pool, '_processes', None) or {}).values()):
+                process.terminate()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def shutdown(self, wait: bool = True):
+        """Com `wait`, entrega os recibos que já estavam na fila antes de encerrar."""
+        with self._cond:
+            if wait:
+                self._cond.wait_for(lambda: not self._queue and not self._running)
+            self._closed = True
+        self._waiters.shutdown(wait=wait)
+        if self._pool is not None:
+            self._pool.shutdown(wait=wait)
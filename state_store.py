@@ -0,0 +1,405 @@
+import os
+import json
+import logging
+import sqlite3
+import threading
+import time
+from contextlib import closing
+
+##############################################################################
+# ARMAZENAMENTO DOS ESTADOS DAS CONVERSAS (SQLite em modo WAL)
+##############################################################################
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    chat_id TEXT PRIMARY KEY,
+    state TEXT NOT NULL DEFAULT '',
+    agent_mode INTEGER NOT NULL DEFAULT 0,
+    last_interaction REAL,
+    pause_start_time REAL,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_conversations_state ON conversations(state);
+CREATE INDEX IF NOT EXISTS idx_conversations_last_interaction ON conversations(last_interaction);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('seq', 0);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('tombstone_floor', 0);
+CREATE TABLE IF NOT EXISTS tombstones (
+    chat_id TEXT PRIMARY KEY,
+    seq INTEGER NOT NULL,
+    deleted_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_tombstones_seq ON tombstones(seq);
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+# Índices sobre colunas de ADDED_COLUMNS: criados depois que a coluna existe
+ADDED_INDEXES = """
+CREATE INDEX IF NOT EXISTS idx_conversations_seq ON conversations(seq);
+"""
+
+# Por quanto tempo (segundos) uma conversa removida continua aparecendo em changes_since
+TOMBSTONE_TTL = 24 * 60 * 60
+
+# Colunas adicionadas depois da primeira versão do banco: nome -> definição
+ADDED_COLUMNS = {
+    'seq': "INTEGER NOT NULL DEFAULT 0",
+}
+
+UPSERT_SQL = """
+INSERT INTO conversations (chat_id, state, agent_mode, last_interaction, pause_start_time, data, seq)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT(chat_id) DO UPDATE SET
+    state = excluded.state,
+    agent_mode = excluded.agent_mode,
+    last_interaction = excluded.last_interaction,
+    pause_start_time = excluded.pause_start_time,
+    data = excluded.data,
+    seq = excluded.seq
+"""
+
+GUARDED_UPDATE_SQL = """
+UPDATE conversations SET
+    state = ?, agent_mode = ?, last_interaction = ?, pause_start_time = ?, data = ?, seq = ?
+WHERE chat_id = ? AND seq = ?
+"""
+
+# Grava só se a conversa ainda não existir (gravação condicional de uma conversa nova)
+INSERT_NEW_SQL = """
+INSERT INTO conversations (chat_id, state, agent_mode, last_interaction, pause_start_time, data, seq)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT(chat_id) DO NOTHING
+"""
+
+
+def state_row(chat_id: str, info: dict, seq: int = 0) -> tuple:
+    """Monta a linha da tabela: colunas usadas em consultas + o dicionário completo em JSON."""
+    return (
+        chat_id,
+        info.get('state', '') or '',
+        1 if info.get('agent_mode') else 0,
+        info.get('last_interaction'),
+        info.get('pause_start_time'),
+        json.dumps(info, ensure_ascii=False),
+        seq,
+    )
+
+
+class StateStore():
+    """
+    Estados das conversas, uma linha por chatID.
+
+    Cada escrita toca só a conversa alterada (upsert por chave primária), e o WAL
+    permite leituras concorrentes enquanto outra thread grava. Uma queda no meio
+    de uma gravação perde no máximo a transação em andamento, nunca o arquivo todo.
+    Cada thread usa a sua própria conexão.
+
+    Toda escrita recebe um número de sequência global crescente (`seq`), usado para
+    gravações condicionais ("só se ninguém mexeu desde a leitura") e para listar o
+    que mudou desde um cursor. Remoções deixam uma "lápide" com o seu seq por
+    TOMBSTONE_TTL. Ouvintes registrados com `add_listener` são avisados depois de
+    cada escrita confirmada.
+    """
+
+    def __init__(self, path: str, legacy_json: str = None):
+        self.path = path
+        self._local = threading.local()
+        self._listeners = []
+        # Conexão só da inicialização: fechada ao final (as threads abrem as suas)
+        with closing(self._connect()) as conn, conn:
+            conn.executescript(SCHEMA)
+            self._add_missing_columns(conn)
+            conn.executescript(ADDED_INDEXES)
+        if legacy_json:
+            self.migrate_from_json(legacy_json)
+
+    def _add_missing_columns(self, conn: sqlite3.Connection):
+        existing = {row[1] for row in conn.execute("PRAGMA table_info(conversations)")}
+        for column, definition in ADDED_COLUMNS.items():
+            if column not in existing:
+                conn.execute(f"ALTER TABLE conversations ADD COLUMN {column} {definition}")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    # ---------------------------- leitura ----------------------------
+
+    def get(self, chat_id: str):
+        """Estado de uma conversa, ou None se ela não existir."""
+        row = self.conn.execute(
+            "SELECT data FROM conversations WHERE chat_id = ?", (chat_id,)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_state(self, chat_id: str):
+        """Só a coluna `state` de uma conversa (sem desserializar o JSON), ou None."""
+        row = self.conn.execute(
+            "SELECT state FROM conversations WHERE chat_id = ?", (chat_id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def all(self) -> dict:
+        """Todas as conversas como {chatID: estado}."""
+        rows = self.conn.execute("SELECT chat_id, data FROM conversations").fetchall()
+        return {chat_id: json.loads(data) for chat_id, data in rows}
+
+    def get_with_seq(self, chat_id: str):
+        """(estado, seq) de uma conversa, ou (None, None) se ela não existir."""
+        row = self.conn.execute(
+            "SELECT data, seq FROM conversations WHERE chat_id = ?", (chat_id,)
+        ).fetchone()
+        return (json.loads(row[0]), row[1]) if row else (None, None)
+
+    def deadline_rows(self) -> list:
+        """[(chatID, state, last_interaction, pause_start_time)] para montar os prazos de inatividade."""
+        return self.conn.execute(
+            "SELECT chat_id, state, last_interaction, pause_start_time FROM conversations"
+        ).fetchall()
+
+    def summaries(self) -> list:
+        """[(chatID, state, agent_mode)] sem desserializar o JSON de cada conversa."""
+        rows = self.conn.execute(
+            "SELECT chat_id, state, agent_mode FROM conversations"
+        ).fetchall()
+        return [(chat_id, state, bool(agent_mode)) for chat_id, state, agent_mode in rows]
+
+    def current_seq(self) -> int:
+        """Último número de sequência usado (muda a cada escrita ou remoção)."""
+        return self.conn.execute("SELECT value FROM meta WHERE key = 'seq'").fetchone()[0]
+
+    def summaries_page(self, state: str = None, agent_mode: bool = None,
+                       after: str = None, limit: int = 100) -> list:
+        """[(chatID, state, agent_mode)] em ordem de chatID, a partir de `after` (exclusivo), com filtros."""
+        where, params = [], []
+        if state is not None:
+            where.append("state = ?")
+            params.append(state)
+        if agent_mode is not None:
+            where.append("agent_mode = ?")
+            params.append(1 if agent_mode else 0)
+        if after is not None:
+            where.append("chat_id > ?")
+            params.append(after)
+        sql = "SELECT chat_id, state, agent_mode FROM conversations"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        rows = self.conn.execute(sql + " ORDER BY chat_id LIMIT ?", params + [limit]).fetchall()
+        return [(chat_id, state, bool(agent_mode)) for chat_id, state, agent_mode in rows]
+
+    def changes_since(self, seq: int, limit: int = 100):
+        """
+        Conversas alteradas ou removidas depois de `seq`, em ordem de seq:
+        [(chatID, state, agent_mode, seq, removida)].
+        Devolve None se `seq` é mais antigo que as lápides guardadas (é preciso recarregar tudo).
+        """
+        floor = self.conn.execute("SELECT value FROM meta WHERE key = 'tombstone_floor'").fetchone()[0]
+        if seq < floor:
+            return None
+        rows = self.conn.execute(
+            "SELECT chat_id, state, agent_mode, seq, 0 FROM conversations WHERE seq > ? "
+            "UNION ALL "
+            "SELECT chat_id, '', 0, seq, 1 FROM tombstones WHERE seq > ? "
+            "ORDER BY seq LIMIT ?",
+            (seq, seq, limit)
+        ).fetchall()
+        return [(chat_id, state, bool(agent_mode), row_seq, bool(removed))
+                for chat_id, state, agent_mode, row_seq, removed in rows]
+
+    def deadline_changes_since(self, seq: int, limit: int = 1000):
+        """
+        Como changes_since, mas com as colunas dos prazos de inatividade:
+        [(chatID, state, last_interaction, pause_start_time, seq)], state None = removida.
+        """
+        floor = self.conn.execute("SELECT value FROM meta WHERE key = 'tombstone_floor'").fetchone()[0]
+        if seq < floor:
+            return None
+        return self.conn.execute(
+            "SELECT chat_id, state, last_interaction, pause_start_time, seq FROM conversations WHERE seq > ? "
+            "UNION ALL "
+            "SELECT chat_id, NULL, NULL, NULL, seq FROM tombstones WHERE seq > ? "
+            "ORDER BY seq LIMIT ?",
+            (seq, seq, limit)
+        ).fetchall()
+
+    def count(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM conversations").fetchone()[0]
+
+    def count_by_state(self) -> dict:
+        """{state: número de conversas}."""
+        return dict(self.conn.execute("SELECT state, COUNT(*) FROM conversations GROUP BY state").fetchall())
+
+    def size_bytes(self) -> int:
+        """Tamanho do banco em disco, incluindo o WAL."""
+        return sum(os.path.getsize(path) for path in (self.path, self.path + '-wal') if os.path.exists(path))
+
+    # -------------------- configurações compartilhadas --------------------
+
+    def get_setting(self, key: str, default=None):
+        row = self.conn.execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set_setting(self, key: str, value, overwrite: bool = True):
+        """Grava uma configuração (com overwrite=False, só se ainda não existir)."""
+        verb = "INSERT OR REPLACE" if overwrite else "INSERT OR IGNORE"
+        with self.conn:
+            self.conn.execute(
+                f"{verb} INTO settings (key, value, updated_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value), time.time())
+            )
+
+    def toggle_setting(self, key: str, default: bool = False) -> bool:
+        """Inverte uma configuração booleana numa única escrita e devolve o novo valor."""
+        with self.conn:
+            # O UPSERT pega a trava de escrita antes da leitura: dois processos
+            # alternando ao mesmo tempo não leem o mesmo valor antigo
+            self.conn.execute(
+                "INSERT INTO settings (key, value, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET "
+                "value = CASE value WHEN 'true' THEN 'false' ELSE 'true' END, updated_at = excluded.updated_at",
+                (key, json.dumps(not default), time.time())
+            )
+            row = self.conn.execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0])
+
+    # ---------------------------- escrita ----------------------------
+
+    def add_listener(self, listener):
+        """`listener(chat_id, estado)` é chamado após cada escrita; estado None = conversa removida."""
+        self._listeners.append(listener)
+
+    def _notify(self, changes):
+        for chat_id, info in changes:
+            for listener in self._listeners:
+                try:
+                    listener(chat_id, info)
+                except Exception as e:
+                    logging.error(f"Erro em ouvinte do banco de estados ({chat_id}): {e}")
+
+    def _next_seq(self, conn: sqlite3.Connection, count: int) -> int:
+        """Reserva `count` números de sequência e devolve o primeiro (dentro da transação aberta)."""
+        conn.execute("UPDATE meta SET value = value + ? WHERE key = 'seq'", (count,))
+        last = conn.execute("SELECT value FROM meta WHERE key = 'seq'").fetchone()[0]
+        return last - count + 1
+
+    def upsert(self, chat_id: str, info: dict):
+        self.upsert_many({chat_id: info})
+
+    def upsert_many(self, states: dict):
+        """Grava várias conversas numa única transação."""
+        if not states:
+            return
+        with self.conn:
+            first = self._next_seq(self.conn, len(states))
+            self.conn.executemany(
+                UPSERT_SQL,
+                [state_row(chat_id, info, first + i) for i, (chat_id, info) in enumerate(states.items())]
+            )
+            # Conversa recriada: a lápide anterior deixa de valer
+            self.conn.executemany("DELETE FROM tombstones WHERE chat_id = ?", [(chat_id,) for chat_id in states])
+        self._notify(states.items())
+
+    def delete(self, chat_id: str):
+        with self.conn:
+            cursor = self.conn.execute("DELETE FROM conversations WHERE chat_id = ?", (chat_id,))
+            if cursor.rowcount:
+                self._add_tombstones(self.conn, [chat_id])
+        self._notify([(chat_id, None)])
+
+    def _add_tombstones(self, conn: sqlite3.Connection, chat_ids: list):
+        """Registra remoções (com seq novo) e descarta as lápides vencidas."""
+        now = time.time()
+        first = self._next_seq(conn, len(chat_ids))
+        conn.executemany(
+            "INSERT OR REPLACE INTO tombstones (chat_id, seq, deleted_at) VALUES (?, ?, ?)",
+            [(chat_id, first + i, now) for i, chat_id in enumerate(chat_ids)]
+        )
+        cutoff = now - TOMBSTONE_TTL
+        expired = conn.execute("SELECT MAX(seq) FROM tombstones WHERE deleted_at < ?", (cutoff,)).fetchone()[0]
+        if expired is not None:
+            # Cursores anteriores à lápide mais nova descartada já não enxergam todas as remoções
+            conn.execute("UPDATE meta SET value = MAX(value, ?) WHERE key = 'tombstone_floor'", (expired,))
+            conn.execute("DELETE FROM tombstones WHERE deleted_at < ?", (cutoff,))
+
+    def apply_batch(self, updates: dict, deletes: dict) -> list:
+        """
+        Aplica alterações condicionais numa única transação.
+        `updates`: {chatID: (estado, seq_lido)}; `deletes`: {chatID: seq_lido}.
+        Cada conversa só é alterada se o seq ainda for o lido (seq_lido None: só se a
+        conversa ainda não existir); devolve os chatIDs aplicados.
+        """
+        applied = []
+        changes = []
+        with self.conn:
+            seq = self._next_seq(self.conn, len(updates)) if updates else 0
+            for chat_id, (info, expected_seq) in updates.items():
+                row = state_row(chat_id, info, seq)
+                if expected_seq is None:
+                    cursor = self.conn.execute(INSERT_NEW_SQL, row)
+                    if cursor.rowcount:
+                        # Conversa recriada: a lápide anterior deixa de valer
+                        self.conn.execute("DELETE FROM tombstones WHERE chat_id = ?", (chat_id,))
+                else:
+                    cursor = self.conn.execute(GUARDED_UPDATE_SQL, row[1:] + (chat_id, expected_seq))
+                seq += 1
+                if cursor.rowcount:
+                    applied.append(chat_id)
+                    changes.append((chat_id, info))
+            removed = []
+            for chat_id, expected_seq in deletes.items():
+                cursor = self.conn.execute(
+                    "DELETE FROM conversations WHERE chat_id = ? AND seq = ?", (chat_id, expected_seq)
+                )
+                if cursor.rowcount:
+                    removed.append(chat_id)
+                    changes.append((chat_id, None))
+            if removed:
+                self._add_tombstones(self.conn, removed)
+                applied.extend(removed)
+        self._notify(changes)
+        return applied
+
+    # ---------------------------- migração ----------------------------
+
+    def migrate_from_json(self, json_path: str):
+        """
+        Importa o antigo conversation_states.json uma única vez.
+        Depois da importação o arquivo é renomeado para <nome>.migrated.
+        """
+        if not os.path.exists(json_path):
+            return
+        try:
+            with open(json_path, 'r') as f:
+                states = json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            logging.error(f"Erro ao ler {json_path} para migração: {e}")
+            return
+        if not isinstance(states, dict):
+            logging.error(f"{json_path} não contém um dicionário válido; migração ignorada.")
+            return
+
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO conversations "
+                "(chat_id, state, agent_mode, last_interaction, pause_start_time, data, seq) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [state_row(chat_id, info) for chat_id, info in states.items() if isinstance(info, dict)]
+            )
+        os.replace(json_path, json_path + '.migrated')
+        logging.info(f"{len(states)} conversas migradas de {json_path} para {self.path}.")
@@ -1,21 +1,37 @@
-import json
-import requests
 import pandas as pd
 import os
 import logging
 import time
-import base64
 import re
-from weasyprint import HTML
+import functools
+import threading
+import ast
+import sys
+import inspect
+
+from catalog import product_catalog, repair_table, SearchResultCache
+from state_store import StateStore
+from archive import ConversationArchive, ARCHIVE_DIR
+import inactivity
+from executor import ChatExecutor
+from ultramsg import UltraMsgClient, Outbox, DEFAULT_BASE_URL
+from receipt import ReceiptService, receipt_filename
+from metrics import CATALOG_SEARCH_SECONDS, STATE_SAVE_SECONDS
 
 ##############################################################################
 # CONFIGURAÇÕES ULTRAMSG
 ##############################################################################
 
-STATE_FILE = 'conversation_states.json'
+STATE_DB = 'conversation_states.db'
+STATE_FILE = 'conversation_states.json'  # formato antigo, migrado para STATE_DB na primeira execução
 
-ULTRAMSG_INSTANCE_ID = "instance99723"  # Substitua pelo seu ID da instância UltraMsg
-ULTRAMSG_TOKEN = "2str21gem9r5za4u"    # Substitua pelo seu token UltraMsg
+# Podem ser sobrescritos por variáveis de ambiente (ex.: apontar para um servidor de testes)
+ULTRAMSG_INSTANCE_ID = os.environ.get('ULTRAMSG_INSTANCE_ID', "instance99723")  # Substitua pelo seu ID da instância UltraMsg
+ULTRAMSG_TOKEN = os.environ.get('ULTRAMSG_TOKEN', "2str21gem9r5za4u")    # Substitua pelo seu token UltraMsg
+ULTRAMSG_BASE_URL = os.environ.get('ULTRAMSG_BASE_URL', DEFAULT_BASE_URL)
+
+# Cliente HTTP compartilhado (pool keep-alive, timeouts e novas tentativas)
+ultramsg_client = UltraMsgClient(ULTRAMSG_INSTANCE_ID, ULTRAMSG_TOKEN, ULTRAMSG_BASE_URL)
 
 # Exemplo de dicionário de taxas do Cartão (1 a 18 parcelas)
 CREDIT_RATES = {
@@ -39,6 +55,18 @@ CREDIT_RATES = {
     18: 0.1727
 }
 
+# Coleta de dados do cliente, na ordem: estado -> (campo gravado, próxima pergunta, próximo estado).
+# A última etapa não tem próximo estado: gera o recibo e encerra a sessão.
+CLIENT_DATA_STEPS = {
+    'ASKED_NAME': ('name', "CPF:", 'ASKED_CPF'),
+    'ASKED_CPF': ('cpf', "CEL:", 'ASKED_PHONE'),
+    'ASKED_PHONE': ('phone', "ENDEREÇO DA ENTREGA:", 'ASKED_ADDRESS'),
+    'ASKED_ADDRESS': ('address', "BAIRRO:", 'ASKED_NEIGHBORHOOD'),
+    'ASKED_NEIGHBORHOOD': ('neighborhood', "CEP:", 'ASKED_ZIP'),
+    'ASKED_ZIP': ('zip', "E-MAIL:", 'ASKED_EMAIL'),
+    'ASKED_EMAIL': ('email', None, None),
+}
+
 ##############################################################################
 # FUNÇÕES DE APOIO (ENVIO E MANIPULAÇÃO)
 ##############################################################################
@@ -51,18 +79,46 @@ def format_number(chatID: str) -> str:
     number = number.replace("@c.us", "")
     return number
 
+# Envios para a UltraMsg saem do caminho do webhook: fila FIFO por chat + pool de workers
+outbound_dispatcher = ChatExecutor(max_workers=4, name='ultramsg')
+
+# Contadores de envio (consultados pelo painel/monitoramento)
+outbound_stats = {'sent': 0, 'failed': 0}
+outbound_stats_lock = threading.Lock()
+
+def report_send_result(kind: str, chatID: str, future):
+    """Callback dos envios assíncronos: registra sucesso/falha no log e nos contadores."""
+    try:
+        response = future.result()
+        ok = response is not None and response.status_code < 400
+    except Exception as e:
+        logging.error(f"Falha no envio de {kind} para {chatID}: {e}")
+        ok = False
+    else:
+        if not ok:
+            status = response.status_code if response is not None else 'sem resposta'
+            logging.error(f"Falha no envio de {kind} para {chatID}: {status}")
+    with outbound_stats_lock:
+        outbound_stats['sent' if ok else 'failed'] += 1
+
 def send_message_ultramsg(chatID: str, text: str):
+    """Enfileira o texto para envio e retorna imediatamente (Future com a resposta da UltraMsg)."""
+    future = outbound_dispatcher.submit(format_number(chatID), post_message_ultramsg, chatID, text)
+    future.add_done_callback(functools.partial(report_send_result, 'mensagem', chatID))
+    return future
+
+def send_document_ultramsg_bytes(chatID: str, filename: str, pdf_bytes: bytes):
+    """Enfileira um PDF que já está em memória, sem gravá-lo em disco."""
+    future = outbound_dispatcher.submit(format_number(chatID), post_document_ultramsg, chatID, filename, pdf_bytes)
+    future.add_done_callback(functools.partial(report_send_result, 'documento', chatID))
+    return future
+
+def post_message_ultramsg(chatID: str, text: str):
     # Supondo que chatID seja só numero ex.: "5511999999999"
     to_number = f"{chatID}@c.us"  # ou se preferir "whatsapp:+{chatID}@c.us"
-    url = f"https://api.ultramsg.com/{ULTRAMSG_INSTANCE_ID}/messages/chat"
-    data = {
-        "to": to_number,
-        "body": text,
-        "token": ULTRAMSG_TOKEN
-    }
 
     try:
-        response = requests.post(url, data=data)
+        response = ultramsg_client.send_text(to_number, text)
         logging.info(f"Mensagem enviada para {to_number}: '{text}'")
         logging.info(f"Resposta UltraMsg: {response.status_code}, {response.text}")
         return response
@@ -70,68 +126,120 @@ def send_message_ultramsg(chatID: str, text: str):
         logging.error(f"Erro ao enviar mensagem via UltraMsg: {e}")
         return None
 
-def send_document_ultramsg_base64(chatID: str, pdf_path: str):
+def post_document_ultramsg(chatID: str, filename: str, pdf_bytes: bytes):
     """
-    Lê o PDF local em binário, converte para Base64 e envia via endpoint /messages/document
-    da UltraMsg, sem precisar de URL pública.
+    Envia o PDF em Base64 via endpoint /messages/document da UltraMsg, sem precisar
+    de URL pública. A codificação acontece em pedaços durante o envio.
     """
     to_number = format_number(chatID)
-    url = f"https://api.ultramsg.com/{ULTRAMSG_INSTANCE_ID}/messages/document"
-    
-    # Lê o PDF em binário
-    try:
-        with open(pdf_path, 'rb') as f:
-            pdf_bytes = f.read()
-    except FileNotFoundError:
-        logging.error(f"Arquivo PDF não encontrado: {pdf_path}")
-        return None
-
-    # Converte em Base64
-    pdf_b64 = base64.b64encode(pdf_bytes).decode('utf-8')
-
-    data = {
-        "token": ULTRAMSG_TOKEN,
-        "to": to_number,
-        "base64Encoded": "true",  
-        "document": pdf_b64,
-        "filename": os.path.basename(pdf_path)
-    }
 
     try:
-        response = requests.post(url, data=data)
-        logging.info(f"Enviando PDF (base64) para {to_number} -> {pdf_path}")
+        response = ultramsg_client.send_document(to_number, filename, pdf_bytes)
+        logging.info(f"Enviando PDF (base64) para {to_number} -> {filename} ({len(pdf_bytes)} bytes)")
         logging.info(f"Resposta UltraMsg: {response.status_code}, {response.text}")
         return response
     except Exception as e:
         logging.error(f"Erro ao enviar PDF via UltraMsg (base64): {e}")
         return None
 
-def load_states() -> dict:
-    """Carrega o dicionário de estados do arquivo JSON."""
-    if os.path.exists(STATE_FILE):
-        with open(STATE_FILE, 'r') as f:
-            try:
-                data = json.load(f)
-                if isinstance(data, dict):
-                    return data
-                else:
-                    logging.error("O arquivo de estados não contém um dicionário válido.")
-                    return {}
-            except json.JSONDecodeError:
-                logging.error("Erro ao decodificar o arquivo de estados.")
-                return {}
-    else:
-        logging.info("Arquivo de estados não encontrado. Criando novo.")
-        return {}
+# Recibos em PDF são renderizados num pool de processos, fora do caminho do webhook
+receipt_service = ReceiptService()
+
+# Listas de produtos já montadas para as consultas mais recentes
+product_list_cache = SearchResultCache()
+
+def build_product_list(snapshot, model_name: str) -> tuple:
+    """(produtos em ordem de relevância, mensagem "LISTA DE APARELHOS"), ou ((), None) sem resultados."""
+    resultados = snapshot.search(model_name)
+    if resultados.empty:
+        return (), None
+    produtos = tuple(resultados.to_dict(orient='records'))
+
+    linhas = ["✨📱 LISTA DE APARELHOS DISPONÍVEIS 📱✨\n"]
+    for i, row in enumerate(produtos, start=1):
+        linhas.append(
+            f"{i}. Produto: {row['Produto']}\n"
+            f"   Cor: {row['Cor']}\n"
+            f"   Estado: {row['Estado']}\n"
+            f"   Preço: {row['Preço (R$)']}\n\n"
+        )
+    return produtos, "".join(linhas)
+
+def product_list_reply(model_name: str) -> tuple:
+    """Resultado de build_product_list, reaproveitado enquanto o catálogo não mudar."""
+    started = time.perf_counter()
+    snapshot = product_catalog.snapshot()
+    built = []
+
+    def build():
+        built.append(True)
+        return build_product_list(snapshot, model_name)
+
+    reply = product_list_cache.get_or_build(model_name, snapshot.version, build)
+    CATALOG_SEARCH_SECONDS.labels('miss' if built else 'hit').observe(time.perf_counter() - started)
+    return reply
+
+RECEIPT_FALLBACK_MESSAGE = (
+    "Não conseguimos gerar o seu recibo agora, mas sua compra foi registrada. "
+    "Nossa equipe enviará o recibo em breve."
+)
+
+def start_receipt(chatID: str, client_data: dict, filename: str):
+    """Envia o recibo quando o PDF ficar pronto, ou uma mensagem de aviso se falhar."""
+    def on_done(pdf_bytes):
+        send_message_ultramsg(chatID, "Aqui está o seu recibo!")
+        send_document_ultramsg_bytes(chatID, filename, pdf_bytes)
+
+    def on_error(error):
+        send_message_ultramsg(chatID, RECEIPT_FALLBACK_MESSAGE)
+
+    if not receipt_service.submit(client_data, filename, on_done, on_error):
+        on_error(None)
+
+state_store = StateStore(STATE_DB, legacy_json=STATE_FILE)
+# Conversas encerradas, fora do banco de estados
+conversation_archive = ConversationArchive(ARCHIVE_DIR)
+
+# Quantas vezes um turno é refeito quando outra thread ou processo grava a mesma
+# conversa entre a leitura e a gravação
+TURN_ATTEMPTS = 3
+
 
-def save_states(states: dict):
-    """Salva o dicionário de estados no arquivo JSON."""
+class TurnConflictError(Exception):
+    """A conversa mudou em outro lugar a cada tentativa do turno; nada foi gravado nem enviado."""
+
+
+def load_state_with_seq(chat_id: str):
+    """(estado, seq) de uma conversa para uma gravação condicional; (None, None) se não existir."""
+    try:
+        return state_store.get_with_seq(chat_id)
+    except Exception as e:
+        logging.error(f"Erro ao carregar o estado de {chat_id}: {e}")
+        return None, None
+
+def save_state_if_unchanged(chat_id: str, info: dict, seq) -> bool:
+    """
+    Grava a conversa só se ela ainda estiver no `seq` lido (None = ainda não existia).
+    Devolve False se outra thread ou processo gravou antes; aí o chamador relê e refaz.
+    """
     try:
-        with open(STATE_FILE, 'w') as f:
-            json.dump(states, f, indent=4)
-        logging.info("Estados salvos com sucesso.")
+        with STATE_SAVE_SECONDS.time():
+            applied = state_store.apply_batch({chat_id: (info, seq)}, {})
     except Exception as e:
-        logging.error(f"Erro ao salvar os estados: {e}")
+        # Banco indisponível: registra e segue, como antes das gravações condicionais
+        logging.error(f"Erro ao salvar o estado de {chat_id}: {e}")
+        return True
+    if not applied:
+        return False
+    logging.info("Estados salvos com sucesso.")
+    return True
+
+def delete_state(chat_id: str):
+    """Remove uma conversa do banco."""
+    try:
+        state_store.delete(chat_id)
+    except Exception as e:
+        logging.error(f"Erro ao remover o estado de {chat_id}: {e}")
 
 
 ##############################################################################
@@ -148,11 +256,56 @@ class ultraChatBot():
         raw_chat_id = raw_chat_id.replace("@c.us", "")
         self.chatID = raw_chat_id  # <= FICA SÓ NÚMERO (ex.: 5511999999999)
         
-        # Carrega states
-        self.states = load_states()
+        self.start_turn()
+
+    def start_turn(self):
+        """(Re)carrega a conversa e descarta o que um turno anterior tenha acumulado."""
+        # Carrega só o estado desta conversa, com o seq para a gravação condicional
+        info, self.seq = load_state_with_seq(self.chatID)
+        self.states = {self.chatID: info} if info is not None else {}
+        # Conversas alteradas neste turno; gravadas uma única vez em flush_states()
+        self.dirty = set()
+        # Mensagens do turno; enviadas (agrupadas) em flush_outbox()
+        self.outbox = Outbox()
+        # Tarefas que só podem começar depois que o turno foi gravado e enviado
+        self.after_turn = []
 
     def send_message(self, chatID: str, text: str):
-        return send_message_ultramsg(chatID, text)
+        """Guarda o texto na caixa de saída do turno; textos seguidos viram um único balão."""
+        if chatID != self.chatID:
+            return send_message_ultramsg(chatID, text)
+        self.outbox.add_text(text)
+
+    def send_break(self):
+        """Força que a próxima mensagem do turno saia num balão separado."""
+        self.outbox.add_break()
+
+    def flush_outbox(self):
+        """Entrega à fila de envio tudo o que foi acumulado no turno."""
+        for text in self.outbox.drain():
+            send_message_ultramsg(self.chatID, text)
+
+    def mark_dirty(self):
+        """Marca a conversa para ser gravada no fim do turno."""
+        self.dirty.add(self.chatID)
+
+    def flush_states(self) -> bool:
+        """
+        Grava a conversa, se foi alterada, numa única escrita condicional. Devolve
+        False se ela mudou desde a leitura (outro processo atendeu uma mensagem dela).
+        """
+        changed = self.chatID in self.dirty and self.chatID in self.states
+        self.dirty.clear()
+        if not changed:
+            return True
+        return save_state_if_unchanged(self.chatID, self.states[self.chatID], self.seq)
+
+    def finish_turn(self):
+        """Envia as respostas do turno e dispara as tarefas que dependiam dele."""
+        self.flush_outbox()
+        for task in self.after_turn:
+            task()
+        self.after_turn.clear()
 
     ################################################################
     #                    MENSAGENS BÁSICAS
@@ -175,7 +328,7 @@ class ultraChatBot():
             'state': 'ASKED_OPTION',
             'last_interaction': time.time()
         }
-        save_states(self.states)
+        self.mark_dirty()
         
     def send_options(self):
         """Envia as opções principais para o usuário."""
@@ -203,35 +356,19 @@ class ultraChatBot():
 
         self.states[self.chatID]['state'] = 'ASKED_MODEL_NAME'
         self.states[self.chatID]['last_interaction'] = time.time()
-        save_states(self.states)
+        self.mark_dirty()
 
     def handle_model_search(self, model_name: str):
         """
-        Busca o modelo no arquivo Excel 'Produtos_Lacrados.xlsx' e lista as opções.
+        Busca o modelo no índice do catálogo em memória (planilha 'Produtos_Lacrados.xlsx')
+        e lista as opções, da mais relevante para a menos relevante.
         """
         try:
-            df = pd.read_excel('excel/Produtos_Lacrados.xlsx')
-            df.columns = df.columns.str.strip()
-
-            df = df[['Produto', 'Preço (R$)', 'Cor', 'Detalhe']]
-            df['Estado'] = df['Detalhe'].apply(
-                lambda x: 'Lacrado' if pd.isna(x) else f"Seminovo ({x})"
-            )
-
-            resultados = df[df['Produto'].str.contains(model_name, case=False, na=False)]
-            if not resultados.empty:
-                # Caso encontre resultados, segue o fluxo normal
-                produtos = resultados.to_dict(orient='records')
-                self.states[self.chatID]['produtos'] = produtos
-
-                mensagem = "✨📱 LISTA DE APARELHOS DISPONÍVEIS 📱✨\n"
-                for i, row in enumerate(produtos, start=1):
-                    mensagem += (
-                        f"{i}. Produto: {row['Produto']}\n"
-                        f"   Cor: {row['Cor']}\n"
-                        f"   Estado: {row['Estado']}\n"
-                        f"   Preço: {row['Preço (R$)']}\n\n"
-                    )
+            produtos, mensagem = product_list_reply(model_name)
+            if produtos:
+                # Caso encontre resultados, segue o fluxo normal.
+                # Cópias: o resultado em cache é compartilhado entre as conversas
+                self.states[self.chatID]['produtos'] = [dict(row) for row in produtos]
 
                 self.send_message(self.chatID, mensagem)
                 self.send_message(
@@ -244,7 +381,7 @@ class ultraChatBot():
                 )
                 self.states[self.chatID]['state'] = 'ASKED_MODEL_NUMBER'
                 self.states[self.chatID]['last_interaction'] = time.time()
-                save_states(self.states)
+                self.mark_dirty()
             else:
                 # Não encontrou resultados => oferecer 3 opções:
                 self.send_message(self.chatID, "Desculpe, não encontramos esse produto em nosso estoque.")
@@ -259,7 +396,7 @@ class ultraChatBot():
                 self.states[self.chatID]['last_searched_model'] = model_name
                 self.states[self.chatID]['state'] = 'ASKED_NO_RESULTS_ACTION'
                 self.states[self.chatID]['last_interaction'] = time.time()
-                save_states(self.states)
+                self.mark_dirty()
 
         except Exception as e:
             logging.error(f"Erro ao acessar a planilha: {e}")
@@ -278,7 +415,7 @@ class ultraChatBot():
             self.send_message(self.chatID, "Obrigado pelo contato. Se precisar de algo, estamos à disposição!")
             self.states[self.chatID]['state'] = 'SESSION_ENDED'
             self.states[self.chatID]['pause_start_time'] = time.time()
-            save_states(self.states)
+            self.mark_dirty()
         else:
             try:
                 choice_num = int(choice)
@@ -302,7 +439,7 @@ class ultraChatBot():
                     self.send_message(self.chatID, mensagem)
                     self.states[self.chatID]['state'] = 'CONFIRM_PURCHASE'
                     self.states[self.chatID]['last_interaction'] = time.time()
-                    save_states(self.states)
+                    self.mark_dirty()
                 else:
                     self.send_message(self.chatID, "Opção inválida. Por favor, digite o número do modelo desejado.")
             except ValueError:
@@ -324,12 +461,12 @@ class ultraChatBot():
             )
             self.states[self.chatID]['state'] = 'ASKED_PAYMENT_METHOD'
             self.states[self.chatID]['last_interaction'] = time.time()
-            save_states(self.states)
+            self.mark_dirty()
         elif choice in ['NÃO', 'NAO', '❌']:
             self.send_message(self.chatID, "Tudo bem! Se precisar de algo mais, estamos à disposição.")
             self.states[self.chatID]['state'] = 'SESSION_ENDED'
             self.states[self.chatID]['pause_start_time'] = time.time()
-            save_states(self.states)
+            self.mark_dirty()
         else:
             self.send_message(self.chatID, "Desculpe, não entendi. Responda com 'Sim' ou 'Não'.")
 
@@ -354,7 +491,7 @@ class ultraChatBot():
             self.send_message(self.chatID, mensagem_parcelas)
 
             self.states[self.chatID]['state'] = 'ASKED_CREDIT_INSTALLMENTS'
-            save_states(self.states)
+            self.mark_dirty()
 
         elif choice == '2':
             # PIX/DINHEIRO
@@ -363,7 +500,7 @@ class ultraChatBot():
             self.send_message(self.chatID, "Por favor, informe seus dados para finalizar:")
             self.send_message(self.chatID, "NOME COMPLETO:")
             self.states[self.chatID]['state'] = 'ASKED_NAME'
-            save_states(self.states)
+            self.mark_dirty()
 
         elif choice == '3':
             # DAR APARELHO USADO
@@ -371,7 +508,7 @@ class ultraChatBot():
             self.send_message(self.chatID, "Perfeito! Precisamos de algumas informações do aparelho que você vai entregar.")
             self.send_message(self.chatID, "Qual o modelo do aparelho usado?")
             self.states[self.chatID]['state'] = 'ASKED_USED_PHONE_MODEL'
-            save_states(self.states)
+            self.mark_dirty()
         else:
             self.send_message(self.chatID, "Opção inválida. Selecione 1, 2 ou 3 por favor.")
 
@@ -388,7 +525,7 @@ class ultraChatBot():
                 self.send_message(self.chatID, "NOME COMPLETO:")
 
                 self.states[self.chatID]['state'] = 'ASKED_NAME'
-                save_states(self.states)
+                self.mark_dirty()
             else:
                 self.send_message(self.chatID, "Por favor, digite um número de 1 a 18.")
         except ValueError:
@@ -402,25 +539,25 @@ class ultraChatBot():
         self.states[self.chatID]['used_phone_model'] = user_message
         self.send_message(self.chatID, "Qual o armazenamento do aparelho (ex: 64GB, 128GB)?")
         self.states[self.chatID]['state'] = 'ASKED_USED_PHONE_STORAGE'
-        save_states(self.states)
+        self.mark_dirty()
 
     def handle_used_phone_storage(self, user_message: str):
         self.states[self.chatID]['used_phone_storage'] = user_message
         self.send_message(self.chatID, "Como está a bateria do aparelho? (ex: Boa, Ruim, Saúde X%)")
         self.states[self.chatID]['state'] = 'ASKED_USED_PHONE_BATTERY'
-        save_states(self.states)
+        self.mark_dirty()
 
     def handle_used_phone_battery(self, user_message: str):
         self.states[self.chatID]['used_phone_battery'] = user_message
         self.send_message(self.chatID, "O Face ID está funcionando? (Sim / Não)")
         self.states[self.chatID]['state'] = 'ASKED_USED_PHONE_FACEID'
-        save_states(self.states)
+        self.mark_dirty()
 
     def handle_used_phone_faceid(self, user_message: str):
         self.states[self.chatID]['used_phone_faceid'] = user_message
         self.send_message(self.chatID, "Há algum defeito, tela trincada ou algo parecido? Se sim, descreva. Se não, digite 'Não'.")
         self.states[self.chatID]['state'] = 'ASKED_USED_PHONE_DEFECTS'
-        save_states(self.states)
+        self.mark_dirty()
 
     def handle_used_phone_defects(self, user_message: str):
         self.states[self.chatID]['used_phone_defects'] = user_message
@@ -431,7 +568,7 @@ class ultraChatBot():
             "2️⃣ - PIX/Dinheiro"
         )
         self.states[self.chatID]['state'] = 'ASKED_COMPLEMENT_PAYMENT_METHOD'
-        save_states(self.states)
+        self.mark_dirty()
 
     def handle_complement_payment_method(self, user_message: str):
         choice = user_message.strip()
@@ -441,7 +578,7 @@ class ultraChatBot():
             self.send_message(self.chatID, "Por favor, informe seus dados para finalizar:")
             self.send_message(self.chatID, "NOME COMPLETO:")
             self.states[self.chatID]['state'] = 'ASKED_NAME'
-            save_states(self.states)
+            self.mark_dirty()
 
         elif choice == '2':
             self.states[self.chatID]['payment_complement'] = 'PIX_DINHEIRO'
@@ -449,7 +586,7 @@ class ultraChatBot():
             self.send_message(self.chatID, "Por favor, informe seus dados para finalizar:")
             self.send_message(self.chatID, "NOME COMPLETO:")
             self.states[self.chatID]['state'] = 'ASKED_NAME'
-            save_states(self.states)
+            self.mark_dirty()
         else:
             self.send_message(self.chatID, "Opção inválida. Selecione 1 ou 2, por favor.")
 
@@ -459,39 +596,13 @@ class ultraChatBot():
 
     def collect_client_data(self, user_message: str):
         current_state = self.states[self.chatID].get('state')
+        field, next_question, next_state = CLIENT_DATA_STEPS[current_state]
+        self.states[self.chatID][field] = user_message
 
-        if current_state == 'ASKED_NAME':
-            self.states[self.chatID]['name'] = user_message
-            self.send_message(self.chatID, "CPF:")
-            self.states[self.chatID]['state'] = 'ASKED_CPF'
-
-        elif current_state == 'ASKED_CPF':
-            self.states[self.chatID]['cpf'] = user_message
-            self.send_message(self.chatID, "CEL:")
-            self.states[self.chatID]['state'] = 'ASKED_PHONE'
-
-        elif current_state == 'ASKED_PHONE':
-            self.states[self.chatID]['phone'] = user_message
-            self.send_message(self.chatID, "ENDEREÇO DA ENTREGA:")
-            self.states[self.chatID]['state'] = 'ASKED_ADDRESS'
-
-        elif current_state == 'ASKED_ADDRESS':
-            self.states[self.chatID]['address'] = user_message
-            self.send_message(self.chatID, "BAIRRO:")
-            self.states[self.chatID]['state'] = 'ASKED_NEIGHBORHOOD'
-
-        elif current_state == 'ASKED_NEIGHBORHOOD':
-            self.states[self.chatID]['neighborhood'] = user_message
-            self.send_message(self.chatID, "CEP:")
-            self.states[self.chatID]['state'] = 'ASKED_ZIP'
-
-        elif current_state == 'ASKED_ZIP':
-            self.states[self.chatID]['zip'] = user_message
-            self.send_message(self.chatID, "E-MAIL:")
-            self.states[self.chatID]['state'] = 'ASKED_EMAIL'
-
-        elif current_state == 'ASKED_EMAIL':
-            self.states[self.chatID]['email'] = user_message
+        if next_state:
+            self.send_message(self.chatID, next_question)
+            self.states[self.chatID]['state'] = next_state
+        else:
             self.send_message(self.chatID, "Obrigado! Estamos gerando o recibo da sua compra...")
 
             # 1) Calcula valor final
@@ -502,7 +613,7 @@ class ultraChatBot():
             self.states[self.chatID]['state'] = 'SESSION_ENDED'
             self.states[self.chatID]['pause_start_time'] = time.time()
 
-        save_states(self.states)
+        self.mark_dirty()
 
     def calculate_final_price(self):
         client_data = self.states[self.chatID]
@@ -544,111 +655,19 @@ class ultraChatBot():
 
         self.states[self.chatID]['valor_troca_usado'] = used_phone_value
         self.states[self.chatID]['valor_final'] = round(preco_final, 2)
-        save_states(self.states)
+        self.mark_dirty()
 
     def generate_receipt(self):
-        client_data = self.states[self.chatID]
-        product = client_data.get('produto_escolhido', {})
-        valor_final = client_data.get('valor_final', 0)
-        payment_method = client_data.get('payment_method', '')
-        payment_complement = client_data.get('payment_complement', '')
-        valor_troca_usado = client_data.get('valor_troca_usado', 0)
-        installments = client_data.get('installments', 1)
-
-        nome_cliente = client_data.get('name', 'Cliente')
+        """
+        Agenda a geração do recibo no pool de processos. O pedido só é enviado depois
+        que o turno termina, para o recibo nunca chegar antes das mensagens do turno.
+        """
+        client_data = dict(self.states[self.chatID])
         # Extrair número de Whats do chatID
         number_str = format_number(self.chatID)  # ex.: '556781687046'
+        filename = receipt_filename(client_data, number_str)
 
-        # Monta o nome do PDF: "NomeDoCliente_whatsnumero.pdf"
-        pdf_filename = f"{nome_cliente}_{number_str}.pdf"
-        pdf_path = os.path.join("PDF", pdf_filename)
-
-        html_content = f"""
-        <!DOCTYPE html>
-        <html lang="pt-BR">
-        <head>
-            <meta charset="UTF-8">
-            <meta name="viewport" content="width=device-width, initial-scale=1.0">
-            <title>Nota/Recibo</title>
-            <style>
-                body {{
-                    font-family: Arial, sans-serif;
-                    margin: 20px;
-                    padding: 20px;
-                    border: 1px solid #ccc;
-                    max-width: 600px;
-                }}
-                h1 {{
-                    text-align: center;
-                    text-transform: uppercase;
-                }}
-                .details {{
-                    margin-bottom: 20px;
-                }}
-                .details div {{
-                    margin: 5px 0;
-                }}
-                .footer {{
-                    text-align: center;
-                    margin-top: 30px;
-                }}
-            </style>
-        </head>
-        <body>
-            <h1>Recibo de Compra</h1>
-            <div class="details">
-                <div><strong>Data:</strong> <span>{time.strftime("%d/%m/%Y")}</span></div>
-                <div><strong>Cliente:</strong> <span>{nome_cliente}</span></div>
-                <div><strong>Endereço:</strong> <span>{client_data.get('address')}, {client_data.get('neighborhood')}, {client_data.get('zip')}</span></div>
-                <div><strong>CPF:</strong> <span>{client_data.get('cpf')}</span></div>
-                <div><strong>E-mail:</strong> <span>{client_data.get('email')}</span></div>
-            </div>
-
-            <h2>Detalhes do Pedido</h2>
-            <table border="1" width="100%" cellpadding="5" cellspacing="0">
-                <thead>
-                    <tr>
-                        <th>Item</th>
-                        <th>Modelo</th>
-                        <th>Quantidade</th>
-                        <th>Preço Unitário</th>
-                        <th>Total</th>
-                    </tr>
-                </thead>
-                <tbody>
-                    <tr>
-                        <td>Smartphone</td>
-                        <td>{product.get('Produto')}</td>
-                        <td>1</td>
-                        <td>{product.get('Preço (R$)')}</td>
-                        <td>{product.get('Preço (R$)')}</td>
-                    </tr>
-                </tbody>
-            </table>
-
-            <div style="margin-top: 20px;">
-                <p><strong>Forma de Pagamento:</strong> {payment_method}</p>
-                {"<p><strong>Pagamento Complementar:</strong> " + payment_complement + "</p>" if payment_method == "USADO" else ""}
-                {f"<p><strong>Valor de troca do aparelho usado:</strong> R$ {valor_troca_usado}</p>" if valor_troca_usado else ""}
-                
-                {"<p><strong>Parcelas:</strong> " + str(installments) + "x</p>" if payment_method == "CARTAO" or (payment_method == "USADO" and payment_complement == "CARTAO") else ""}
-                
-                <p><strong>Valor Final (após taxas/descontos):</strong> R$ {valor_final}</p>
-            </div>
-
-            <div class="footer">
-                <p>Obrigado pela sua compra!</p>
-                <p>Loja Exemplo</p>
-            </div>
-        </body>
-        </html>
-        """
-
-        HTML(string=html_content).write_pdf(pdf_path)
-
-        # Envia o PDF como DOCUMENTO
-        self.send_message(self.chatID, "Aqui está o seu recibo!")
-        send_document_ultramsg_base64(self.chatID, pdf_path)
+        self.after_turn.append(lambda: start_receipt(self.chatID, client_data, filename))
 
     ################################################################
     #               LÓGICA DE ASSISTÊNCIA TÉCNICA
@@ -665,7 +684,7 @@ class ultraChatBot():
         self.send_message(self.chatID, options)
         self.states[self.chatID]['state'] = 'ASKED_TECH_OPTION'
         self.states[self.chatID]['last_interaction'] = time.time()
-        save_states(self.states)
+        self.mark_dirty()
 
     def handle_tech_option_choice(self, choice: str):
         choice = choice.strip()
@@ -675,12 +694,12 @@ class ultraChatBot():
             self.send_message(self.chatID, "Por favor, informe o modelo do seu iPhone (exemplo: iPhone 12).")
             self.states[self.chatID]['state'] = 'ASKED_PHONE_MODEL'
             self.states[self.chatID]['last_interaction'] = time.time()
-            save_states(self.states)
+            self.mark_dirty()
         elif choice == '4':
             self.send_message(self.chatID, "Por favor, descreva o problema que está enfrentando.")
             self.states[self.chatID]['state'] = 'ASKED_PROBLEM_DESCRIPTION'
             self.states[self.chatID]['last_interaction'] = time.time()
-            save_states(self.states)
+            self.mark_dirty()
         else:
             self.send_message(self.chatID, "Opção inválida. Selecione uma opção válida.")
 
@@ -692,34 +711,42 @@ class ultraChatBot():
             return
 
         try:
-            df = pd.read_excel('excel/reparo_iphones.xlsx')
-            df = df[['Modelo', 'Tela', 'Bateria', 'Tampa']]
-            df = df.dropna(subset=['Modelo'])
-
-            matched_rows = df[df['Modelo'].str.contains(model_name, case=False, na=False)]
-            if matched_rows.empty:
+            entry, candidates = repair_table.lookup(model_name)
+            if entry is None and candidates:
+                # Mais de um modelo possível: pergunta qual é, em vez de arriscar um preço errado
+                opcoes = "\n".join(f"- {c['Modelo']}" for c in candidates)
+                self.send_message(
+                    self.chatID,
+                    f"Encontramos mais de um modelo parecido com {model_name}:\n{opcoes}\n\n"
+                    "Por favor, digite o modelo exato do seu iPhone."
+                )
+                return
+            if entry is None:
                 self.send_message(self.chatID, f"Desculpe, não encontramos o modelo {model_name} em nosso sistema.")
                 self.send_message(self.chatID, "Por favor, informe o modelo novamente! ")
                 return
 
-            price = matched_rows.iloc[0][service_type]
-            if pd.isna(price):
-                self.send_message(self.chatID, f"Desculpe, não possuo o serviço de {service_type.lower()} para o modelo {model_name}.")
+            modelo = entry['Modelo']
+            price = entry.get(service_type)
+            if price is None:
+                self.send_message(self.chatID, f"Desculpe, não possuo o serviço de {service_type.lower()} para o modelo {modelo}.")
                 self.send_message(self.chatID, "Por favor, informe outro modelo ou peça um orçamento específico.")
                 self.handle_technical_assistance_options()
                 return
 
             self.send_message(
                 self.chatID,
-                f"O valor para trocar a {service_type.lower()} do seu {model_name} é R$ {price:.2f}."
+                f"O valor para trocar a {service_type.lower()} do seu {modelo} é R$ {price:.2f}."
             )
+            # O orçamento fica num balão só dele, para o cliente encaminhar ou consultar depois
+            self.send_break()
             self.send_message(
                 self.chatID,
                 "Deseja prosseguir com o serviço?\nResponda com:\nSim ✅\nNão ❌"
             )
             self.states[self.chatID]['state'] = 'ASKED_SERVICE_CONFIRMATION'
             self.states[self.chatID]['last_interaction'] = time.time()
-            save_states(self.states)
+            self.mark_dirty()
 
         except Exception as e:
             logging.error(f"Erro ao acessar a planilha: {e}")
@@ -734,12 +761,12 @@ class ultraChatBot():
             )
             self.states[self.chatID]['state'] = 'SESSION_ENDED'
             self.states[self.chatID]['pause_start_time'] = time.time()
-            save_states(self.states)
+            self.mark_dirty()
         elif confirmation in ['NÃO', 'NAO', '❌']:
             self.send_message(self.chatID, "Tudo bem! Se precisar de algo mais, estamos à disposição.")
             self.states[self.chatID]['state'] = 'SESSION_ENDED'
             self.states[self.chatID]['pause_start_time'] = time.time()
-            save_states(self.states)
+            self.mark_dirty()
         else:
             self.send_message(self.chatID, "Desculpe, não entendi. Por favor, responda com 'Sim' ou 'Não'.")
 
@@ -747,7 +774,7 @@ class ultraChatBot():
         self.send_message(self.chatID, "Obrigado por nos informar. Nossa equipe técnica irá analisar e entraremos em contato com o orçamento em breve.")
         self.states[self.chatID]['state'] = 'SESSION_ENDED'
         self.states[self.chatID]['pause_start_time'] = time.time()
-        save_states(self.states)
+        self.mark_dirty()
         
     ################################################################
     #                 VENDER UM APARELHO
@@ -772,23 +799,18 @@ class ultraChatBot():
                 model_minus = f"iPhone {number - 1}" if number > 1 else None
                 model_plus = f"iPhone {number + 1}"
 
-                # Leitura do Excel
-                df = pd.read_excel('excel/Produtos_Lacrados.xlsx')
-                df.columns = df.columns.str.strip()
-                df = df[['Produto', 'Preço (R$)', 'Cor', 'Detalhe']]
-                df['Estado'] = df['Detalhe'].apply(
-                    lambda x: 'Lacrado' if pd.isna(x) else f"Seminovo ({x})"
-                )
+                # Busca no índice do catálogo em memória (mesma versão para os dois modelos)
+                catalogo = product_catalog.snapshot()
 
                 # Aqui vamos juntar resultados dos dois modelos
                 similares = pd.DataFrame()
                 
                 if model_minus:  # se "iPhone 0" não faz sentido, ignoramos
-                    results_minus = df[df['Produto'].str.contains(model_minus, case=False, na=False)]
+                    results_minus = catalogo.search(model_minus)
                     similares = pd.concat([similares, results_minus], ignore_index=True)
                 
                 # iPhone (n+1)
-                results_plus = df[df['Produto'].str.contains(model_plus, case=False, na=False)]
+                results_plus = catalogo.search(model_plus)
                 similares = pd.concat([similares, results_plus], ignore_index=True)
 
                 if not similares.empty:
@@ -816,7 +838,7 @@ class ultraChatBot():
                     self.states[self.chatID]['produtos'] = produtos
                     self.states[self.chatID]['state'] = 'ASKED_MODEL_NUMBER'
                     self.states[self.chatID]['last_interaction'] = time.time()
-                    save_states(self.states)
+                    self.mark_dirty()
                 else:
                     self.send_message(self.chatID, "Não encontramos modelos semelhantes (iPhone anterior ou posterior).")
                     self.send_message(
@@ -828,7 +850,7 @@ class ultraChatBot():
                     # Pode criar um novo estado ou reaproveitar a lógica de redirect
                     self.states[self.chatID]['state'] = 'ASKED_SIMILAR_NOT_FOUND'
                     self.states[self.chatID]['last_interaction'] = time.time()
-                    save_states(self.states)
+                    self.mark_dirty()
             except Exception as e:
                 logging.error(f"Erro ao listar similares: {e}")
                 self.send_message(self.chatID, "Desculpe, ocorreu um erro ao buscar aparelhos semelhantes.")
@@ -845,7 +867,7 @@ class ultraChatBot():
             # Pode criar um novo estado, ou chamar handle_buy_device() novamente
             self.states[self.chatID]['state'] = 'ASKED_SIMILAR_NOT_FOUND'
             self.states[self.chatID]['last_interaction'] = time.time()
-            save_states(self.states)
+            self.mark_dirty()
 
         
     ################################################################
@@ -861,62 +883,62 @@ class ultraChatBot():
         # Define o próximo estado
         self.states[self.chatID]['state'] = 'ASKED_USED_PHONE_MODEL_SELL'
         self.states[self.chatID]['last_interaction'] = time.time()
-        save_states(self.states)
+        self.mark_dirty()
         
     def handle_used_phone_model_sell(self, user_message: str):
         self.states[self.chatID]['used_phone_model'] = user_message
         self.send_message(self.chatID, "Qual o armazenamento do aparelho (ex: 64GB, 128GB)?")
         self.states[self.chatID]['state'] = 'ASKED_USED_PHONE_STORAGE_SELL'
         self.states[self.chatID]['last_interaction'] = time.time()
-        save_states(self.states)
+        self.mark_dirty()
 
     def handle_used_phone_storage_sell(self, user_message: str):
         self.states[self.chatID]['used_phone_storage'] = user_message
         self.send_message(self.chatID, "Como está a bateria do aparelho? (ex: Boa, Ruim, Saúde 85%)")
         self.states[self.chatID]['state'] = 'ASKED_USED_PHONE_BATTERY_SELL'
         self.states[self.chatID]['last_interaction'] = time.time()
-        save_states(self.states)
+        self.mark_dirty()
 
     def handle_used_phone_battery_sell(self, user_message: str):
         self.states[self.chatID]['used_phone_battery'] = user_message
         self.send_message(self.chatID, "O Face ID está funcionando? (Sim / Não)")
         self.states[self.chatID]['state'] = 'ASKED_USED_PHONE_FACEID_SELL'
         self.states[self.chatID]['last_interaction'] = time.time()
-        save_states(self.states)
+        self.mark_dirty()
 
     def handle_used_phone_faceid_sell(self, user_message: str):
         self.states[self.chatID]['used_phone_faceid'] = user_message
         self.send_message(self.chatID, "Há algum defeito, tela trincada ou algo parecido? Se sim, descreva. Se não, digite 'Não'.")
         self.states[self.chatID]['state'] = 'ASKED_USED_PHONE_DEFECTS_SELL'
         self.states[self.chatID]['last_interaction'] = time.time()
-        save_states(self.states)
+        self.mark_dirty()
     def handle_used_phone_model_sell(self, user_message: str):
         self.states[self.chatID]['used_phone_model'] = user_message
         self.send_message(self.chatID, "Qual o armazenamento do aparelho (ex: 64GB, 128GB)?")
         self.states[self.chatID]['state'] = 'ASKED_USED_PHONE_STORAGE_SELL'
         self.states[self.chatID]['last_interaction'] = time.time()
-        save_states(self.states)
+        self.mark_dirty()
 
     def handle_used_phone_storage_sell(self, user_message: str):
         self.states[self.chatID]['used_phone_storage'] = user_message
         self.send_message(self.chatID, "Como está a bateria do aparelho? (ex: Boa, Ruim, Saúde 85%)")
         self.states[self.chatID]['state'] = 'ASKED_USED_PHONE_BATTERY_SELL'
         self.states[self.chatID]['last_interaction'] = time.time()
-        save_states(self.states)
+        self.mark_dirty()
 
     def handle_used_phone_battery_sell(self, user_message: str):
         self.states[self.chatID]['used_phone_battery'] = user_message
         self.send_message(self.chatID, "O Face ID está funcionando? (Sim / Não)")
         self.states[self.chatID]['state'] = 'ASKED_USED_PHONE_FACEID_SELL'
         self.states[self.chatID]['last_interaction'] = time.time()
-        save_states(self.states)
+        self.mark_dirty()
 
     def handle_used_phone_faceid_sell(self, user_message: str):
         self.states[self.chatID]['used_phone_faceid'] = user_message
         self.send_message(self.chatID, "Há algum defeito, tela trincada ou algo parecido? Se sim, descreva. Se não, digite 'Não'.")
         self.states[self.chatID]['state'] = 'ASKED_USED_PHONE_DEFECTS_SELL'
         self.states[self.chatID]['last_interaction'] = time.time()
-        save_states(self.states)
+        self.mark_dirty()
     
     def handle_used_phone_defects_sell(self, user_message: str):
         self.states[self.chatID]['used_phone_defects'] = user_message
@@ -924,7 +946,7 @@ class ultraChatBot():
                                     "Pode mandar uma de cada vez ou várias. Assim que terminar avise.")
         self.states[self.chatID]['state'] = 'ASKED_USED_PHONE_PHOTOS_SELL'
         self.states[self.chatID]['last_interaction'] = time.time()
-        save_states(self.states)
+        self.mark_dirty()
         
     def handle_used_phone_photos_sell(self, user_message: str):
         # Exemplo simples: só guardamos a resposta e finalizamos
@@ -937,7 +959,7 @@ class ultraChatBot():
         
         # Marcamos a conversa com o status COMPRAR_CEL (conforme solicitado)
         self.states[self.chatID]['state'] = 'VENDER_CEL'
-        save_states(self.states)
+        self.mark_dirty()
 
 
     ################################################################
@@ -950,13 +972,40 @@ class ultraChatBot():
         self.send_message(self.chatID, message)
         self.states[self.chatID]['state'] = 'WAITING_FOR_AGENT'
         self.states[self.chatID]['pause_start_time'] = time.time()
-        save_states(self.states)
+        self.mark_dirty()
         
     ################################################################
     #               PROCESSAMENTO PRINCIPAL
     ################################################################
 
     def Processing_incoming_messages(self):
+        """
+        Processa a mensagem recebida. Ao final do turno grava o estado uma única vez
+        e só então envia as respostas acumuladas.
+
+        A gravação é condicional ao seq lido no início: se outro worker gravou a
+        mesma conversa nesse meio tempo, nada é enviado e o turno é refeito sobre o
+        estado novo (até TURN_ATTEMPTS vezes).
+        """
+        for attempt in range(1, TURN_ATTEMPTS + 1):
+            try:
+                response = self.route_message()
+            except Exception:
+                # Grava e envia o que o turno fez até o erro
+                if self.flush_states():
+                    self.finish_turn()
+                raise
+            if self.flush_states():
+                self.finish_turn()
+                return response
+            logging.warning(
+                f"Conversa {self.chatID} gravada por outro processo durante o turno; "
+                f"refazendo ({attempt}/{TURN_ATTEMPTS})."
+            )
+            self.start_turn()
+        raise TurnConflictError(f"Conversa {self.chatID} mudou durante todas as {TURN_ATTEMPTS} tentativas do turno")
+
+    def route_message(self):
         user_message = self.message.get('body', '').strip()
         if not user_message:
             self.send_message(self.chatID, "Desculpe, não entendi sua mensagem.")
@@ -964,6 +1013,9 @@ class ultraChatBot():
 
         # 1) Primeiro, se não existe esse chatID em self.states, inicia a conversa
         if self.chatID not in self.states:
+            # Cliente que volta depois de a conversa anterior ter ido para o arquivo
+            if conversation_archive.contains(self.chatID):
+                self.send_message(self.chatID, "Olá novamente! Como posso ajudar?")
             self.greet_and_ask_options()
             return
 
@@ -972,125 +1024,165 @@ class ultraChatBot():
             logging.info(f"Conversa {self.chatID} em modo atendente humano. Bot não responderá automaticamente.")
             return
 
-        # 3) Obtém o estado atual
-        state_info = self.states[self.chatID]
-        state = state_info.get('state', '')
+        # 3) Segue o fluxo de acordo com o estado atual (estado desconhecido reinicia a conversa)
+        state = self.states[self.chatID].get('state', '')
+        handler = STATE_DISPATCH.get(state, ultraChatBot.handle_restart)
+        handler(self, user_message)
 
-        # 4) Se o estado for SESSION_ENDED, reinicia a conversa
-        if state == 'SESSION_ENDED':
-            self.send_message(self.chatID, "Olá novamente! Como posso ajudar?")
-            self.greet_and_ask_options()
-            return
+    ################################################################
+    #               TRATADORES DOS ESTADOS DE MENU
+    ################################################################
 
-        # 5) Agora segue o fluxo principal de acordo com o estado
-        elif state == 'ASKED_OPTION':
-            if user_message == '1':
-                self.handle_buy_device()
-            elif user_message == '2':
-                self.handle_technical_assistance_options()
-            elif user_message == '3':
-                self.handle_talk_to_agent()
-            elif user_message == '4':
-                self.send_message(self.chatID, "Obrigado pelo contato. Se precisar de algo, estamos à disposição!")
-                self.states[self.chatID]['state'] = 'FINISHED'
-                self.states[self.chatID]['pause_start_time'] = time.time()
-                save_states(self.states)
-            elif user_message == '5':
-                self.handle_sell_device()  # Método que inicia o fluxo de "Vender um aparelho"
-            else:
-                self.send_message(self.chatID, "Opção inválida. Por favor, selecione uma das opções enviadas.")
-        
-        # ===========================================
-        #         NOVO ESTADO DE 'SEM RESULTADOS'
-        # ===========================================
-        elif state == 'ASKED_NO_RESULTS_ACTION':
-            if user_message == '1':
-                # 1) Listar aparelhos semelhantes
-                self.handle_list_similar_devices()
-            elif user_message == '2':
-                # 2) Fazer nova consulta
-                self.handle_buy_device()
-            elif user_message == '3':
-                # 3) Voltar ao menu principal
-                self.greet_and_ask_options()
-            else:
-                self.send_message(self.chatID, "Por favor, escolha uma das opções: 1, 2 ou 3.")
-
-
-        # COMPRA
-        elif state == 'ASKED_MODEL_NAME':
-            self.handle_model_search(user_message)
-        elif state == 'ASKED_MODEL_NUMBER':
-            self.handle_model_number_choice(user_message)
-        elif state == 'CONFIRM_PURCHASE':
-            self.handle_confirm_purchase(user_message)
-
-        # PAGAMENTO
-        elif state == 'ASKED_PAYMENT_METHOD':
-            self.handle_payment_method(user_message)
-        elif state == 'ASKED_CREDIT_INSTALLMENTS':
-            self.handle_credit_installments(user_message)
-
-        # APARELHO USADO
-        elif state == 'ASKED_USED_PHONE_MODEL':
-            self.handle_used_phone_model(user_message)
-        elif state == 'ASKED_USED_PHONE_STORAGE':
-            self.handle_used_phone_storage(user_message)
-        elif state == 'ASKED_USED_PHONE_BATTERY':
-            self.handle_used_phone_battery(user_message)
-        elif state == 'ASKED_USED_PHONE_FACEID':
-            self.handle_used_phone_faceid(user_message)
-        elif state == 'ASKED_USED_PHONE_DEFECTS':
-            self.handle_used_phone_defects(user_message)
-        elif state == 'ASKED_COMPLEMENT_PAYMENT_METHOD':
-            self.handle_complement_payment_method(user_message)
-            
-        # VENDER APARELHO (NOVOS ESTADOS):
-        elif state == 'ASKED_USED_PHONE_MODEL_SELL':
-            self.handle_used_phone_model_sell(user_message)
-        elif state == 'ASKED_USED_PHONE_STORAGE_SELL':
-            self.handle_used_phone_storage_sell(user_message)
-        elif state == 'ASKED_USED_PHONE_BATTERY_SELL':
-            self.handle_used_phone_battery_sell(user_message)
-        elif state == 'ASKED_USED_PHONE_FACEID_SELL':
-            self.handle_used_phone_faceid_sell(user_message)
-        elif state == 'ASKED_USED_PHONE_DEFECTS_SELL':
-            self.handle_used_phone_defects_sell(user_message)
-        elif state == 'ASKED_USED_PHONE_PHOTOS_SELL':
-            self.handle_used_phone_photos_sell(user_message)
-
-        # COLETA DE DADOS (NOME, CPF, etc.)
-        elif state.startswith('ASKED_'):
-            self.collect_client_data(user_message)
-
-        # ASSISTÊNCIA TÉCNICA
-        elif state == 'ASKED_TECH_OPTION':
-            self.handle_tech_option_choice(user_message)
-        elif state == 'ASKED_PHONE_MODEL':
-            self.handle_phone_model(user_message)
-        elif state == 'ASKED_SERVICE_CONFIRMATION':
-            self.handle_service_confirmation(user_message)
-        elif state == 'ASKED_PROBLEM_DESCRIPTION':
-            self.handle_problem_description(user_message)
-        
-        #FINALIZAR A COMVERSA
-        elif state == 'FINISHED':
-            self.send_message(self.chatID, "Olá novamente! Como podemos te ajudar?")
-            self.send_options()
-            self.states[self.chatID]['state'] = 'ASKED_OPTION'
-            self.states[self.chatID]['last_interaction'] = time.time()
-            save_states(self.states)
+    def handle_restart(self, user_message: str):
+        self.greet_and_ask_options()
 
-        # FALAR COM ATENDENTE
-        elif state == 'WAITING_FOR_AGENT':
-            # Não responde nada
-            pass
-        
-        # FALAR COM VENDER DEL
-        elif state == 'VENDER_CEL':
-            # Não responde nada
-            pass
+    def handle_session_ended(self, user_message: str):
+        self.send_message(self.chatID, "Olá novamente! Como posso ajudar?")
+        self.greet_and_ask_options()
 
-        # Fallback: se cair em um estado desconhecido
+    def handle_option_choice(self, user_message: str):
+        if user_message == '1':
+            self.handle_buy_device()
+        elif user_message == '2':
+            self.handle_technical_assistance_options()
+        elif user_message == '3':
+            self.handle_talk_to_agent()
+        elif user_message == '4':
+            self.send_message(self.chatID, "Obrigado pelo contato. Se precisar de algo, estamos à disposição!")
+            self.states[self.chatID]['state'] = 'FINISHED'
+            self.states[self.chatID]['pause_start_time'] = time.time()
+            self.mark_dirty()
+        elif user_message == '5':
+            self.handle_sell_device()  # Método que inicia o fluxo de "Vender um aparelho"
+        else:
+            self.send_message(self.chatID, "Opção inválida. Por favor, selecione uma das opções enviadas.")
+
+    def handle_no_results_action(self, user_message: str):
+        if user_message == '1':
+            # 1) Listar aparelhos semelhantes
+            self.handle_list_similar_devices()
+        elif user_message == '2':
+            # 2) Fazer nova consulta
+            self.handle_buy_device()
+        elif user_message == '3':
+            # 3) Voltar ao menu principal
+            self.greet_and_ask_options()
         else:
+            self.send_message(self.chatID, "Por favor, escolha uma das opções: 1, 2 ou 3.")
+
+    def handle_similar_not_found(self, user_message: str):
+        if user_message == '1':
+            # 1) Digitar outro modelo
+            self.handle_buy_device()
+        elif user_message == '2':
+            # 2) Menu principal
             self.greet_and_ask_options()
+        else:
+            self.send_message(self.chatID, "Por favor, escolha uma das opções: 1 ou 2.")
+
+    def handle_finished(self, user_message: str):
+        self.send_message(self.chatID, "Olá novamente! Como podemos te ajudar?")
+        self.send_options()
+        self.states[self.chatID]['state'] = 'ASKED_OPTION'
+        self.states[self.chatID]['last_interaction'] = time.time()
+        self.mark_dirty()
+
+    def handle_waiting(self, user_message: str):
+        # Atendente (ou avaliação do aparelho) pendente: não responde nada
+        pass
+
+
+##############################################################################
+# TABELA DE ESTADOS
+##############################################################################
+
+# Estado da conversa -> método que trata a próxima mensagem do cliente
+STATE_HANDLERS = {
+    'SESSION_ENDED': 'handle_session_ended',
+    # Aviso de inatividade enviado: o estado anterior já foi perdido, recomeça
+    'WARNING_SENT': 'handle_restart',
+    'ASKED_OPTION': 'handle_option_choice',
+    'ASKED_NO_RESULTS_ACTION': 'handle_no_results_action',
+    'ASKED_SIMILAR_NOT_FOUND': 'handle_similar_not_found',
+
+    # COMPRA
+    'ASKED_MODEL_NAME': 'handle_model_search',
+    'ASKED_MODEL_NUMBER': 'handle_model_number_choice',
+    'CONFIRM_PURCHASE': 'handle_confirm_purchase',
+
+    # PAGAMENTO
+    'ASKED_PAYMENT_METHOD': 'handle_payment_method',
+    'ASKED_CREDIT_INSTALLMENTS': 'handle_credit_installments',
+
+    # APARELHO USADO
+    'ASKED_USED_PHONE_MODEL': 'handle_used_phone_model',
+    'ASKED_USED_PHONE_STORAGE': 'handle_used_phone_storage',
+    'ASKED_USED_PHONE_BATTERY': 'handle_used_phone_battery',
+    'ASKED_USED_PHONE_FACEID': 'handle_used_phone_faceid',
+    'ASKED_USED_PHONE_DEFECTS': 'handle_used_phone_defects',
+    'ASKED_COMPLEMENT_PAYMENT_METHOD': 'handle_complement_payment_method',
+
+    # VENDER APARELHO
+    'ASKED_USED_PHONE_MODEL_SELL': 'handle_used_phone_model_sell',
+    'ASKED_USED_PHONE_STORAGE_SELL': 'handle_used_phone_storage_sell',
+    'ASKED_USED_PHONE_BATTERY_SELL': 'handle_used_phone_battery_sell',
+    'ASKED_USED_PHONE_FACEID_SELL': 'handle_used_phone_faceid_sell',
+    'ASKED_USED_PHONE_DEFECTS_SELL': 'handle_used_phone_defects_sell',
+    'ASKED_USED_PHONE_PHOTOS_SELL': 'handle_used_phone_photos_sell',
+
+    # ASSISTÊNCIA TÉCNICA
+    'ASKED_TECH_OPTION': 'handle_tech_option_choice',
+    'ASKED_PHONE_MODEL': 'handle_phone_model',
+    'ASKED_SERVICE_CONFIRMATION': 'handle_service_confirmation',
+    'ASKED_PROBLEM_DESCRIPTION': 'handle_problem_description',
+
+    # FINALIZAR A CONVERSA / AGUARDANDO PESSOA
+    'FINISHED': 'handle_finished',
+    'WAITING_FOR_AGENT': 'handle_waiting',
+    'VENDER_CEL': 'handle_waiting',
+}
+
+# COLETA DE DADOS (NOME, CPF, etc.): todas as etapas passam por collect_client_data
+STATE_HANDLERS.update({state: 'collect_client_data' for state in CLIENT_DATA_STEPS})
+
+# Estados de texto livre: mensagens seguidas do cliente nesses estados são juntadas
+# (debounce.py) antes de irem ao tratador; estados de menu respondem na hora
+FREE_TEXT_STATES = {'ASKED_MODEL_NAME', 'ASKED_PHONE_MODEL', 'ASKED_PROBLEM_DESCRIPTION'}
+
+
+def assigned_states(*modules) -> set:
+    """Estados gravados em `<algo>['state'] = '<ESTADO>'` no código dos módulos."""
+    states = set()
+    for module in modules:
+        tree = ast.parse(inspect.getsource(module))
+        for node in ast.walk(tree):
+            if not isinstance(node, ast.Assign) or not isinstance(node.value, ast.Constant):
+                continue
+            for target in node.targets:
+                if (isinstance(target, ast.Subscript) and isinstance(target.slice, ast.Constant)
+                        and target.slice.value == 'state' and isinstance(node.value.value, str)):
+                    states.add(node.value.value)
+    return states
+
+
+def build_state_dispatch() -> dict:
+    """
+    Monta {estado: função} a partir de STATE_HANDLERS e valida, na inicialização,
+    que todo estado que o bot (ou o agendador de inatividade) pode gravar tem tratador.
+    """
+    dispatch = {}
+    for state, method_name in STATE_HANDLERS.items():
+        handler = getattr(ultraChatBot, method_name, None)
+        if handler is None:
+            raise RuntimeError(f"Tratador {method_name} do estado {state} não existe em ultraChatBot.")
+        dispatch[state] = handler
+
+    reachable = assigned_states(sys.modules[__name__], inactivity)
+    reachable.update(next_state for _, _, next_state in CLIENT_DATA_STEPS.values() if next_state)
+    missing = reachable - dispatch.keys()
+    if missing:
+        raise RuntimeError(f"Estados sem tratador registrado: {', '.join(sorted(missing))}")
+    return dispatch
+
+
+STATE_DISPATCH = build_state_dispatch()
@@ -0,0 +1,215 @@
+import time
+import base64
+import random
+import logging
+from urllib.parse import urlencode, quote, quote_from_bytes
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import ULTRAMSG_SEND_SECONDS
+
+##############################################################################
+# CLIENTE HTTP DA ULTRAMSG
+##############################################################################
+
+DEFAULT_BASE_URL = "https://api.ultramsg.com"
+
+# Respostas que valem uma nova tentativa (limite de taxa e falhas temporárias do servidor)
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+
+class UltraMsgClient():
+    """
+    Cliente único da API da UltraMsg, compartilhado por todas as threads.
+
+    - Sessão com pool de conexões keep-alive (sem um handshake TCP+TLS por mensagem).
+    - Timeout de conexão e de leitura em toda chamada.
+    - Novas tentativas com backoff exponencial e jitter, apenas para status em
+      RETRYABLE_STATUS e falhas de conexão. Um timeout de leitura não é repetido:
+      a UltraMsg pode ter recebido a mensagem, e repetir duplicaria o envio.
+
+    `base_url` pode apontar para um servidor local que simula a UltraMsg em testes.
+    """
+
+    def __init__(self, instance_id: str, token: str, base_url: str = DEFAULT_BASE_URL,
+                 connect_timeout: float = 5.0, read_timeout: float = 20.0,
+                 max_retries: int = 3, backoff: float = 0.5, pool_size: int = 10):
+        self.instance_id = instance_id
+        self.token = token
+        self.base_url = base_url.rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def url(self, endpoint: str) -> str:
+        return f"{self.base_url}/{self.instance_id}/{endpoint}"
+
+    def retry_delay(self, attempt: int, response=None) -> float:
+        """Espera antes da próxima tentativa: Retry-After, se vier, ou backoff com jitter."""
+        if response is not None:
+            retry_after = response.headers.get('Retry-After', '')
+            if retry_after.isdigit():
+                return min(float(retry_after), 30.0)
+        return random.uniform(0, self.backoff * (2 ** attempt))
+
+    def post(self, endpoint: str, data: dict) -> requests.Response:
+        """POST de formulário em /<instance>/<endpoint>, com o token."""
+        return self.send(endpoint, dict(data, token=self.token))
+
+    def send(self, endpoint: str, body, headers: dict = None) -> requests.Response:
+        """
+        Envia `body` (dicionário ou corpo pronto, ex.: Base64FormBody) com novas tentativas.
+        Devolve a última resposta recebida (mesmo com erro HTTP) ou relança a falha de
+        conexão se nenhuma tentativa respondeu.
+        """
+        kind = 'document' if endpoint == 'messages/document' else 'text'
+        started = time.perf_counter()
+        status = 'error'
+        try:
+            response = self._send_with_retries(endpoint, body, headers)
+            status = response.status_code
+            return response
+        finally:
+            ULTRAMSG_SEND_SECONDS.labels(kind, status).observe(time.perf_counter() - started)
+
+    def _send_with_retries(self, endpoint: str, body, headers: dict = None) -> requests.Response:
+        url = self.url(endpoint)
+
+        for attempt in range(self.max_retries + 1):
+            response = None
+            try:
+                response = self.session.post(url, data=body, headers=headers, timeout=self.timeout)
+            except requests.ConnectionError as e:
+                if attempt == self.max_retries:
+                    raise
+                logging.warning(f"UltraMsg indisponível ({e}); tentativa {attempt + 1} de {self.max_retries + 1}.")
+            else:
+                if response.status_code not in RETRYABLE_STATUS or attempt == self.max_retries:
+                    return response
+                logging.warning(f"UltraMsg respondeu {response.status_code}; tentativa {attempt + 1} de {self.max_retries + 1}.")
+
+            time.sleep(self.retry_delay(attempt, response))
+
+    def send_text(self, to: str, body: str) -> requests.Response:
+        return self.post('messages/chat', {"to": to, "body": body})
+
+    def send_document(self, to: str, filename: str, document: bytes) -> requests.Response:
+        """Envia um documento a partir dos bytes, codificando em Base64 durante o envio."""
+        body = Base64FormBody(
+            {"token": self.token, "to": to, "base64Encoded": "true", "filename": filename},
+            'document', document,
+        )
+        return self.send('messages/document', body, headers={'Content-Type': FORM_CONTENT_TYPE})
+
+
+FORM_CONTENT_TYPE = 'application/x-www-form-urlencoded'
+
+
+class Base64FormBody():
+    """
+    Corpo application/x-www-form-urlencoded em que um campo binário é codificado em
+    Base64 (e escapado para URL) pedaço a pedaço, enquanto é enviado.
+
+    Assim o documento não existe inteiro em Base64 na memória; só os bytes originais.
+    O tamanho é calculado antes (Content-Length), e cada iteração recomeça do início,
+    o que permite reenviar o mesmo corpo numa nova tentativa.
+    """
+
+    # Múltiplo de 3: cada pedaço vira Base64 sem '=' no meio do campo
+    CHUNK_SIZE = 3 * 16 * 1024
+
+    def __init__(self, fields: dict, file_field: str, data: bytes):
+        self.prefix = (urlencode(fields) + '&' + quote(file_field) + '=').encode('ascii')
+        self.data = memoryview(data)
+        self.length = len(self.prefix) + sum(len(chunk) for chunk in self._encoded_chunks())
+
+    def _encoded_chunks(self):
+        for start in range(0, len(self.data), self.CHUNK_SIZE):
+            encoded = base64.b64encode(self.data[start:start + self.CHUNK_SIZE])
+            yield quote_from_bytes(encoded, safe='').encode('ascii')
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __iter__(self):
+        yield self.prefix
+        yield from self._encoded_chunks()
+
+
+##############################################################################
+# CAIXA DE SAÍDA DO TURNO (junta mensagens seguidas)
+##############################################################################
+
+# Limite de caracteres de uma mensagem de texto do WhatsApp
+WHATSAPP_MAX_CHARS = 4096
+
+# Separador usado ao juntar duas mensagens num mesmo balão
+COALESCE_SEPARATOR = "\n\n"
+
+
+def split_text(text: str, limit: int = WHATSAPP_MAX_CHARS) -> list:
+    """Quebra um texto maior que `limit` em partes, preferindo quebras de linha."""
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    if text:
+        parts.append(text)
+    return parts
+
+
+class Outbox():
+    """
+    Acumula o que o bot envia a um chat durante um turno e entrega tudo no final,
+    juntando textos consecutivos num único balão (até WHATSAPP_MAX_CHARS).
+
+    `add_break()` força um novo balão: o que veio antes e o que vem depois nunca
+    são juntados.
+    """
+
+    def __init__(self, limit: int = WHATSAPP_MAX_CHARS):
+        self.limit = limit
+        self.items = []  # textos na ordem em que foram adicionados; None = quebra de balão
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def add_text(self, text: str):
+        self.items.append(text)
+
+    def add_break(self):
+        self.items.append(None)
+
+    def drain(self) -> list:
+        """Esvazia a caixa e devolve os textos já agrupados em balões."""
+        items, self.items = self.items, []
+        messages = []
+        buffer = None
+
+        for text in items:
+            if text is None:
+                if buffer is not None:
+                    messages.append(buffer)
+                    buffer = None
+                continue
+            for part in split_text(text, self.limit):
+                joined = None if buffer is None else buffer.rstrip("\n") + COALESCE_SEPARATOR + part
+                if joined is not None and len(joined) <= self.limit:
+                    buffer = joined
+                else:
+                    if buffer is not None:
+                        messages.append(buffer)
+                    buffer = part
+
+        if buffer is not None:
+            messages.append(buffer)
+        return messages